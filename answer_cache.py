@@ -0,0 +1,165 @@
+"""Semantic cache of query answers, one per PineconeIndex.
+
+Paraphrased questions ("how do I X" / "steps to X") embed close together, so
+a query whose embedding is within ANSWER_CACHE_THRESHOLD cosine similarity
+of an earlier query with the same options is answered from the cache,
+skipping term extraction, the search embedding, the vector query and the
+completion. Entries live in a fixed-size float32 matrix per index and a
+lookup is a single matrix-vector product.
+
+Uploads and deletes bump a generation counter for the index in the shared
+state backend; every worker drops its entries for that index when it sees
+a new generation.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+from metrics import Counter
+from shared_state import state as shared_state
+
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95))  # 0 disables
+ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', 1000))  # Entries per index
+ANSWER_CACHE_TTL = float(os.environ.get('ANSWER_CACHE_TTL', 3600))  # Seconds
+
+# Request fields that change the answer; queries only match within the same options
+VARIANT_FIELDS = ('top_k', 'additional_context', 'context_token_budget', 'mmr', 'filters',
+                  'extract_terms')
+
+CACHE_REQUESTS = Counter('pfm_answer_cache_requests_total',
+                         'Answer cache lookups by result (hit or miss)', ('index', 'result'))
+CACHE_SECONDS_SAVED = Counter('pfm_answer_cache_seconds_saved_total',
+                              'Query latency avoided by answering from the cache', ('index',))
+
+
+def request_variant(data):
+    """Stable key of the request options that affect the answer"""
+    options = {name: data.get(name) for name in VARIANT_FIELDS if data.get(name) is not None}
+    return hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IndexAnswerCache:
+    """Ring buffer of normalized query embeddings with their answers"""
+
+    def __init__(self, dimension, capacity, generation):
+        self.generation = generation
+        self.vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self.variants = [None] * capacity
+        self.expires = np.zeros(capacity, dtype=np.float64)
+        self.entries = [None] * capacity
+        self.next_slot = 0
+        self.size = 0
+
+    def lookup(self, vector, variant, threshold):
+        if not self.size:
+            return None, 0.0
+        scores = self.vectors[:self.size] @ vector
+        usable = self.expires[:self.size] > time.time()
+        usable &= np.fromiter((v == variant for v in self.variants[:self.size]),
+                              dtype=bool, count=self.size)
+        scores = np.where(usable, scores, -1.0)
+        best = int(np.argmax(scores))
+        if scores[best] < threshold:
+            return None, float(max(scores[best], 0.0))
+        return self.entries[best], float(scores[best])
+
+    def store(self, vector, variant, entry, ttl):
+        slot = self.next_slot
+        self.vectors[slot] = vector
+        self.variants[slot] = variant
+        self.expires[slot] = time.time() + ttl
+        self.entries[slot] = entry
+        self.next_slot = (slot + 1) % len(self.entries)
+        self.size = min(self.size + 1, len(self.entries))
+
+
+class AnswerCache:
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, capacity=ANSWER_CACHE_SIZE,
+                 ttl=ANSWER_CACHE_TTL):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self._indexes = {}
+        self._stats = {}  # Kept across invalidations: index id -> hit/miss counts
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0 and self.capacity > 0
+
+    def generation(self, index_id):
+        """Current generation of an index; it changes whenever the index's files change"""
+        return shared_state.get(f'answer_cache_generation:{index_id}', 0)
+
+    def _index(self, index_id, dimension, generation):
+        """The cache of an index, emptied if another worker changed its files"""
+        cache = self._indexes.get(index_id)
+        if cache is None or cache.generation != generation or cache.vectors.shape[1] != dimension:
+            cache = self._indexes[index_id] = IndexAnswerCache(dimension, self.capacity, generation)
+        return cache
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, index_id, index_name, query_vector, variant, generation):
+        """Find the answer to a similar earlier query.
+
+        Returns (entry, similarity); entry is None on a miss, otherwise a dict
+        with the cached response `payload` and the `seconds` it took to compute.
+        """
+        vector = self._normalize(query_vector)
+        with self._lock:
+            cache = self._index(index_id, len(vector), generation)
+            entry, similarity = cache.lookup(vector, variant, self.threshold)
+            stats = self._stats.setdefault(index_id, {'hits': 0, 'misses': 0, 'seconds_saved': 0.0})
+            if entry is None:
+                stats['misses'] += 1
+            else:
+                stats['hits'] += 1
+                stats['seconds_saved'] += entry['seconds']
+        CACHE_REQUESTS.inc(index=index_name, result='miss' if entry is None else 'hit')
+        if entry is not None:
+            CACHE_SECONDS_SAVED.inc(entry['seconds'], index=index_name)
+        return entry, similarity
+
+    def store(self, index_id, query_vector, variant, payload, seconds, generation):
+        """Remember an answer along with how long it took to compute.
+
+        Answers computed while the index's files changed are not stored.
+        """
+        if self.generation(index_id) != generation:
+            return
+        vector = self._normalize(query_vector)
+        with self._lock:
+            cache = self._index(index_id, len(vector), generation)
+            cache.store(vector, variant, {'payload': payload, 'seconds': seconds}, self.ttl)
+
+    def invalidate(self, index_id):
+        """Drop cached answers for an index in every worker"""
+        shared_state.update(f'answer_cache_generation:{index_id}', lambda g: g + 1, default=0)
+        with self._lock:
+            self._indexes.pop(index_id, None)
+
+    def stats(self, index_id):
+        """Hit rate and latency saved for an index in this worker"""
+        with self._lock:
+            cache = self._indexes.get(index_id)
+            stats = self._stats.get(index_id, {'hits': 0, 'misses': 0, 'seconds_saved': 0.0})
+            lookups = stats['hits'] + stats['misses']
+            return {
+                'entries': cache.size if cache else 0,
+                'hits': stats['hits'],
+                'misses': stats['misses'],
+                'hit_rate': round(stats['hits'] / lookups, 4) if lookups else 0.0,
+                'seconds_saved': round(stats['seconds_saved'], 3),
+            }
+
+
+answer_cache = AnswerCache()
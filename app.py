@@ -5,17 +5,42 @@ from dotenv import load_dotenv
 # Load environment variables first
 load_dotenv()
 
-from flask import Flask, render_template, request, redirect, flash, url_for, jsonify, send_file
-from werkzeug.utils import secure_filename
+import contextvars
+from functools import wraps
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from flask import (Flask, render_template, request, redirect, flash, url_for, jsonify, send_file,
+                   make_response, Response, abort)
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
 from pinecone import Pinecone, ServerlessSpec
-from openai import OpenAI
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import SQLAlchemyError
 from utils import (generate_thumbnail, generate_pdf_preview, get_mime_type,
-                   is_image, is_pdf, get_file_icon, extract_text_from_file,
-                   IMAGE_EXTENSIONS, DOCUMENT_EXTENSIONS, chunk_text,
-                   generate_title)
+                   is_image, is_pdf, get_file_icon,
+                   IMAGE_EXTENSIONS, DOCUMENT_EXTENSIONS, chunk_text)
+from retrieval import (batch_search_terms_messages, parse_batch_search_terms,
+                       DEFAULT_CONTEXT_TOKEN_BUDGET, DEFAULT_MMR_LAMBDA)
+from ratelimit import openai_client, limited_call, estimate_tokens, INTERACTIVE
+from metrics import span, start_trace, finish_trace, set_trace_labels, render_metrics
+from extractors import extract_text_cached
+from titles import request_title, heuristic_title
+from filters import epoch_seconds
+from shared_state import state as shared_state
+from answer_cache import answer_cache
+from query_pipeline import (parse_query, query_steps, search_steps, empty_result, resolve_index_filters,
+                            Embed, Complete, Search, Blocking, Log)
+from batch_query import parse_batch, BATCH_CONCURRENCY
+from jobs import (upload_scheduler, upload_lane, set_job_state, job_state, cancel_job, is_cancelled,
+                  check_cancelled, JobCancelled, LANE_PRIORITIES, TERMINAL_STATES)
+from storage import (save_stream_hashed, place_blob_file, content_path, acquire_blob, release_blob,
+                     delete_file_row, vector_base_id, chunk_vector_ids)
 import pinecone
+import openai
+import urllib3
+from pinecone.exceptions import PineconeException
 import time
-from threading import Lock
+import re
+import uuid
 from pydantic import BaseModel
 from typing import List, Optional
 import json
@@ -26,35 +51,39 @@ from database import db
 # Initialize Flask
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY") or "development-key"
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///files.db"
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///files.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16MB max file size
-app.config["UPLOAD_FOLDER"] = "uploads"
+app.config["UPLOAD_FOLDER"] = os.environ.get("UPLOAD_FOLDER", "uploads")
+app.config["CONTEXT_TOKEN_BUDGET"] = int(
+    os.environ.get("CONTEXT_TOKEN_BUDGET", DEFAULT_CONTEXT_TOKEN_BUDGET))
+app.config["MMR_LAMBDA"] = float(os.environ.get("MMR_LAMBDA", DEFAULT_MMR_LAMBDA))
+app.config["MMR_MAX_PER_FILE"] = int(os.environ.get("MMR_MAX_PER_FILE", 0)) or None
+# "x-accel-redirect" (nginx) or "x-sendfile" (Apache, lighttpd) hands file bytes to the proxy
+app.config["FILE_SERVING_MODE"] = os.environ.get("FILE_SERVING_MODE", "").lower()
+app.config["ACCEL_REDIRECT_PREFIX"] = os.environ.get("ACCEL_REDIRECT_PREFIX", "/protected/")
 
 # Initialize extensions
 db.init_app(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
+# With several workers, a message queue (e.g. redis://) relays emits to every worker's clients
+socketio = SocketIO(app, cors_allowed_origins="*",
+                    message_queue=os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None)
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
-# Global upload status tracking
-upload_status = {
+# Upload status and API logs live in the shared state backend so every worker sees them
+IDLE_STATUS = {
     'status': 'idle',
     'progress': 0,
     'message': '',
     'current_operation': '',
     'operation_progress': 0,
-    'timestamp': time.time()
+    'timestamp': 0
 }
-status_lock = Lock()
-
-# Global log tracking
-api_logs = []
 max_logs = 100
 
 def add_api_log(message, level="info", additional_data=None):
-    global api_logs
     timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
     
     # Set verbose to True by default
@@ -74,9 +103,7 @@ def add_api_log(message, level="info", additional_data=None):
         "verbose": is_verbose,
         **(additional_data or {})
     }
-    api_logs.append(log_entry)
-    if len(api_logs) > max_logs:
-        api_logs = api_logs[-max_logs:]
+    shared_state.append_log('api_logs', log_entry, max_logs)
     socketio.emit('new_log', log_entry)
 
 # Update the logging configuration to capture API logs
@@ -84,13 +111,15 @@ class APILogHandler(logging.Handler):
     def emit(self, record):
         add_api_log(self.format(record), record.levelname.lower())
 
-# Add the custom handler to the root logger
-api_log_handler = APILogHandler()
+# Add the custom handler to the root logger; the log panel only shows info and above,
+# and every forwarded record is a shared state write
+api_log_handler = APILogHandler(level=logging.INFO)
 api_log_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.getLogger().addHandler(api_log_handler)
 
 def update_status(status, message, operation=None, operation_progress=None):
-    with status_lock:
+    def apply(current):
+        upload_status = dict(current)
         upload_status['status'] = status
         upload_status['message'] = message
         upload_status['timestamp'] = time.time()
@@ -110,9 +139,12 @@ def update_status(status, message, operation=None, operation_progress=None):
                 upload_status['progress'] = 50 + (operation_progress * 0.2)  # 50-70%
             elif operation == 'vectorizing':
                 upload_status['progress'] = 70 + (operation_progress * 0.3)  # 70-100%
+        return upload_status
+
+    shared_state.update('upload_status', apply, default=IDLE_STATUS)
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+# Initialize OpenAI client (shared with utils, rate limited process-wide)
+client = openai_client()
 
 # Initialize Pinecone client
 pinecone_client = None
@@ -236,7 +268,9 @@ def files():
     return render_template('index.html',
                          files=files,
                          indexes=indexes,
-                         get_file_icon=get_file_icon)
+                         get_file_icon=get_file_icon,
+                         file_url=file_url,
+                         preview_url=preview_url)
 
 @app.route('/logs')
 def logs():
@@ -316,6 +350,7 @@ def delete_index(index_id):
         # Delete from database
         db.session.delete(index)
         db.session.commit()
+        answer_cache.invalidate(index_id)
         
         flash(f"Successfully deleted index: {index.name}", "success")
         return redirect(url_for('list_indexes'))
@@ -324,7 +359,126 @@ def delete_index(index_id):
         flash(f"Error deleting index: {str(e)}", "error")
         return redirect(url_for('list_indexes'))
 
+def file_metadata(file):
+    """Per-file metadata stored on every chunk vector, used by query filters"""
+    return {
+        'filename': file.filename,
+        'mime_type': file.mime_type,
+        'content_hash': file.content_hash,
+        'file_id': file.id,
+        'index_id': file.index_id,
+        'uploaded_at': epoch_seconds(file.uploaded_at)
+    }
+
+def copy_vectors(source_index_name, target_index_name, vector_ids, metadata_overrides, batch_size=100):
+    """Copy already computed chunk vectors from one index into another"""
+    source = pinecone_client.Index(source_index_name)
+    target = pinecone_client.Index(target_index_name)
+    copied = 0
+    for start in range(0, len(vector_ids), batch_size):
+        fetched = source.fetch(ids=vector_ids[start:start + batch_size])
+        vectors = []
+        for vector in fetched.vectors.values():
+            metadata = dict(vector.metadata or {})
+            metadata.update(metadata_overrides)
+            vectors.append({'id': vector.id, 'values': vector.values, 'metadata': metadata})
+        if vectors:
+            target.upsert(vectors=vectors)
+            copied += len(vectors)
+    if copied != len(vector_ids):
+        raise ValueError(f"Expected {len(vector_ids)} vectors in {source_index_name}, found {copied}")
+    return copied
+
+def release_upload_blob(content_hash, thumbnail_path):
+    """Drop the blob reference a failed or cancelled upload took"""
+    release_blob(content_hash, thumbnail_path)
+    db.session.commit()
+
+def discard_upload(new_file, content_hash, thumbnail_path):
+    """Undo what a failed or cancelled upload recorded in the database.
+
+    Once its File row is committed, deleting the row drops the blob
+    reference; before that only the reference is released.
+    """
+    db.session.rollback()
+    if new_file is not None and sa_inspect(new_file).persistent:
+        delete_file_row(new_file)
+        db.session.commit()
+    else:
+        release_upload_blob(content_hash, thumbnail_path)
+
+# Errors from the services behind the app; their messages can carry request details
+UPSTREAM_ERRORS = (openai.OpenAIError, PineconeException, urllib3.exceptions.HTTPError)
+
+def client_error(e):
+    """Message for an unexpected error that is safe to return to clients"""
+    if isinstance(e, SQLAlchemyError):
+        return 'Database error, please try again'
+    if isinstance(e, UPSTREAM_ERRORS):
+        return 'Upstream service error, please try again'
+    return str(e)
+
+def apply_title(file_id, title):
+    """Replace the stand-in title of a file once its AI title is ready"""
+    with app.app_context():
+        try:
+            file = db.session.get(models.File, file_id)
+            if file and file.display_title != title:
+                file.display_title = title
+                db.session.commit()
+        except Exception as e:
+            logging.error(f"Error saving title for file {file_id}: {e}")
+            db.session.rollback()
+
+def traced(pipeline):
+    """Collect per-stage spans for a view and expose them on the response.
+
+    Timings are always sent in a Server-Timing header and are added to JSON
+    responses as "timings" when the request sets include_timings.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            start_trace(pipeline=pipeline)
+            try:
+                response = make_response(view(*args, **kwargs))
+            finally:
+                timings = finish_trace()
+
+            response.headers['Server-Timing'] = ', '.join(
+                f"{t['stage']};dur={t['ms']}" for t in timings)
+            json_body = request.get_json(silent=True) if request.is_json else None
+            wants_timings = (request.values.get('include_timings', '').lower() in ('1', 'true')
+                             or bool(json_body and json_body.get('include_timings')))
+            if wants_timings and response.is_json and isinstance(response.get_json(), dict):
+                response.set_data(json.dumps({**response.get_json(), 'timings': timings}))
+            return response
+        return wrapper
+    return decorator
+
+@app.route('/metrics')
+def metrics():
+    """Expose pipeline latency histograms in the Prometheus text format."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+UPLOAD_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+EMBED_BATCH_SIZE = int(os.environ.get('UPLOAD_EMBED_BATCH_SIZE', 32))  # Chunks per embedding call and upsert
+
+def remove_written_vectors(index_name, index_id, base_vector_id, vector_ids):
+    """Delete the vectors a cancelled upload wrote, unless a processed file in the index owns them"""
+    if not vector_ids:
+        return
+    shared = db.session.query(models.File).filter_by(
+        index_id=index_id, vector_id=base_vector_id, processed=True).first()
+    if shared:
+        return
+    index_vector_store = pinecone_client.Index(index_name)
+    for start in range(0, len(vector_ids), 1000):
+        index_vector_store.delete(ids=vector_ids[start:start + 1000], namespace="")
+    logging.info(f"Deleted {len(vector_ids)} vectors written by a cancelled upload")
+
 @app.route('/upload', methods=['POST'])
+@traced('upload')
 def upload_file():
     try:
         if 'file' not in request.files:
@@ -342,169 +496,426 @@ def upload_file():
         if not index:
             return jsonify({'error': 'Invalid index selected'}), 400
 
+        # The client may pick the id so it can cancel before this response arrives
+        upload_id = request.form.get('upload_id') or uuid.uuid4().hex
+        if not UPLOAD_ID_PATTERN.match(upload_id):
+            return jsonify({'error': 'Invalid upload id'}), 400
+
         if file and allowed_file(file.filename):
+            if is_cancelled(upload_id):
+                return jsonify({'status': 'cancelled', 'upload_id': upload_id,
+                                'message': 'Upload cancelled'}), 200
             update_status('processing', 'Starting upload...', 'uploading', 0)
-            
+
             filename = secure_filename(file.filename)
             mime_type = get_mime_type(filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
-
-            update_status('processing', 'File uploaded, generating preview...', 'processing', 0)
-
-            # Generate display title
-            display_title = generate_title(filename)
-
-            thumbnail_path = None
-            if is_image(mime_type):
-                update_status('processing', 'Processing image...', 'processing', 30)
-                thumbnail_path = generate_thumbnail(file_path, filename)
-            elif is_pdf(mime_type):
-                update_status('processing', 'Generating PDF preview...', 'processing', 30)
-                thumbnail_path = generate_pdf_preview(file_path, filename)
-                logging.info(f"Generated PDF preview: {thumbnail_path}")
-
-            update_status('processing', 'Extracting content...', 'analyzing', 0)
-            # Extract text content
-            text_content = extract_text_from_file(file_path, mime_type)
-            vector_id = None
-
-            # Generate embedding and store in Pinecone
-            if text_content and client:
+            set_trace_labels(index=index.name, mime_type=mime_type)
+            with span('store') as store_span:
+                content_hash, temp_path, size = save_stream_hashed(file, app.config['UPLOAD_FOLDER'])
                 try:
-                    update_status('processing', 'Analyzing content...', 'analyzing', 50)
-                    # Generate base vector_id for the file
-                    base_vector_id = f"file_{filename}"
-
-                    # Initialize vector store for this specific index
-                    index_vector_store = pinecone_client.Index(index.name)
-
-                    # Chunk the text content
-                    chunks = chunk_text(text_content)
-                    total_chunks = len(chunks)
-                    logging.info(f"Split document into {total_chunks} chunks")
-
-                    vectors_to_upsert = []
-
-                    # Process each chunk
-                    for chunk_idx, chunk in enumerate(chunks):
-                        progress = (chunk_idx / total_chunks) * 100
-                        update_status(
-                            'processing',
-                            f'Vectorizing section {chunk_idx + 1} of {total_chunks}...',
-                            'vectorizing', progress)
-
-                        # Generate embeddings using OpenAI
-                        embedding_response = client.embeddings.create(
-                            model="text-embedding-ada-002", input=chunk)
-
-                        if embedding_response and embedding_response.data:
-                            chunk_vector_id = f"{base_vector_id}_chunk_{chunk_idx}"
-                            vectors_to_upsert.append({
-                                'id': chunk_vector_id,
-                                'values': embedding_response.data[0].embedding,
-                                'metadata': {
-                                    'filename': filename,
-                                    'mime_type': mime_type,
-                                    'chunk_index': chunk_idx,
-                                    'total_chunks': total_chunks,
-                                    'text_content': chunk[:1000],
-                                    'is_chunk': True,
-                                    'parent_file': base_vector_id
-                                }
-                            })
-
-                    if vectors_to_upsert:
-                        update_status('processing', 'Storing vectors in database...', 'vectorizing', 90)
-
-                        try:
-                            index_vector_store.upsert(vectors=vectors_to_upsert)
-                            vector_id = base_vector_id
-                            logging.info(f"Successfully vectorized file: {filename} with {len(vectors_to_upsert)} chunks")
-                            update_status('processing', 'Finalizing...', 'vectorizing', 100)
+                    # Reference the blob before placing the bytes so a concurrent delete keeps them
+                    file_path = acquire_blob(content_hash,
+                                             content_path(app.config['UPLOAD_FOLDER'], content_hash, filename),
+                                             size, mime_type)
+                except Exception:
+                    os.remove(temp_path)
+                    raise
+                try:
+                    already_stored = place_blob_file(temp_path, file_path)
+                except Exception:
+                    release_upload_blob(content_hash, None)
+                    raise
+                store_span.set(payload_bytes=size, deduplicated=already_stored)
+            logging.info(f"Stored {filename} as {content_hash} ({size} bytes)")
+
+            # Small uploads go ahead of bulk work unless the client says otherwise
+            lane = upload_lane(request.form.get('priority'), size)
+            set_job_state(upload_id, 'queued', lane=lane, filename=filename, index_id=index.id)
+            job = upload_scheduler.submit(upload_id, lane, process_upload, upload_id, lane, index.id,
+                                          filename, mime_type, content_hash, file_path, size)
+
+            if request.form.get('wait', '').lower() in ('0', 'false'):
+                return jsonify({'status': 'queued', 'upload_id': upload_id, 'lane': lane}), 202
+            payload, status_code = job.wait()
+            return jsonify(payload), status_code
 
-                        except Exception as e:
-                            logging.error(f"Pinecone upsert error: {e}")
-                            raise
+        return jsonify({'error': 'Invalid file type'}), 400
 
-                except Exception as e:
-                    logging.error(f"Error vectorizing file: {e}")
-                    return jsonify({'error': f'Error vectorizing file: {str(e)}'}), 500
+    except Exception as e:
+        logging.error(f"Upload error: {e}")
+        db.session.rollback()
+        update_status('error', client_error(e), 'error', 0)
+        return jsonify({'error': client_error(e)}), 500
+
+def process_upload(upload_id, lane, index_id, filename, mime_type, content_hash, file_path, size):
+    """Preview, extract, embed and record a stored upload; runs on an upload worker.
+
+    The request has already taken a reference to the content's blob. The File
+    row is committed unprocessed before embedding starts and the blob's
+    updated_at is refreshed after every chunk batch, so the reconciler can
+    tell the upload is still running. Checks for cancellation between steps
+    and between chunk batches. A cancelled or failed upload deletes the
+    vectors it wrote, its File row and its blob reference. Returns the JSON
+    payload and status code for the upload response.
+    """
+    with app.app_context():
+        set_job_state(upload_id, 'running')
+        written_vector_ids = []
+        base_vector_id = vector_base_id(content_hash)
+        index = None
+        new_file = None
+        thumbnail_path = None
+        try:
+            check_cancelled(upload_id)
+            index = db.session.get(models.PineconeIndex, index_id)
+            blob = db.session.query(models.FileBlob).filter_by(content_hash=content_hash).one()
 
-            # Create database entry
+            update_status('processing', 'File uploaded, generating preview...', 'processing', 0)
+
+            # Start the AI title in the background; a local title stands in until it arrives
+            with span('title'):
+                ai_title = request_title(filename)
+                display_title = ai_title or heuristic_title(filename)
+
+            # Previews are named after the content so identical files share them
+            preview_name = os.path.basename(file_path)
+            if not blob.thumbnail_path:
+                with span('preview'):
+                    if is_image(mime_type):
+                        update_status('processing', 'Processing image...', 'processing', 30)
+                        blob.thumbnail_path = generate_thumbnail(file_path, preview_name)
+                    elif is_pdf(mime_type):
+                        update_status('processing', 'Generating PDF preview...', 'processing', 30)
+                        blob.thumbnail_path = generate_pdf_preview(file_path, preview_name)
+                        logging.info(f"Generated PDF preview: {blob.thumbnail_path}")
+            thumbnail_path = blob.thumbnail_path
+
+            # Commit the file row first so its id can go into the chunk metadata
             new_file = models.File(
                 filename=filename,
                 filepath=file_path,
                 mime_type=mime_type,
                 thumbnail_path=thumbnail_path,
-                vector_id=vector_id,
-                processed=bool(vector_id),
+                processed=False,
                 display_title=display_title,
-                index_id=index_id
+                index_id=index.id,
+                content_hash=content_hash
             )
             db.session.add(new_file)
             db.session.commit()
+            chunk_file_metadata = file_metadata(new_file)
+
+            vector_id = None
+
+            # Identical content that is already vectorized can skip extraction and embedding
+            existing_file = db.session.query(models.File).filter(
+                models.File.content_hash == content_hash,
+                models.File.processed.is_(True)).order_by(
+                    (models.File.index_id == index.id).desc()).first()
+
+            if existing_file and blob.chunk_count:
+                if existing_file.index_id == index.id:
+                    logging.info(f"Content of {filename} is already vectorized in {index.name}")
+                    vector_id = base_vector_id
+                else:
+                    try:
+                        check_cancelled(upload_id)
+                        update_status('processing', 'Reusing existing embeddings...', 'vectorizing', 50)
+                        copied_ids = chunk_vector_ids(base_vector_id, blob.chunk_count)
+                        with span('vector_copy') as copy_span:
+                            copied = copy_vectors(existing_file.index.name, index.name,
+                                                  copied_ids, chunk_file_metadata)
+                            copy_span.set(vectors=copied)
+                        written_vector_ids.extend(copied_ids)
+                        vector_id = base_vector_id
+                        logging.info(f"Copied {copied} vectors for {filename} from {existing_file.index.name}")
+                    except JobCancelled:
+                        raise
+                    except Exception as e:
+                        logging.error(f"Error copying vectors, re-embedding instead: {e}")
+
+            if vector_id is None:
+                check_cancelled(upload_id)
+                update_status('processing', 'Extracting content...', 'analyzing', 0)
+                # Extract text content
+                with span('extraction') as extraction_span:
+                    text_content = extract_text_cached(file_path, mime_type, content_hash)
+                    extraction_span.set(payload_bytes=size, characters=len(text_content or ''))
+
+                # Generate embeddings and store them in Pinecone a batch of chunks at a time
+                if text_content and client:
+                    try:
+                        update_status('processing', 'Analyzing content...', 'analyzing', 50)
+
+                        # Initialize vector store for this specific index
+                        index_vector_store = pinecone_client.Index(index.name)
+
+                        # Chunk the text content
+                        with span('chunking') as chunking_span:
+                            chunks = chunk_text(text_content)
+                            chunking_span.set(chunks=len(chunks))
+                        total_chunks = len(chunks)
+                        logging.info(f"Split document into {total_chunks} chunks")
+
+                        for batch_start in range(0, total_chunks, EMBED_BATCH_SIZE):
+                            check_cancelled(upload_id)
+                            batch = chunks[batch_start:batch_start + EMBED_BATCH_SIZE]
+                            update_status(
+                                'processing',
+                                f'Vectorizing sections {batch_start + 1}-{batch_start + len(batch)} '
+                                f'of {total_chunks}...',
+                                'vectorizing', batch_start / total_chunks * 100)
+
+                            # Generate embeddings using OpenAI
+                            with span('embedding') as embedding_span:
+                                embedding_response = limited_call(
+                                    client.embeddings.create,
+                                    model="text-embedding-ada-002", input=batch,
+                                    priority=LANE_PRIORITIES[lane],
+                                    tokens=estimate_tokens(*batch))
+                                embedding_span.record_usage(embedding_response)
+                                embedding_span.set(payload_bytes=sum(len(chunk.encode('utf-8')) for chunk in batch))
+
+                            vectors_to_upsert = []
+                            for item in sorted(embedding_response.data, key=lambda item: item.index):
+                                chunk_idx = batch_start + item.index
+                                vectors_to_upsert.append({
+                                    'id': f"{base_vector_id}_chunk_{chunk_idx}",
+                                    'values': item.embedding,
+                                    'metadata': {
+                                        **chunk_file_metadata,
+                                        'chunk_index': chunk_idx,
+                                        'total_chunks': total_chunks,
+                                        'text_content': chunks[chunk_idx],
+                                        'text_truncated': False,
+                                        'is_chunk': True,
+                                        'parent_file': base_vector_id
+                                    }
+                                })
+
+                            if vectors_to_upsert:
+                                try:
+                                    with span('upsert') as upsert_span:
+                                        index_vector_store.upsert(vectors=vectors_to_upsert)
+                                        upsert_span.set(vectors=len(vectors_to_upsert))
+                                except Exception as e:
+                                    logging.error(f"Pinecone upsert error: {e}")
+                                    raise
+                                written_vector_ids.extend(vector['id'] for vector in vectors_to_upsert)
+
+                            # Show the reconciler the upload is still making progress
+                            blob.updated_at = datetime.utcnow()
+                            db.session.commit()
+
+                        if written_vector_ids:
+                            vector_id = base_vector_id
+                            blob.chunk_count = total_chunks
+                            logging.info(f"Successfully vectorized file: {filename} with {len(written_vector_ids)} chunks")
+                            update_status('processing', 'Finalizing...', 'vectorizing', 100)
+
+                    except JobCancelled:
+                        raise
+                    except Exception as e:
+                        logging.error(f"Error vectorizing file: {e}")
+                        discard_upload(new_file, content_hash, thumbnail_path)
+                        update_status('error', client_error(e), 'error', 0)
+                        set_job_state(upload_id, 'error', message=client_error(e))
+                        return {'error': f'Error vectorizing file: {client_error(e)}'}, 500
+
+            # Last chance to stop before the upload becomes searchable
+            check_cancelled(upload_id)
+
+            # Finish the database entry
+            new_file.vector_id = vector_id
+            new_file.processed = bool(vector_id)
+            with span('db_commit'):
+                db.session.commit()
+            if vector_id:
+                answer_cache.invalidate(index.id)
+
+            if ai_title is None:
+                file_id = new_file.id
+                request_title(filename, lambda title: apply_title(file_id, title))
 
             update_status('complete', 'Complete!', 'complete', 100)
-            return jsonify({
+            set_job_state(upload_id, 'complete', file_id=new_file.id)
+            return {
                 'status': 'processing',
+                'upload_id': upload_id,
                 'message': 'Processing complete'
-            }), 200
+            }, 200
 
-        return jsonify({'error': 'Invalid file type'}), 400
+        except JobCancelled:
+            db.session.rollback()
+            try:
+                if index is not None:
+                    remove_written_vectors(index.name, index.id, base_vector_id, written_vector_ids)
+                discard_upload(new_file, content_hash, thumbnail_path)
+            except Exception as e:
+                logging.error(f"Error cleaning up cancelled upload {upload_id}: {e}")
+            add_api_log(f"Upload of {filename} cancelled", level="info",
+                        additional_data={"upload_id": upload_id, "vectors_removed": len(written_vector_ids)})
+            update_status('cancelled', 'Upload cancelled', 'cancelled', 0)
+            set_job_state(upload_id, 'cancelled')
+            return {'status': 'cancelled', 'upload_id': upload_id, 'message': 'Upload cancelled'}, 200
 
-    except Exception as e:
-        logging.error(f"Upload error: {e}")
-        db.session.rollback()
-        update_status('error', str(e), 'error', 0)
-        return jsonify({'error': str(e)}), 500
+        except Exception as e:
+            logging.error(f"Upload error: {e}")
+            db.session.rollback()
+            try:
+                discard_upload(new_file, content_hash, thumbnail_path)
+            except Exception as cleanup_error:
+                logging.error(f"Error releasing blob of failed upload {upload_id}: {cleanup_error}")
+                db.session.rollback()
+            update_status('error', client_error(e), 'error', 0)
+            set_job_state(upload_id, 'error', message=client_error(e))
+            return {'error': client_error(e)}, 500
+
+@app.route('/upload/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """State of one upload job"""
+    state = job_state(upload_id)
+    if state is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify({'upload_id': upload_id, **state})
+
+@app.route('/upload/<upload_id>/cancel', methods=['POST'])
+def cancel_upload(upload_id):
+    """Stop an upload between processing steps and remove what it wrote"""
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return jsonify({'error': 'Invalid upload id'}), 400
+    state = job_state(upload_id)
+    if state and state['state'] in TERMINAL_STATES:
+        return jsonify({'error': f"Upload already {state['state']}", 'upload_id': upload_id,
+                        'state': state['state']}), 409
+    cancel_job(upload_id)
+    add_api_log(f"Cancellation requested for upload {upload_id}", level="info")
+    return jsonify({'status': 'cancelling', 'upload_id': upload_id}), 202
 
 @app.route('/upload/status')
 def get_upload_status():
-    with status_lock:
-        if time.time() - upload_status['timestamp'] > 300:
-            upload_status['status'] = 'idle'
-            upload_status['progress'] = 0
-            upload_status['message'] = ''
-            upload_status['current_operation'] = ''
-            upload_status['operation_progress'] = 0
-        return jsonify(upload_status)
+    upload_status = dict(shared_state.get('upload_status', IDLE_STATUS))
+    if time.time() - upload_status['timestamp'] > 300:
+        upload_status['status'] = 'idle'
+        upload_status['progress'] = 0
+        upload_status['message'] = ''
+        upload_status['current_operation'] = ''
+        upload_status['operation_progress'] = 0
+    return jsonify(upload_status)
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600  # Seconds content-hash URLs may be cached
+
+def file_url(file):
+    """Cacheable URL of a file's bytes, versioned by content hash when known"""
+    if file.content_hash:
+        return url_for('serve_blob', content_hash=file.content_hash, filename=file.filename)
+    return url_for('serve_file', file_id=file.id)
+
+def preview_url(file):
+    """Cacheable URL of a file's preview image"""
+    if file.content_hash:
+        return url_for('serve_preview', content_hash=file.content_hash)
+    return url_for('static', filename=file.thumbnail_path)
+
+def accel_redirect_uri(path):
+    """Map a local path to the nginx internal location aliasing the app directory"""
+    relative = os.path.relpath(os.path.abspath(path))
+    if relative.startswith(os.pardir):
+        return None
+    return app.config["ACCEL_REDIRECT_PREFIX"].rstrip('/') + '/' + relative.replace(os.sep, '/')
+
+def send_immutable(path, mimetype, etag, download_name=None):
+    """Send bytes addressed by content hash with an immutable cache policy.
+
+    The bytes behind a content-hash URL never change, so the response carries a
+    strong ETag and may be cached for a year. Range requests are answered here,
+    or by the front proxy when FILE_SERVING_MODE offloads the transfer.
+    """
+    mode = app.config["FILE_SERVING_MODE"]
+    accel_uri = accel_redirect_uri(path) if mode == "x-accel-redirect" else None
+    offload = mode == "x-sendfile" or accel_uri is not None
+    response = werkzeug_send_file(os.path.abspath(path),
+                                  request.environ,
+                                  mimetype=mimetype,
+                                  as_attachment=False,
+                                  download_name=download_name,
+                                  conditional=not offload,
+                                  etag=etag,
+                                  max_age=IMMUTABLE_MAX_AGE,
+                                  use_x_sendfile=offload,
+                                  response_class=app.response_class)
+    if offload:
+        # The proxy handles ranges; only revalidation is answered here
+        if accel_uri:
+            del response.headers['X-Sendfile']
+            response.headers['X-Accel-Redirect'] = accel_uri
+            response.content_length = 0
+        response = response.make_conditional(request.environ)
+    else:
+        # Lets PDF viewers fetch large documents page by page
+        response.accept_ranges = 'bytes'
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/blob/<content_hash>/<path:filename>')
+def serve_blob(content_hash, filename):
+    blob = db.first_or_404(db.select(models.FileBlob).filter_by(content_hash=content_hash))
+    if not os.path.exists(blob.filepath):
+        abort(404)
+    return send_immutable(blob.filepath, blob.mime_type, content_hash, download_name=filename)
+
+@app.route('/preview/<content_hash>')
+def serve_preview(content_hash):
+    blob = db.first_or_404(db.select(models.FileBlob).filter_by(content_hash=content_hash))
+    if not blob.thumbnail_path:
+        abort(404)
+    path = os.path.join('static', blob.thumbnail_path)
+    if not os.path.exists(path):
+        abort(404)
+    return send_immutable(path, 'image/jpeg', f"{content_hash}-preview")
 
 @app.route('/file/<int:file_id>')
 def serve_file(file_id):
     file = db.get_or_404(models.File, file_id)
+    if file.content_hash:
+        # Ids can be reused after a delete, so the redirect itself is not cached
+        response = redirect(file_url(file))
+        response.cache_control.no_store = True
+        return response
     return send_file(file.filepath,
                     mimetype=file.mime_type,
                     as_attachment=False,
-                    download_name=file.filename)
+                    download_name=file.filename,
+                    conditional=True)
 
 @app.route('/delete/<int:file_id>', methods=['POST'])
 def delete_file(file_id):
     file = db.get_or_404(models.File, file_id)
     try:
-        # Delete vector from Pinecone if it exists
-        if file.vector_id and vector_store:
-            try:
-                vector_ids = [f"{file.vector_id}_chunk_{i}" for i in range(100)]
-                vector_store.delete(ids=vector_ids, namespace="")
-                logging.info(f"Successfully deleted vectors for file: {file.filename}")
-            except Exception as e:
-                logging.error(f"Error deleting vectors: {e}")
-
-        # Delete the actual file
-        if os.path.exists(file.filepath):
-            os.remove(file.filepath)
-            logging.info(f"Deleted file: {file.filepath}")
-
-        # Delete thumbnail if exists
-        if file.thumbnail_path:
-            thumbnail_path = os.path.join('static', file.thumbnail_path)
-            if os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
-                logging.info(f"Deleted thumbnail: {thumbnail_path}")
+        blob = None
+        if file.content_hash:
+            blob = db.session.query(models.FileBlob).filter_by(content_hash=file.content_hash).first()
+
+        # Delete vectors from Pinecone unless another file in the same index shares them
+        if file.vector_id and pinecone_client:
+            shares_vectors = db.session.query(models.File).filter(
+                models.File.id != file.id,
+                models.File.index_id == file.index_id,
+                models.File.vector_id == file.vector_id).first()
+            if not shares_vectors:
+                try:
+                    chunk_count = blob.chunk_count if blob and blob.chunk_count else 100
+                    vector_ids = chunk_vector_ids(file.vector_id, chunk_count)
+                    pinecone_client.Index(file.index.name).delete(ids=vector_ids, namespace="")
+                    logging.info(f"Successfully deleted vectors for file: {file.filename}")
+                except Exception as e:
+                    logging.error(f"Error deleting vectors: {e}")
 
-        db.session.delete(file)
+        # Only removes the stored bytes once the last reference is gone
+        index_id = file.index_id
+        delete_file_row(file)
         db.session.commit()
+        answer_cache.invalidate(index_id)
         flash('File and associated data deleted successfully')
     except Exception as e:
         logging.error(f"Error deleting file: {e}")
@@ -517,7 +928,7 @@ def get_logs():
     verbose = request.args.get('verbose', 'false').lower() == 'true'
     index = request.args.get('index')
     
-    filtered_logs = api_logs.copy()
+    filtered_logs = shared_state.get_log('api_logs', max_logs)
     if not verbose:
         filtered_logs = [log for log in filtered_logs if log.get('verbose') is False]
     if index:
@@ -525,7 +936,37 @@ def get_logs():
         
     return jsonify(filtered_logs)
 
+def perform_query_step(step, index_name):
+    """Carry out one I/O request of the query pipeline with blocking calls"""
+    if isinstance(step, Embed):
+        return limited_call(client.embeddings.create, priority=INTERACTIVE, **step.call_options())
+    if isinstance(step, Complete):
+        return limited_call(client.chat.completions.create, priority=INTERACTIVE, **step.call_options())
+    if isinstance(step, Search):
+        return pinecone_client.Index(index_name).query(
+            vector=step.vector, top_k=step.top_k, include_metadata=True,
+            include_values=step.include_values, filter=step.filter).matches
+    if isinstance(step, Blocking):
+        return step.fn(*step.args)
+    if isinstance(step, Log):
+        return add_api_log(step.message, level=step.level, additional_data=step.data)
+    raise TypeError(f"Unknown query step {step!r}")
+
+def run_query_steps(steps, index_name):
+    """Drive query pipeline steps to their result; failures are raised inside the step"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error else steps.send(result)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = perform_query_step(step, index_name), None
+        except Exception as e:
+            result, error = None, e
+
 @app.route('/api/<index_name>', methods=['GET', 'POST'])
+@traced('query')
 def get_index_info(index_name):
     """Get information about a specific index and its files, or perform a query."""
     try:
@@ -537,6 +978,7 @@ def get_index_info(index_name):
             }), 404
             
         if request.method == 'GET':
+            set_trace_labels(pipeline='index_info', index=index_name)
             # Get files associated with this index
             files = db.session.query(models.File).filter_by(index_id=index.id).all()
             
@@ -554,6 +996,7 @@ def get_index_info(index_name):
                     'status': index.status,
                     'endpoint': index.endpoint,
                     'stats': index_stats.dict(),
+                    'answer_cache': answer_cache.stats(index.id),
                 },
                 'files': [{
                     'id': file.id,
@@ -569,118 +1012,182 @@ def get_index_info(index_name):
             # Validate request
             if not request.is_json:
                 return jsonify({'error': 'Request must be JSON'}), 400
-                
-            data = request.get_json()
-            if 'query' not in data:
-                return jsonify({'error': 'Query is required'}), 400
-                
-            query_text = data['query']
-            top_k = data.get('top_k', 5)  # Default to 5 results
-            additional_context = data.get('additional_context', '')
-            
-            # Initialize vector store for this index
-            vector_store = pinecone_client.Index(index_name)
-            
             try:
-                # Extract search-relevant information using GPT
-                extraction_response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[{
-                        "role": "system",
-                        "content": "IF the query could be a request to search, extract key information from the query that would be relevant for searching a knowledge base. Return only the essential search terms and concepts. Otherwise, return an empty string."
-                    }, {
-                        "role": "user",
-                        "content": query_text
-                    }])
-
-                search_terms = extraction_response.choices[0].message.content.strip()
-                if not search_terms or search_terms == '""':
-                    add_api_log("No search terms found - no Pinecone search necessary", level="info", additional_data={"index": index_name})
-                    return jsonify({
-                        "answer": "",
-                        "contexts": []
-                    })
-                    
-                add_api_log(f"Search terms identified: {search_terms}", level="info", additional_data={"index": index_name})
-
-                # Generate embedding for the extracted search terms
-                embedding_response = client.embeddings.create(
-                    input=search_terms,
-                    model="text-embedding-ada-002"
-                )
-                
-                if not embedding_response or not embedding_response.data:
-                    add_api_log("Failed to generate query embedding", level="error")
-                    return jsonify({
-                        "answer": "",
-                        "contexts": []
-                    })
-                    
-                # Query the index
-                query_response = vector_store.query(
-                    vector=embedding_response.data[0].embedding,
-                    top_k=top_k,
-                    include_metadata=True
-                )
-                
-                # Process and format results
-                contexts = []
-                retrieved_context = ""
-                
-                # Log found content
-                for match in query_response.matches:
-                    filename = match.metadata.get("filename", "Unknown file")
-                    display_title = match.metadata.get("display_title", filename)
-                    add_api_log(f"Found relevant content in {display_title}", level="info", additional_data={"index": index_name})
-                    
-                    # Add to contexts list
-                    contexts.append({
-                        "id": match.id,
-                        "score": match.score,
-                        "text": match.metadata.get("text_content", "No content available")
-                    })
-                    
-                    # Add to retrieved context string
-                    retrieved_context += match.metadata.get("text_content", "") + " "
-
-                # Add additional context if provided
-                if additional_context:
-                    retrieved_context += f"\n{additional_context}"
-
-                # Get response from GPT-4
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[{
-                        "role": "system",
-                        "content": "You are a helpful assistant. Find anything relevant to the query."
-                    }, {
-                        "role": "user",
-                        "content": query_text
-                    }, {
-                        "role": "system",
-                        "content": f"Relevant context: {retrieved_context}"
-                    }])
-                
-                generated_response = response.choices[0].message.content
-                add_api_log(f"Generated response: {generated_response}", level="info", additional_data={"index": index_name})
+                query = parse_query(request.get_json(), app.config)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
 
-                return jsonify({
-                    "answer": generated_response,
-                    "contexts": contexts
-                })
-                
+            set_trace_labels(index=index_name)
+            try:
+                return jsonify(run_query_steps(query_steps(query, index.id, index_name), index_name))
             except Exception as e:
                 logging.error(f"Error during query processing: {str(e)}")
-                return jsonify({
-                    "answer": "",
-                    "contexts": []
-                })
-            
+                return jsonify(empty_result())
+
     except Exception as e:
         logging.error(f"Error accessing index: {str(e)}")
         return jsonify({
             'error': f'Error accessing index: {str(e)}'
         }), 500
 
+def embed_texts(texts):
+    """Embed many texts with one embeddings call; returns the response and the vectors in order"""
+    response = perform_query_step(Embed(texts), None)
+    return response, [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+@app.route('/api/<index_name>/batch', methods=['POST'])
+@traced('batch_query')
+def batch_query(index_name):
+    """Answer many queries at once.
+
+    Each stage makes one call for the whole batch where the API allows it:
+    one embeddings call for the raw queries (answer cache and queries with
+    extract_terms false), one completion extracting search terms for the
+    rest and one embeddings call for those terms. Vector lookups and answer
+    completions then run concurrently. Results keep the input order; a query
+    that fails gets an "error" entry instead of failing the batch.
+    """
+    index = db.session.query(models.PineconeIndex).filter_by(name=index_name).first()
+    if not index:
+        return jsonify({'error': f'Index "{index_name}" not found'}), 404
+    if not request.is_json:
+        return jsonify({'error': 'Request must be JSON'}), 400
+    try:
+        answer, items = parse_batch(request.get_json(), app.config)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    set_trace_labels(index=index_name)
+
+    started = time.perf_counter()
+    results = [{'error': item.error} if item.error else None for item in items]
+    embedding_calls = 0
+    cache_hits = 0
+
+    def pending():
+        return [item for item in items if results[item.position] is None]
+
+    def fail(batch_items, message):
+        for item in batch_items:
+            results[item.position] = {'error': message}
+
+    # Queries with the same filters resolve them once
+    resolved = {}
+    filtered = [item for item in pending() if item.request.filters]
+    if filtered:
+        with span('filter_resolution') as filter_span:
+            for item in filtered:
+                key = json.dumps(item.request.filters, sort_keys=True, default=str)
+                if key not in resolved:
+                    resolved[key] = resolve_index_filters(index.id, item.request.filters)
+                item.vector_filter, item.filter_stats = resolved[key]
+                if item.vector_filter is None:
+                    results[item.position] = empty_result(item.filter_stats)
+            filter_span.set(filters=len(resolved))
+
+    # Raw queries are embedded for the answer cache and for queries searched as written
+    generation = answer_cache.generation(index.id)
+
+    raw = [item for item in pending() if item.request.use_cache or not item.request.extract_terms]
+    if raw:
+        try:
+            with span('cache_lookup') as cache_span:
+                response, vectors = embed_texts([item.query for item in raw])
+                cache_span.record_usage(response)
+                embedding_calls += 1
+                for item, vector in zip(raw, vectors):
+                    item.query_embedding = vector
+                    if not item.request.extract_terms:
+                        item.search_terms, item.search_vector = item.query, vector
+                    if not item.request.use_cache:
+                        continue
+                    cached, similarity = answer_cache.lookup(
+                        index.id, index_name, vector, item.request.variant, generation)
+                    item.cache_info = {'hit': cached is not None, 'similarity': round(similarity, 4)}
+                    if cached is not None:
+                        cache_hits += 1
+                        results[item.position] = {**cached['payload'], 'cache': item.cache_info}
+                cache_span.set(hits=cache_hits)
+        except Exception as e:
+            logging.error(f"Error embedding batch queries: {e}")
+            fail(raw, f"Error embedding query: {client_error(e)}")
+
+    # One completion extracts the search terms of every remaining query
+    extract = [item for item in pending() if item.search_vector is None]
+    if extract:
+        try:
+            with span('term_extraction') as extraction_span:
+                extraction_response = perform_query_step(Complete(
+                    "gpt-4o-mini", batch_search_terms_messages([item.query for item in extract]),
+                    estimate_tokens(*(item.query for item in extract), completion=50 * len(extract)),
+                    {'response_format': {"type": "json_object"}}), index_name)
+                extraction_span.record_usage(extraction_response)
+            terms = parse_batch_search_terms(extraction_response.choices[0].message.content, len(extract))
+            for item, search_terms in zip(extract, terms):
+                if search_terms:
+                    item.search_terms = search_terms
+                else:
+                    results[item.position] = empty_result()
+        except Exception as e:
+            logging.error(f"Error extracting batch search terms: {e}")
+            fail(extract, f"Error extracting search terms: {client_error(e)}")
+
+    to_embed = [item for item in pending() if item.search_vector is None]
+    if to_embed:
+        try:
+            with span('embedding') as embedding_span:
+                response, vectors = embed_texts([item.search_terms for item in to_embed])
+                embedding_span.record_usage(response)
+                embedding_calls += 1
+            for item, vector in zip(to_embed, vectors):
+                item.search_vector = vector
+        except Exception as e:
+            logging.error(f"Error embedding batch search terms: {e}")
+            fail(to_embed, f"Error embedding search terms: {client_error(e)}")
+
+    index_id = index.id
+    searched = pending()
+    # Each query is charged its share of the batched calls plus its own lookup and answer
+    shared_seconds = (time.perf_counter() - started) / max(len(searched), 1)
+
+    def run_query(item):
+        item_started = time.perf_counter()
+        with app.app_context():
+            result = run_query_steps(search_steps(item.request, index_name, item.search_vector,
+                                                  item.vector_filter, item.filter_stats, answer),
+                                     index_name)
+            if answer and item.request.use_cache:
+                answer_cache.store(index_id, item.query_embedding, item.request.variant, result,
+                                   shared_seconds + time.perf_counter() - item_started, generation)
+        return result
+
+    if searched:
+        with span('completion' if answer else 'vector_query') as query_span:
+            with ThreadPoolExecutor(min(BATCH_CONCURRENCY, len(searched))) as executor:
+                # Spans recorded by the workers join this request's trace
+                futures = [(item, executor.submit(contextvars.copy_context().run, run_query, item))
+                           for item in searched]
+                for item, future in futures:
+                    try:
+                        results[item.position] = {**future.result(), 'cache': item.cache_info}
+                    except Exception as e:
+                        logging.error(f"Error answering batch query {item.position}: {e}")
+                        results[item.position] = {'error': f"Error during query processing: {client_error(e)}"}
+            query_span.set(queries=len(searched))
+
+    errors = sum(1 for result in results if 'error' in result)
+    add_api_log(f"Answered {len(items)} batch queries ({cache_hits} from cache, {errors} failed)",
+                level="error" if errors == len(items) else "info",
+                additional_data={"index": index_name})
+    return jsonify({
+        'results': results,
+        'stats': {
+            'queries': len(items),
+            'errors': errors,
+            'cache_hits': cache_hits,
+            'embedding_calls': embedding_calls,
+            'seconds': round(time.perf_counter() - started, 3),
+        }
+    })
+
 if __name__ == '__main__':
     socketio.run(app, debug=True)
@@ -0,0 +1,217 @@
+"""ASGI entry point with an async query endpoint.
+
+POST /api/<index_name> is served natively on the event loop: it runs the
+same query_pipeline steps as the Flask route, but the term extraction,
+embedding and completion use the async OpenAI client, the vector lookup
+calls the Pinecone data plane over async HTTP and database, cache and log
+writes run in worker threads, so a query in flight holds no worker thread
+while it waits. Every other route, including the UI, is delegated to the
+Flask app.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as flask_app, db, models, pinecone_client, add_api_log
+from metrics import start_trace, finish_trace
+from ratelimit import async_openai_client, limited_call_async, INTERACTIVE
+from query_pipeline import (parse_query, query_steps, empty_result, Embed, Complete, Search, Blocking,
+                            Log)
+
+PINECONE_API_VERSION = '2024-07'
+INDEX_HOST_TTL = 300  # Seconds an index host lookup is cached
+MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', 1000))
+
+QUERY_ROUTE = re.compile(r'^/api/(?P<index_name>[^/]+)$')
+
+client = async_openai_client(MAX_CONNECTIONS)
+pinecone_http = httpx.AsyncClient(
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=100),
+    headers={'Api-Key': os.environ.get('PINECONE_API_KEY', ''),
+             'X-Pinecone-API-Version': PINECONE_API_VERSION})
+
+_index_hosts = {}
+
+
+@dataclass
+class Match:
+    """A Pinecone query match with the attributes retrieval.py expects"""
+    id: str
+    score: float = 0.0
+    values: list = None
+    metadata: dict = field(default_factory=dict)
+
+
+def _normalize_host(host):
+    return host if host.startswith(('http://', 'https://')) else f"https://{host}"
+
+
+def _lookup_index(index_name):
+    with flask_app.app_context():
+        index = db.session.query(models.PineconeIndex).filter_by(name=index_name).first()
+        if not index:
+            return None, None
+        return index.id, index.endpoint or pinecone_client.describe_index(index_name).host
+
+
+async def lookup_index(index_name):
+    """Database id and data plane URL of an index, or (None, None) if it isn't registered"""
+    cached = _index_hosts.get(index_name)
+    if cached and cached[2] > time.monotonic():
+        return cached[0], cached[1]
+    index_id, host = await asyncio.to_thread(_lookup_index, index_name)
+    if host:
+        host = _normalize_host(host)
+        _index_hosts[index_name] = (index_id, host, time.monotonic() + INDEX_HOST_TTL)
+    return index_id, host
+
+
+def _in_app_context(fn, *args, **kwargs):
+    with flask_app.app_context():
+        return fn(*args, **kwargs)
+
+
+async def query_vectors(host, vector, top_k, include_values=False, vector_filter=None):
+    body = {
+        'vector': vector,
+        'topK': top_k,
+        'includeMetadata': True,
+        'includeValues': include_values,
+        'namespace': '',
+    }
+    if vector_filter is not None:
+        body['filter'] = vector_filter
+    response = await pinecone_http.post(f"{host}/query", json=body)
+    response.raise_for_status()
+    return [Match(id=m['id'], score=m.get('score', 0.0), values=m.get('values') or None,
+                  metadata=m.get('metadata') or {})
+            for m in response.json().get('matches', [])]
+
+
+async def perform_query_step(step, host):
+    """Carry out one I/O request of the query pipeline without blocking the event loop"""
+    if isinstance(step, Embed):
+        return await limited_call_async(client.embeddings.create, priority=INTERACTIVE,
+                                        **step.call_options())
+    if isinstance(step, Complete):
+        return await limited_call_async(client.chat.completions.create, priority=INTERACTIVE,
+                                        **step.call_options())
+    if isinstance(step, Search):
+        return await query_vectors(host, step.vector, step.top_k, include_values=step.include_values,
+                                   vector_filter=step.filter)
+    if isinstance(step, Blocking):
+        return await asyncio.to_thread(_in_app_context, step.fn, *step.args)
+    if isinstance(step, Log):
+        # Log writes go to the shared state backend and Socket.IO, both blocking
+        return await asyncio.to_thread(add_api_log, step.message, level=step.level,
+                                       additional_data=step.data)
+    raise TypeError(f"Unknown query step {step!r}")
+
+
+async def run_query_steps(steps, host):
+    """The async twin of app.run_query_steps"""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error else steps.send(result)
+        except StopIteration as done:
+            return done.value
+        try:
+            result, error = await perform_query_step(step, host), None
+        except Exception as e:
+            result, error = None, e
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode()),
+                    *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def handle_query(scope, receive, send, index_name):
+    body = await read_body(receive)
+    request_headers = dict(scope.get('headers') or [])
+    if not request_headers.get(b'content-type', b'').startswith(b'application/json'):
+        return await send_json(send, {'error': 'Request must be JSON'}, 400)
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        return await send_json(send, {'error': 'Request must be JSON'}, 400)
+    try:
+        query = parse_query(data, flask_app.config)
+    except ValueError as e:
+        return await send_json(send, {'error': str(e)}, 400)
+
+    start_trace(pipeline='query', index=index_name)
+    status = 200
+    try:
+        index_id, host = await lookup_index(index_name)
+        if not host:
+            status = 404
+            payload = {'error': f'Index "{index_name}" not found'}
+        else:
+            try:
+                payload = await run_query_steps(query_steps(query, index_id, index_name), host)
+            except Exception as e:
+                logging.error(f"Error during query processing: {str(e)}")
+                payload = empty_result()
+    finally:
+        timings = finish_trace()
+
+    if isinstance(data, dict) and data.get('include_timings') and status == 200:
+        payload['timings'] = timings
+    server_timing = ', '.join(f"{t['stage']};dur={t['ms']}" for t in timings)
+    await send_json(send, payload, status, [(b'server-timing', server_timing.encode())])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await pinecone_http.aclose()
+            await client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+wsgi_app = WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] == 'POST':
+        route = QUERY_ROUTE.match(scope['path'])
+        if route:
+            return await handle_query(scope, receive, send, route.group('index_name'))
+    if scope['type'] == 'websocket':
+        # Socket.IO falls back to long-polling, which the Flask app serves
+        return await send({'type': 'websocket.close', 'code': 1000})
+    return await wsgi_app(scope, receive, send)
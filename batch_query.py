@@ -0,0 +1,71 @@
+"""Request parsing for POST /api/<index_name>/batch.
+
+The body holds a list of queries and options shared by all of them:
+
+    {"queries": ["What is due?", {"query": "Who grades it?", "top_k": 3}],
+     "top_k": 5, "filters": {"mime_types": ["application/pdf"]}, "answer": false}
+
+Each query is a string or an object with the fields of a single query, which
+override the shared ones. Problems with one query are reported on that query
+only; the rest of the batch still runs.
+"""
+import os
+from dataclasses import dataclass
+
+from query_pipeline import QueryRequest, parse_query
+
+MAX_BATCH_QUERIES = int(os.environ.get('MAX_BATCH_QUERIES', 256))
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 16))  # Lookups and completions in flight
+
+# Fields the batch can set for every query and each query can override
+QUERY_FIELDS = ('top_k', 'additional_context', 'context_token_budget', 'mmr', 'filters', 'cache',
+                'extract_terms')
+
+
+@dataclass
+class BatchItem:
+    """One query of a batch and the state it picks up along the way"""
+    position: int
+    request: QueryRequest = None
+    error: str = None
+    vector_filter: dict = None
+    filter_stats: dict = None
+    query_embedding: list = None
+    cache_info: dict = None
+    search_terms: str = None
+    search_vector: list = None
+
+    @property
+    def query(self):
+        return self.request.query
+
+
+def _parse_item(position, raw, defaults, config):
+    if isinstance(raw, str):
+        raw = {'query': raw}
+    if not isinstance(raw, dict):
+        return BatchItem(position, error='Each query must be a string or an object')
+    try:
+        return BatchItem(position, parse_query({**defaults, **raw}, config))
+    except ValueError as e:
+        return BatchItem(position, error=str(e))
+
+
+def parse_batch(data, config):
+    """Validate a batch request and return (answer, items).
+
+    Each query is validated like a single query, with `config` supplying the
+    defaults. Raises ValueError when the batch as a whole is invalid;
+    per-query problems are recorded in the item's `error` instead.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('queries'), list) or not data['queries']:
+        raise ValueError("'queries' must be a non-empty list")
+    if len(data['queries']) > MAX_BATCH_QUERIES:
+        raise ValueError(f"A batch may hold at most {MAX_BATCH_QUERIES} queries")
+    answer = data.get('answer', True)
+    if not isinstance(answer, bool):
+        raise ValueError("'answer' must be true or false")
+
+    defaults = {name: data[name] for name in QUERY_FIELDS if name in data}
+    return answer, [_parse_item(position, raw, defaults, config)
+                    for position, raw in enumerate(data['queries'])]
@@ -0,0 +1,140 @@
+"""Load test comparing the Flask and ASGI query endpoints.
+
+Both servers run in this process against the stub OpenAI and Pinecone APIs.
+The Flask app is served by a WSGI server with a fixed thread pool, like a
+gunicorn gthread worker, and the ASGI app by uvicorn. The same burst of
+concurrent queries is sent to each and throughput and latency are reported.
+
+    python benchmarks/load_test.py --concurrency 500 --requests 2000 --latency-ms 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.run import Context, BENCHMARK_INDEX  # noqa: E402
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class PooledWSGIServer(WSGIServer):
+    """WSGI server handling requests on a bounded thread pool"""
+
+    request_queue_size = 4096
+
+    def __init__(self, address, threads):
+        super().__init__(address, QuietHandler)
+        self.pool = ThreadPoolExecutor(threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def start_flask(flask_app, threads):
+    server = PooledWSGIServer(('127.0.0.1', 0), threads)
+    server.set_app(flask_app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def start_uvicorn():
+    import uvicorn
+    import asgi
+    config = uvicorn.Config(asgi.app, host='127.0.0.1', port=0, log_level='warning',
+                            backlog=4096, lifespan='off')
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def run_load(url, concurrency, total):
+    import httpx
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as http:
+        async def one(i):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    response = await http.post(f"{url}/api/{BENCHMARK_INDEX}",
+                                               json={'query': f'What are the paper instructions? {i}'})
+                    if response.status_code != 200 or not response.json().get('answer'):
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 2),
+        'throughput_rps': round(total / elapsed, 1),
+        'median_ms': round(statistics.median(latencies), 1),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1], 1),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1], 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=200.0,
+                        help='simulated latency of every stub API call')
+    parser.add_argument('--flask-threads', type=int, default=8,
+                        help='worker threads for the WSGI server')
+    args = parser.parse_args(argv)
+
+    # The stub APIs have no real limits; keep the shared limiter out of the comparison
+    os.environ.setdefault('OPENAI_RPM', '1000000')
+    os.environ.setdefault('OPENAI_TPM', '1000000000')
+    os.environ.setdefault('OPENAI_MAX_CONCURRENCY', '10000')
+
+    with Context(args.latency_ms / 1000) as ctx:
+        ctx.app
+        ctx.upload()
+        flask_server, flask_url = start_flask(ctx.app.app, args.flask_threads)
+        uvicorn_server, asgi_url = start_uvicorn()
+        try:
+            for name, url in (('flask', flask_url), ('asgi', asgi_url)):
+                result = asyncio.run(run_load(url, args.concurrency, args.requests))
+                print(f"{name:<6} {result['throughput_rps']:>8} req/s  "
+                      f"median {result['median_ms']:>8}ms  p95 {result['p95_ms']:>8}ms  "
+                      f"p99 {result['p99_ms']:>8}ms  errors {result['errors']}")
+        finally:
+            flask_server.shutdown()
+            uvicorn_server.should_exit = True
+
+
+if __name__ == '__main__':
+    main()
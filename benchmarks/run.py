@@ -0,0 +1,310 @@
+"""Offline benchmark suite for the upload and query pipelines.
+
+Runs every benchmark against in-process OpenAI and Pinecone stand-ins, so no
+API keys or network access are needed. Results are appended to a JSON lines
+history file and compared with recent runs that used the same configuration;
+the process exits non-zero when a benchmark's median regresses beyond the
+threshold.
+
+    python benchmarks/run.py                      # full suite
+    python benchmarks/run.py --latency-ms 50      # slower simulated network
+    python benchmarks/run.py --only chunk_text --only query
+"""
+import argparse
+import glob
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.stubs import OpenAIStub, PineconeStub  # noqa: E402
+
+# Kept outside the checkout so runs never dirty the working tree
+DEFAULT_HISTORY = os.environ.get('BENCHMARK_HISTORY') or os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pinecone-file-manager',
+    'benchmark-history.jsonl')
+DEFAULT_THRESHOLD = 0.25  # Allowed slowdown of the median before failing
+DEFAULT_WINDOW = 5  # Previous runs averaged into the baseline
+BENCHMARK_INDEX = 'bench-index'
+
+
+@dataclass
+class Benchmark:
+    name: str
+    setup: callable
+    iterations: int
+
+
+BENCHMARKS = []
+
+
+def benchmark(name, iterations=10):
+    """Register a benchmark whose setup(ctx) returns the callable to time"""
+    def decorator(setup):
+        BENCHMARKS.append(Benchmark(name, setup, iterations))
+        return setup
+    return decorator
+
+
+class Context:
+    """Shared state for one suite run: stub servers, workspace and app"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.workspace = tempfile.mkdtemp(prefix='pfm-bench-')
+        self.pdfs = sorted(glob.glob(os.path.join(REPO_ROOT, 'uploads', '*.pdf')),
+                           key=os.path.getsize)
+        self.counter = itertools.count()
+        self._app = None
+        self._texts = None
+        self.openai = OpenAIStub(latency)
+        self.pinecone = PineconeStub(latency)
+
+    def __enter__(self):
+        self.openai.__enter__()
+        self.pinecone.__enter__()
+        os.environ.update({
+            'OPENAI_API_KEY': 'bench',
+            'OPENAI_BASE_URL': f"{self.openai.url}/v1",
+            'PINECONE_API_KEY': 'bench',
+            'PINECONE_CONTROLLER_HOST': self.pinecone.url,
+            'DATABASE_URL': f"sqlite:///{os.path.join(self.workspace, 'bench.db')}",
+            'UPLOAD_FOLDER': os.path.join(self.workspace, 'uploads'),
+        })
+        # Previews are written relative to the working directory
+        self.cwd = os.getcwd()
+        os.chdir(self.workspace)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.chdir(self.cwd)
+        self.pinecone.__exit__(*exc_info)
+        self.openai.__exit__(*exc_info)
+        shutil.rmtree(self.workspace, ignore_errors=True)
+
+    @property
+    def app(self):
+        """Import the Flask app lazily so pure benchmarks don't pay for it"""
+        if self._app is None:
+            import app as app_module
+            # Keep per-request logging from dominating the measurements
+            logging.getLogger().setLevel(logging.WARNING)
+            app_module.app.config['TESTING'] = True
+            with app_module.app.app_context():
+                index = app_module.db.session.query(
+                    app_module.models.PineconeIndex).filter_by(name=BENCHMARK_INDEX).first()
+                if not index:
+                    app_module.pinecone_client.create_index(
+                        name=BENCHMARK_INDEX, dimension=1536, metric='cosine',
+                        spec=app_module.ServerlessSpec(cloud='aws', region='us-west-2'))
+                    index = app_module.models.PineconeIndex(
+                        name=BENCHMARK_INDEX, status='ready',
+                        endpoint=app_module.pinecone_client.describe_index(BENCHMARK_INDEX).host)
+                    app_module.db.session.add(index)
+                    app_module.db.session.commit()
+                self.index_id = index.id
+            self.client = app_module.app.test_client()
+            self._app = app_module
+        return self._app
+
+    @property
+    def texts(self):
+        """Extracted text of every sample PDF"""
+        if self._texts is None:
+            from utils import extract_text_from_file
+            self._texts = [extract_text_from_file(path, 'application/pdf') for path in self.pdfs]
+        return self._texts
+
+    def unique_pdf(self):
+        """Bytes of the smallest sample PDF, made unique so dedup can't short-circuit"""
+        with open(self.pdfs[0], 'rb') as f:
+            data = f.read()
+        return data + f"\n% benchmark {next(self.counter)} {time.time()}\n".encode()
+
+    def upload(self):
+        response = self.client.post('/upload', data={
+            'file': (io.BytesIO(self.unique_pdf()), os.path.basename(self.pdfs[0])),
+            'index_id': str(self.index_id),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+
+@benchmark('chunk_text', iterations=20)
+def bench_chunk_text(ctx):
+    from utils import chunk_text
+    texts = ctx.texts
+    return lambda: [chunk_text(text) for text in texts]
+
+
+def _register_extraction_benchmarks():
+    for position in range(len(glob.glob(os.path.join(REPO_ROOT, 'uploads', '*.pdf')))):
+        def setup(ctx, position=position):
+            from utils import extract_text_from_file
+            path = ctx.pdfs[position]
+            return lambda: extract_text_from_file(path, 'application/pdf')
+        benchmark(f"extract_text[pdf{position}]", iterations=3)(setup)
+
+
+_register_extraction_benchmarks()
+
+
+@benchmark('thumbnail_image', iterations=10)
+def bench_thumbnail_image(ctx):
+    from PIL import Image
+    from utils import generate_thumbnail
+    path = os.path.join(ctx.workspace, 'sample.jpg')
+    Image.new('RGB', (2400, 1600), (120, 160, 200)).save(path, 'JPEG', quality=90)
+    return lambda: generate_thumbnail(path, 'sample.jpg')
+
+
+@benchmark('thumbnail_pdf', iterations=5)
+def bench_thumbnail_pdf(ctx):
+    if not shutil.which('pdftoppm'):
+        return None  # pdf2image needs poppler
+    from utils import generate_pdf_preview
+    path = ctx.pdfs[0]
+    return lambda: generate_pdf_preview(path, os.path.basename(path))
+
+
+@benchmark('upload_file', iterations=5)
+def bench_upload_file(ctx):
+    ctx.app
+    return ctx.upload
+
+
+def _query(ctx, cache):
+    ctx.app
+    ctx.upload()
+
+    def run(expect_hit=cache):
+        response = ctx.client.post(f"/api/{BENCHMARK_INDEX}",
+                                   json={'query': 'What are the paper instructions?', 'cache': cache})
+        assert response.status_code == 200, response.get_data(as_text=True)
+        assert bool((response.get_json()['cache'] or {}).get('hit')) == expect_hit
+    return run
+
+
+@benchmark('query', iterations=20)
+def bench_query(ctx):
+    return _query(ctx, cache=False)  # The full pipeline, bypassing the answer cache
+
+
+@benchmark('query_cached', iterations=20)
+def bench_query_cached(ctx):
+    from answer_cache import answer_cache
+    if not answer_cache.enabled:
+        return None
+    run = _query(ctx, cache=True)
+    run(expect_hit=False)  # Fill the cache
+    return run
+
+
+def measure(fn, iterations):
+    fn()  # Warm up caches and lazy imports
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'min_ms': round(timings[0], 3),
+        'median_ms': round(statistics.median(timings), 3),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        'mean_ms': round(statistics.fmean(timings), 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(results, history, config, threshold, window):
+    """Compare medians with the mean median of recent runs with the same config"""
+    previous = [run for run in history if run.get('config') == config][-window:]
+    regressions = []
+    for name, result in results.items():
+        baseline = [run['results'][name]['median_ms'] for run in previous
+                    if name in run.get('results', {})]
+        if not baseline:
+            continue
+        expected = statistics.fmean(baseline)
+        if result['median_ms'] > expected * (1 + threshold):
+            regressions.append((name, expected, result['median_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--latency-ms', type=float, default=10.0,
+                        help='simulated latency of every stub API call')
+    parser.add_argument('--iterations', type=int,
+                        help='override the per-benchmark iteration count')
+    parser.add_argument('--only', action='append', default=[],
+                        help='run only benchmarks whose name starts with this prefix')
+    parser.add_argument('--history', default=DEFAULT_HISTORY,
+                        help=f'JSON lines file of previous runs (default {DEFAULT_HISTORY})')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='fail when a median is this fraction slower than the baseline')
+    parser.add_argument('--window', type=int, default=DEFAULT_WINDOW)
+    parser.add_argument('--no-record', action='store_true',
+                        help='compare against history without appending this run')
+    args = parser.parse_args(argv)
+
+    selected = [b for b in BENCHMARKS
+                if not args.only or any(b.name.startswith(prefix) for prefix in args.only)]
+    config = {'latency_ms': args.latency_ms, 'iterations': args.iterations}
+
+    results = {}
+    with Context(args.latency_ms / 1000) as ctx:
+        for bench in selected:
+            fn = bench.setup(ctx)
+            if fn is None:
+                print(f"{bench.name:<28} skipped")
+                continue
+            results[bench.name] = measure(fn, args.iterations or bench.iterations)
+            r = results[bench.name]
+            print(f"{bench.name:<28} median {r['median_ms']:>10.2f}ms  "
+                  f"p95 {r['p95_ms']:>10.2f}ms  min {r['min_ms']:>10.2f}ms")
+
+    history = load_history(args.history)
+    regressions = find_regressions(results, history, config, args.threshold, args.window)
+
+    if not args.no_record:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history)), exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'commit': git_commit(), 'config': config,
+                                'results': results}) + '\n')
+
+    for name, expected, actual in regressions:
+        print(f"REGRESSION {name}: median {actual:.2f}ms vs baseline {expected:.2f}ms "
+              f"(+{(actual / expected - 1) * 100:.0f}%)")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
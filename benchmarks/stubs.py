@@ -0,0 +1,289 @@
+"""In-process stand-ins for the OpenAI and Pinecone HTTP APIs.
+
+Both servers keep everything in memory, answer with deterministic payloads
+and sleep for a configurable latency before every response, so benchmarks
+measure our own code plus a controlled amount of network wait.
+"""
+import base64
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+EMBEDDING_DIMENSION = 1536
+
+
+def fake_embedding(text, dimension=EMBEDDING_DIMENSION):
+    """Deterministic unit vector for a piece of text"""
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+FILTER_OPERATORS = {
+    '$eq': lambda value, arg: value == arg,
+    '$ne': lambda value, arg: value != arg,
+    '$in': lambda value, arg: value in arg,
+    '$nin': lambda value, arg: value not in arg,
+    '$gt': lambda value, arg: value is not None and value > arg,
+    '$gte': lambda value, arg: value is not None and value >= arg,
+    '$lt': lambda value, arg: value is not None and value < arg,
+    '$lte': lambda value, arg: value is not None and value <= arg,
+}
+
+
+def matches_filter(metadata, condition):
+    """Evaluate a Pinecone metadata filter against one vector's metadata"""
+    for key, value in condition.items():
+        if key == '$and':
+            if not all(matches_filter(metadata, c) for c in value):
+                return False
+        elif key == '$or':
+            if not any(matches_filter(metadata, c) for c in value):
+                return False
+        elif isinstance(value, dict):
+            if not all(FILTER_OPERATORS[op](metadata.get(key), arg) for op, arg in value.items()):
+                return False
+        elif metadata.get(key) != value:
+            return False
+    return True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, delayed ACKs add ~40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self):
+        self.server.stub.requests += 1
+        if self.server.stub.latency:
+            time.sleep(self.server.stub.latency)
+
+
+class OpenAIHandler(StubHandler):
+    def do_POST(self):
+        self.delay()
+        data = self.read_json()
+        path = urlparse(self.path).path
+        if path.endswith('/embeddings'):
+            self.send_json(self.embeddings(data))
+        elif path.endswith('/chat/completions'):
+            self.send_json(self.completion(data))
+        else:
+            self.send_json({'error': {'message': f'Unknown path {path}'}}, 404)
+
+    def embeddings(self, data):
+        inputs = data['input'] if isinstance(data['input'], list) else [data['input']]
+        items = []
+        for i, text in enumerate(inputs):
+            vector = fake_embedding(text)
+            if data.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            items.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        tokens = sum(len(text) // 4 + 1 for text in inputs)
+        return {'object': 'list', 'data': items, 'model': data.get('model'),
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}}
+
+    def completion(self, data):
+        messages = data.get('messages', [])
+        user_messages = [m['content'] for m in messages if m.get('role') == 'user']
+        content = f"Stub answer: {user_messages[-1][:200]}" if user_messages else "Stub answer"
+        system = messages[0]['content'] if messages else ''
+        if 'title generator' in system or 'extract key information' in system:
+            content = user_messages[-1][:200] if user_messages else ''
+        if (data.get('response_format') or {}).get('type') == 'json_object':
+            # Batched title generation expects its JSON object echoed back
+            content = user_messages[-1] if user_messages else '{}'
+        prompt_tokens = sum(len(m.get('content', '')) // 4 + 1 for m in messages)
+        return {
+            'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': data.get('model'),
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': 16,
+                      'total_tokens': prompt_tokens + 16},
+        }
+
+
+class PineconeHandler(StubHandler):
+    def index_model(self, name):
+        config = self.server.stub.indexes[name]
+        return {
+            'name': name, 'dimension': config['dimension'], 'metric': config['metric'],
+            'host': f"{self.server.stub.url}/data/{name}", 'deletion_protection': 'disabled',
+            'spec': {'serverless': {'cloud': 'aws', 'region': 'us-west-2'}},
+            'status': {'ready': True, 'state': 'Ready'},
+        }
+
+    def data_plane(self, path):
+        """Split a data plane path into the index vector store and the API path"""
+        match = re.fullmatch(r'/data/([^/]+)(/.*)', path)
+        if not match:
+            return None, path
+        return self.server.stub.vectors.setdefault(match.group(1), {}), match.group(2)
+
+    def do_GET(self):
+        self.delay()
+        url = urlparse(self.path)
+        store, path = self.data_plane(url.path)
+        match = re.fullmatch(r'/indexes/([^/]+)', url.path)
+        if url.path == '/indexes':
+            self.send_json({'indexes': [self.index_model(n) for n in self.server.stub.indexes]})
+        elif match:
+            if match.group(1) not in self.server.stub.indexes:
+                self.send_json({'error': {'code': 'NOT_FOUND', 'message': 'Not found'}, 'status': 404}, 404)
+            else:
+                self.send_json(self.index_model(match.group(1)))
+        elif store is not None and path == '/vectors/fetch':
+            ids = parse_qs(url.query).get('ids', [])
+            self.send_json({'namespace': '', 'vectors': {
+                i: {'id': i, 'values': store[i][0], 'metadata': store[i][1]}
+                for i in ids if i in store}})
+        elif store is not None and path == '/vectors/list':
+            query = parse_qs(url.query)
+            prefix = query.get('prefix', [''])[0]
+            limit = int(query.get('limit', ['100'])[0])
+            start = int(query.get('paginationToken', ['0'])[0])
+            with self.server.stub.lock:
+                ids = sorted(i for i in store if i.startswith(prefix))
+            page = {'namespace': '', 'vectors': [{'id': i} for i in ids[start:start + limit]]}
+            if start + limit < len(ids):
+                page['pagination'] = {'next': str(start + limit)}
+            self.send_json(page)
+        else:
+            self.send_json({'error': {'message': f'Unknown path {url.path}'}}, 404)
+
+    def do_POST(self):
+        self.delay()
+        data = self.read_json()
+        store, path = self.data_plane(urlparse(self.path).path)
+        stub = self.server.stub
+        if store is None and path == '/indexes':
+            if data['name'] in stub.indexes:
+                self.send_json({'error': {'code': 'ALREADY_EXISTS', 'message': 'ALREADY_EXISTS'}, 'status': 409}, 409)
+                return
+            stub.indexes[data['name']] = {'dimension': data['dimension'],
+                                          'metric': data.get('metric', 'cosine')}
+            self.send_json(self.index_model(data['name']), 201)
+        elif store is not None and path == '/vectors/upsert':
+            with stub.lock:
+                for vector in data['vectors']:
+                    store[vector['id']] = (vector['values'], vector.get('metadata') or {})
+            self.send_json({'upsertedCount': len(data['vectors'])})
+        elif store is not None and path == '/vectors/delete':
+            with stub.lock:
+                if data.get('deleteAll'):
+                    store.clear()
+                for vector_id in data.get('ids', []):
+                    store.pop(vector_id, None)
+            self.send_json({})
+        elif store is not None and path == '/query':
+            self.send_json(stub.query(store, data))
+        elif store is not None and path == '/describe_index_stats':
+            self.send_json({'namespaces': {'': {'vectorCount': len(store)}},
+                            'dimension': EMBEDDING_DIMENSION, 'indexFullness': 0.0,
+                            'totalVectorCount': len(store)})
+        else:
+            self.send_json({'error': {'message': f'Unknown path {path}'}}, 404)
+
+    def do_DELETE(self):
+        self.delay()
+        match = re.fullmatch(r'/indexes/([^/]+)', urlparse(self.path).path)
+        if match:
+            self.server.stub.indexes.pop(match.group(1), None)
+            self.server.stub.vectors.pop(match.group(1), None)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    # Load tests open hundreds of connections at once
+    request_queue_size = 4096
+
+
+class StubServer:
+    """A threaded HTTP server running in the background of this process"""
+
+    handler = StubHandler
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.httpd = StubHTTPServer(('127.0.0.1', 0), self.handler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class OpenAIStub(StubServer):
+    handler = OpenAIHandler
+
+
+class PineconeStub(StubServer):
+    """Serves the control plane and a data plane per index under /data/<name>"""
+
+    handler = PineconeHandler
+
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self.indexes = {}
+        self.vectors = {}
+
+    def query(self, store, data):
+        with self.lock:
+            items = list(store.items())
+        if data.get('filter'):
+            items = [item for item in items if matches_filter(item[1][1], data['filter'])]
+        if not items:
+            return {'namespace': '', 'matches': []}
+        matrix = np.asarray([values for _, (values, _) in items], dtype=np.float32)
+        scores = matrix @ np.asarray(data['vector'], dtype=np.float32)
+        top_k = int(data.get('topK', 10))
+        order = np.argsort(-scores)[:top_k]
+        matches = []
+        for i in order:
+            vector_id, (values, metadata) = items[i]
+            match = {'id': vector_id, 'score': float(scores[i])}
+            if data.get('includeValues'):
+                match['values'] = values
+            if data.get('includeMetadata'):
+                match['metadata'] = metadata
+            matches.append(match)
+        return {'namespace': '', 'matches': matches}
@@ -0,0 +1,215 @@
+import os
+import re
+import gzip
+import mmap
+import codecs
+import shutil
+import logging
+import tempfile
+import subprocess
+
+import PyPDF2
+import docx2txt
+
+try:
+    import charset_normalizer
+except ImportError:  # Fall back to BOM sniffing and utf-8/cp1252 trial decoding
+    charset_normalizer = None
+
+EXTRACTOR_VERSION = 2  # Bump when extraction output changes to invalidate the text cache
+TEXT_CACHE_DIR = os.environ.get('TEXT_CACHE_DIR', 'text_cache')
+TEXT_CACHE_COMPRESSLEVEL = 6
+READ_BLOCK_SIZE = 1024 * 1024  # Bytes decoded at a time from text files
+MMAP_THRESHOLD = 8 * 1024 * 1024  # Text files at least this large are memory-mapped
+ENCODING_SAMPLE_SIZE = 64 * 1024
+MIN_LEGACY_RUN = 8  # Shortest printable run kept when scraping legacy .doc files
+LEGACY_WORD = re.compile(rb'[A-Za-z]{2}')  # Scraped runs without one are binary noise
+
+BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# MIME type (or "type/*" wildcard) -> generator yielding pieces of text.
+# The pieces are joined before chunking, so a file's text is held in memory.
+EXTRACTORS = {}
+
+
+def register_extractor(*mime_types):
+    """Register an extractor for one or more MIME types"""
+    def decorator(extractor):
+        for mime_type in mime_types:
+            EXTRACTORS[mime_type] = extractor
+        return extractor
+    return decorator
+
+
+def get_extractor(mime_type):
+    """Return the extractor for a MIME type, falling back to its type/* wildcard"""
+    if not mime_type:
+        return None
+    return EXTRACTORS.get(mime_type) or EXTRACTORS.get(f"{mime_type.split('/')[0]}/*")
+
+
+def detect_encoding(sample):
+    """Guess the encoding of a text file from its first bytes"""
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+    try:
+        # A multi-byte sequence may be cut at the end of the sample
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    if charset_normalizer is not None:
+        best = charset_normalizer.from_bytes(sample).best()
+        if best is not None:
+            return best.encoding
+    return 'cp1252'
+
+
+def _decode_blocks(blocks, encoding):
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+@register_extractor('text/*')
+def extract_plain_text(filepath):
+    """Decode a text file block by block, memory-mapping large files"""
+    size = os.path.getsize(filepath)
+    if size == 0:
+        return
+    with open(filepath, 'rb') as file:
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                encoding = detect_encoding(mapped[:ENCODING_SAMPLE_SIZE])
+                blocks = (mapped[i:i + READ_BLOCK_SIZE] for i in range(0, size, READ_BLOCK_SIZE))
+                yield from _decode_blocks(blocks, encoding)
+        else:
+            encoding = detect_encoding(file.read(ENCODING_SAMPLE_SIZE))
+            file.seek(0)
+            yield from _decode_blocks(iter(lambda: file.read(READ_BLOCK_SIZE), b''), encoding)
+
+
+@register_extractor('application/pdf')
+def extract_pdf_text(filepath):
+    """Yield the text of a PDF page by page"""
+    with open(filepath, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for page in pdf_reader.pages:
+            yield (page.extract_text() or "") + "\n"
+
+
+@register_extractor('application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+def extract_docx_text(filepath):
+    """Extract text content from DOCX file"""
+    yield docx2txt.process(filepath) or ""
+
+
+@register_extractor('application/msword')
+def extract_legacy_doc_text(filepath):
+    """Extract text from a Word 97-2003 .doc file.
+
+    Uses antiword when it is installed; otherwise scrapes printable runs
+    that contain letters out of the binary, trying both cp1252 and UTF-16
+    text and keeping whichever finds more.
+    """
+    if shutil.which('antiword'):
+        result = subprocess.run(['antiword', '-w', '0', filepath], capture_output=True,
+                                timeout=120)
+        if result.returncode == 0:
+            yield result.stdout.decode('utf-8', errors='replace')
+            return
+        logging.warning(f"antiword failed on {filepath}, falling back to text scraping")
+
+    with open(filepath, 'rb') as file:
+        data = file.read()
+    # \xff (and most of \x80-\x9f) is filler in the binary rather than cp1252 text
+    narrow = re.findall(rb'[\x20-\x7e\x91-\x94\xa0-\xfe\r\n\t]{%d,}' % MIN_LEGACY_RUN, data)
+    wide = re.findall(rb'(?:[\x20-\x7e\r\n\t]\x00){%d,}' % MIN_LEGACY_RUN, data)
+    narrow_text = "\n".join(run.decode('cp1252') for run in narrow if LEGACY_WORD.search(run))
+    wide_text = "\n".join(run.decode('utf-16-le') for run in wide
+                           if LEGACY_WORD.search(run.replace(b'\x00', b'')))
+    yield max(narrow_text, wide_text, key=len)
+
+
+def iter_text(filepath, mime_type):
+    """Iterate over the text of a file in pieces; yields nothing for unsupported types"""
+    extractor = get_extractor(mime_type)
+    if extractor is None:
+        return iter(())
+    return extractor(filepath)
+
+
+def extract_text_from_file(filepath, mime_type):
+    """Extract text content from various file types"""
+    try:
+        return "".join(iter_text(filepath, mime_type)).strip()
+    except Exception as e:
+        logging.error(f"Error extracting text from file: {e}")
+        return ""
+
+
+def text_cache_path(content_hash):
+    return os.path.join(TEXT_CACHE_DIR, content_hash[:2],
+                        f"{content_hash}.v{EXTRACTOR_VERSION}.txt.gz")
+
+
+def load_cached_text(content_hash):
+    """Return previously extracted text for a content hash, or None"""
+    path = text_cache_path(content_hash)
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            return file.read()
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError) as e:
+        logging.error(f"Discarding corrupt text cache entry {path}: {e}")
+        remove_cached_text(content_hash)
+        return None
+
+
+def store_cached_text(content_hash, text):
+    """Write extracted text to the cache atomically"""
+    path = text_cache_path(content_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.text_')
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(
+                fileobj=raw, mode='wb', compresslevel=TEXT_CACHE_COMPRESSLEVEL) as file:
+            file.write(text.encode('utf-8'))
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def remove_cached_text(content_hash):
+    path = text_cache_path(content_hash)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def extract_text_cached(filepath, mime_type, content_hash):
+    """Extract text once per content hash; later calls read the compressed cache"""
+    text = load_cached_text(content_hash)
+    if text is not None:
+        return text
+    text = extract_text_from_file(filepath, mime_type)
+    if text:
+        try:
+            store_cached_text(content_hash, text)
+        except OSError as e:
+            logging.error(f"Error caching extracted text: {e}")
+    return text
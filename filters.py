@@ -0,0 +1,136 @@
+import calendar
+from datetime import datetime, timezone
+
+from sqlalchemy import or_
+
+from database import db
+import models
+
+# Most values in one $in condition; longer lists are split into several
+# conditions joined with $or
+MAX_FILTER_VALUES = 1000
+
+FILTER_KEYS = ('file_ids', 'filenames', 'mime_types', 'uploaded_after', 'uploaded_before')
+
+
+def epoch_seconds(value):
+    """Seconds since the epoch for a naive UTC datetime, as stored in chunk metadata"""
+    return calendar.timegm(value.utctimetuple())
+
+
+def _parse_time(name, value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return datetime.fromtimestamp(value, timezone.utc).replace(tzinfo=None)
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"'{name}' must be an ISO 8601 date or epoch seconds")
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    raise ValueError(f"'{name}' must be an ISO 8601 date or epoch seconds")
+
+
+def _parse_list(name, value, item_type):
+    if isinstance(value, item_type) and not isinstance(value, bool):
+        value = [value]
+    if (not isinstance(value, list) or not value
+            or not all(isinstance(v, item_type) and not isinstance(v, bool) for v in value)):
+        raise ValueError(f"'{name}' must be a non-empty list of {item_type.__name__} values")
+    return value
+
+
+def parse_filters(raw):
+    """Validate the `filters` object of a query request.
+
+    Accepts file_ids, filenames, mime_types (exact or "type/*") and an
+    uploaded_after / uploaded_before range. Raises ValueError on bad input.
+    """
+    if raw is None:
+        return None
+    if not isinstance(raw, dict):
+        raise ValueError("'filters' must be an object")
+    unknown = set(raw) - set(FILTER_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown filters: {', '.join(sorted(unknown))}")
+
+    filters = {}
+    if 'file_ids' in raw:
+        filters['file_ids'] = _parse_list('file_ids', raw['file_ids'], int)
+    if 'filenames' in raw:
+        filters['filenames'] = _parse_list('filenames', raw['filenames'], str)
+    if 'mime_types' in raw:
+        filters['mime_types'] = _parse_list('mime_types', raw['mime_types'], str)
+    for name in ('uploaded_after', 'uploaded_before'):
+        if raw.get(name) is not None:
+            filters[name] = _parse_time(name, raw[name])
+    if ('uploaded_after' in filters and 'uploaded_before' in filters
+            and filters['uploaded_after'] > filters['uploaded_before']):
+        raise ValueError("'uploaded_after' must not be later than 'uploaded_before'")
+    return filters or None
+
+
+def _metadata_filter(filters):
+    """Translate the filters directly into Pinecone metadata conditions, if possible.
+
+    Deduplicated chunks are shared by every File row with the same content
+    but carry the file_id, filename and uploaded_at of the first upload, so
+    only per-content fields can be pushed down. Returns None when the
+    filters involve anything else.
+    """
+    mime_types = filters.get('mime_types', [])
+    if set(filters) != {'mime_types'} or any(t.endswith('/*') for t in mime_types):
+        return None
+    return {'mime_type': {'$in': mime_types}}
+
+
+def _in_conditions(field, values):
+    """$in conditions over values, at most MAX_FILTER_VALUES in each"""
+    return [{field: {'$in': values[i:i + MAX_FILTER_VALUES]}}
+            for i in range(0, len(values), MAX_FILTER_VALUES)]
+
+
+def resolve_filters(filters, index):
+    """Resolve query filters against the File table of an index.
+
+    Returns (vector_filter, stats). vector_filter is None when no file
+    matches, in which case the vector store need not be queried at all.
+    Deduplicated content shares chunk vectors between File rows, so matching
+    files are turned into their content hashes; legacy files without a hash
+    match on their parent vector id instead. Filters on exact MIME types
+    alone that match many files are pushed down as a mime_type condition.
+    """
+    query = db.session.query(models.File.content_hash, models.File.vector_id).filter(
+        models.File.index_id == index.id, models.File.processed.is_(True))
+    if 'file_ids' in filters:
+        query = query.filter(models.File.id.in_(filters['file_ids']))
+    if 'filenames' in filters:
+        query = query.filter(models.File.filename.in_(filters['filenames']))
+    if 'mime_types' in filters:
+        query = query.filter(or_(*(
+            models.File.mime_type.like(f"{t[:-1]}%") if t.endswith('/*') else models.File.mime_type == t
+            for t in filters['mime_types'])))
+    if 'uploaded_after' in filters:
+        query = query.filter(models.File.uploaded_at >= filters['uploaded_after'])
+    if 'uploaded_before' in filters:
+        query = query.filter(models.File.uploaded_at <= filters['uploaded_before'])
+
+    rows = query.all()
+    hashes = sorted({content_hash for content_hash, _ in rows if content_hash})
+    legacy_ids = sorted({vector_id for content_hash, vector_id in rows if not content_hash and vector_id})
+    stats = {'files': len(rows), 'content_hashes': len(hashes)}
+
+    if not hashes and not legacy_ids:
+        stats['mode'] = 'empty'
+        return None, stats
+
+    if len(hashes) + len(legacy_ids) > MAX_FILTER_VALUES:
+        vector_filter = _metadata_filter(filters)
+        if vector_filter is not None:
+            stats['mode'] = 'metadata'
+            return vector_filter, stats
+
+    conditions = _in_conditions('content_hash', hashes) + _in_conditions('parent_file', legacy_ids)
+    stats['mode'] = 'content_hash'
+    return (conditions[0] if len(conditions) == 1 else {'$or': conditions}), stats
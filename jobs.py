@@ -0,0 +1,162 @@
+"""Upload processing jobs: priority lanes and cooperative cancellation.
+
+Extraction, embedding and upserts run on a fixed pool of worker threads.
+Queued jobs in the interactive lane always start before bulk jobs, and bulk
+jobs may only occupy UPLOAD_BULK_WORKERS threads at a time, so a small upload
+never waits behind a stack of large ones.
+
+Cancellation is cooperative: cancel_job() sets a flag in the shared state
+backend (visible to every worker process) and the job calls check_cancelled()
+between steps, which raises JobCancelled so it can clean up what it wrote.
+"""
+import os
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+
+from metrics import Histogram
+from ratelimit import BACKGROUND
+from shared_state import state as shared_state
+
+INTERACTIVE_LANE = 'interactive'
+BULK_LANE = 'bulk'
+LANES = (INTERACTIVE_LANE, BULK_LANE)  # In order of precedence
+
+# OpenAI priority of each lane's embedding calls; queries (0) still come first
+LANE_PRIORITIES = {INTERACTIVE_LANE: 5, BULK_LANE: BACKGROUND}
+
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+UPLOAD_BULK_WORKERS = int(os.environ.get('UPLOAD_BULK_WORKERS', max(UPLOAD_WORKERS - 1, 1)))
+BULK_UPLOAD_BYTES = int(os.environ.get('BULK_UPLOAD_BYTES', 2 * 1024 * 1024))  # Larger uploads default to bulk
+JOB_STATE_TTL = 24 * 3600  # Seconds job states and cancel flags are kept
+
+QUEUE_SECONDS = Histogram('pfm_upload_queue_seconds', 'Time uploads waited for a processing worker',
+                          ('lane',))
+
+TERMINAL_STATES = ('complete', 'cancelled', 'error')
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once it has been asked to stop"""
+
+
+def upload_lane(requested, size):
+    """The lane for an upload: as requested, otherwise by size"""
+    if requested in LANES:
+        return requested
+    return BULK_LANE if size > BULK_UPLOAD_BYTES else INTERACTIVE_LANE
+
+
+def job_state(job_id):
+    return shared_state.get(f'upload_job:{job_id}')
+
+
+def set_job_state(job_id, state, **fields):
+    """Record a job's progress; only the request and the worker running the job write it"""
+    shared_state.set(f'upload_job:{job_id}',
+                     {**(job_state(job_id) or {}), **fields, 'state': state, 'updated_at': time.time()},
+                     ttl=JOB_STATE_TTL)
+
+
+def cancel_job(job_id):
+    """Ask a job to stop; works for jobs still uploading, queued or running in any worker"""
+    shared_state.set(f'upload_cancel:{job_id}', True, ttl=JOB_STATE_TTL)
+
+
+def is_cancelled(job_id):
+    return bool(shared_state.get(f'upload_cancel:{job_id}'))
+
+
+def check_cancelled(job_id):
+    if job_id and is_cancelled(job_id):
+        raise JobCancelled(job_id)
+
+
+class Job:
+    def __init__(self, job_id, lane, fn, args):
+        self.id = job_id
+        self.lane = lane
+        self.fn = fn
+        self.args = args
+        # Spans recorded by the job join the trace of the request that queued it
+        self.context = contextvars.copy_context()
+        self.queued_at = time.monotonic()
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.context.run(self.fn, *self.args)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns its result or re-raises its exception"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class JobScheduler:
+    def __init__(self, workers=UPLOAD_WORKERS, bulk_workers=UPLOAD_BULK_WORKERS):
+        self.workers = workers
+        self.bulk_workers = min(bulk_workers, workers)
+        self._queue = []
+        self._sequence = itertools.count()
+        self._running = {lane: 0 for lane in LANES}
+        self._condition = threading.Condition()
+        self._threads = []
+
+    def _start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'upload-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, job_id, lane, fn, *args):
+        job = Job(job_id, lane, fn, args)
+        with self._condition:
+            heapq.heappush(self._queue, (LANES.index(lane), next(self._sequence), job))
+            self._start()
+            self._condition.notify_all()
+        return job
+
+    def queued(self, lane=None):
+        with self._condition:
+            return sum(1 for _, _, job in self._queue if lane in (None, job.lane))
+
+    def _next_job(self):
+        """Pop the first job its lane has capacity for; must hold the condition"""
+        for entry in sorted(self._queue):
+            job = entry[2]
+            if job.lane == BULK_LANE and self._running[BULK_LANE] >= self.bulk_workers:
+                continue
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            return job
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while (job := self._next_job()) is None:
+                    self._condition.wait()
+                self._running[job.lane] += 1
+            QUEUE_SECONDS.observe(time.monotonic() - job.queued_at, lane=job.lane)
+            try:
+                job.run()
+            finally:
+                with self._condition:
+                    self._running[job.lane] -= 1
+                    self._condition.notify_all()
+
+
+upload_scheduler = JobScheduler()
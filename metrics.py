@@ -0,0 +1,189 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Seconds; covers a fast local stage up to a slow gpt-4o completion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Bytes; 1KiB up to 64MiB in powers of four
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+SPAN_LABELS = ('pipeline', 'stage', 'index', 'mime_type')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items())
+            lines.extend(self._render_series(key, value) for key, value in series)
+        return '\n'.join(line for line in lines if line)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, key, value):
+        return f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'buckets': [0] * len(self.buckets),
+                                              'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def _render_series(self, key, series):
+        lines = []
+        for bound, count in zip(self.buckets, series['buckets']):
+            labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+        labels = _format_labels(self.label_names, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(series['sum'])}")
+        lines.append(f"{self.name}_count{labels} {series['count']}")
+        return '\n'.join(lines)
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram('pfm_stage_duration_seconds',
+                          'Duration of each upload and query pipeline stage',
+                          SPAN_LABELS)
+STAGE_ERRORS = Counter('pfm_stage_errors_total',
+                       'Pipeline stages that raised an exception', SPAN_LABELS)
+STAGE_TOKENS = Histogram('pfm_stage_tokens', 'OpenAI tokens used by a pipeline stage',
+                         SPAN_LABELS + ('kind',), buckets=TOKEN_BUCKETS)
+STAGE_BYTES = Histogram('pfm_stage_payload_bytes',
+                        'Size of the payload handled by a pipeline stage',
+                        SPAN_LABELS, buckets=SIZE_BUCKETS)
+
+# Context variables keep traces separate per thread and per asyncio task
+_trace = contextvars.ContextVar('pfm_trace', default=None)
+
+
+class Span:
+    """Timing and size details for one stage of a pipeline"""
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.fields = {}
+        self.duration = None
+
+    def set(self, **fields):
+        """Attach token counts (prompt_tokens, completion_tokens) or payload_bytes"""
+        self.fields.update({k: v for k, v in fields.items() if v is not None})
+
+    def record_usage(self, response):
+        """Attach the token usage reported on an OpenAI response"""
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            self.set(prompt_tokens=getattr(usage, 'prompt_tokens', None),
+                     completion_tokens=getattr(usage, 'completion_tokens', None))
+
+    def as_dict(self):
+        return {'stage': self.stage, 'ms': round(self.duration * 1000, 3), **self.fields}
+
+
+def start_trace(**labels):
+    """Start collecting spans for the current request"""
+    _trace.set({'spans': [], 'labels': labels, 'started': time.perf_counter()})
+
+
+def finish_trace():
+    """Stop collecting, record the total duration and return the spans as dicts"""
+    trace = _trace.get()
+    _trace.set(None)
+    if trace is None:
+        return []
+
+    timings = [span.as_dict() for span in trace['spans']]
+    total = time.perf_counter() - trace['started']
+    STAGE_SECONDS.observe(total, **trace['labels'], stage='total')
+    timings.append({'stage': 'total', 'ms': round(total * 1000, 3)})
+    return timings
+
+
+def set_trace_labels(**labels):
+    """Add labels (e.g. mime_type once known) to every later span of the trace"""
+    trace = _trace.get()
+    if trace is not None:
+        trace['labels'].update(labels)
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time a pipeline stage and record it in the metrics and the current trace"""
+    trace = _trace.get()
+    labels = {**(trace['labels'] if trace else {}), **labels, 'stage': stage}
+    current = Span(stage, labels)
+    started = time.perf_counter()
+    try:
+        yield current
+    except Exception:
+        STAGE_ERRORS.inc(**labels)
+        current.set(error=True)
+        raise
+    finally:
+        current.duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(current.duration, **labels)
+        for kind in ('prompt_tokens', 'completion_tokens'):
+            if kind in current.fields:
+                STAGE_TOKENS.observe(current.fields[kind], kind=kind.split('_')[0], **labels)
+        if 'payload_bytes' in current.fields:
+            STAGE_BYTES.observe(current.fields['payload_bytes'], **labels)
+        if trace is not None:
+            trace['spans'].append(current)
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
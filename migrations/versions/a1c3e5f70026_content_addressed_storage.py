@@ -0,0 +1,49 @@
+"""content addressed storage
+
+Revision ID: a1c3e5f70026
+Revises: 
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f70026'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # db.create_all() creates new tables on startup, so only add what is missing
+    inspector = sa.inspect(op.get_bind())
+
+    file_columns = {column['name'] for column in inspector.get_columns('file')}
+    if 'content_hash' not in file_columns:
+        with op.batch_alter_table('file', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('content_hash', sa.String(length=64), nullable=True))
+            batch_op.create_index(batch_op.f('ix_file_content_hash'), ['content_hash'], unique=False)
+
+    if not inspector.has_table('file_blob'):
+        op.create_table('file_blob',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('content_hash', sa.String(length=64), nullable=False),
+            sa.Column('filepath', sa.String(length=512), nullable=False),
+            sa.Column('size', sa.BigInteger(), nullable=False),
+            sa.Column('mime_type', sa.String(length=128), nullable=True),
+            sa.Column('thumbnail_path', sa.String(length=512), nullable=True),
+            sa.Column('chunk_count', sa.Integer(), nullable=True),
+            sa.Column('ref_count', sa.Integer(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('content_hash')
+        )
+
+
+def downgrade():
+    op.drop_table('file_blob')
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_file_content_hash'))
+        batch_op.drop_column('content_hash')
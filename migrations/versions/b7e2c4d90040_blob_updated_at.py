@@ -0,0 +1,30 @@
+"""blob updated_at
+
+Revision ID: b7e2c4d90040
+Revises: a1c3e5f70026
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e2c4d90040'
+down_revision = 'a1c3e5f70026'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    blob_columns = {column['name'] for column in inspector.get_columns('file_blob')}
+    if 'updated_at' not in blob_columns:
+        with op.batch_alter_table('file_blob', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('file_blob', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
@@ -23,4 +23,18 @@ class File(db.Model):
     processed = db.Column(db.Boolean, default=False)
     vector_id = db.Column(db.String(64))  # Store Pinecone vector ID
     display_title = db.Column(db.String(255))  # Store the AI-generated title
-    index_id = db.Column(db.Integer, db.ForeignKey('pinecone_index.id'), nullable=False)
\ No newline at end of file
+    index_id = db.Column(db.Integer, db.ForeignKey('pinecone_index.id'), nullable=False)
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the stored bytes
+
+class FileBlob(db.Model):
+    """Content-addressed bytes shared by every File row with the same hash"""
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False, unique=True)
+    filepath = db.Column(db.String(512), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    mime_type = db.Column(db.String(128))
+    thumbnail_path = db.Column(db.String(512))
+    chunk_count = db.Column(db.Integer, default=0)  # Number of chunk vectors per index
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # Last reference change or upload progress
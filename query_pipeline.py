@@ -0,0 +1,293 @@
+"""The query pipeline shared by the Flask endpoints and the ASGI service.
+
+Validation, filter resolution, ranking, context assembly and response
+shaping are written once here. The steps are generators that yield the I/O
+they need (an Embed, Complete or Search call, Blocking database and cache
+work, Log entries) and are sent its result, so app.py drives them with
+blocking calls and asgi.py with awaits:
+
+    steps = query_steps(query, index_id, index_name)
+    payload = run_query_steps(steps, ...)            # app.py
+    payload = await run_query_steps(steps, ...)      # asgi.py
+"""
+import time
+from dataclasses import dataclass, field
+
+import models
+from database import db
+from metrics import span
+from filters import parse_filters, resolve_filters
+from answer_cache import answer_cache, request_variant
+from ratelimit import estimate_tokens
+from retrieval import (build_context, select_mmr, mmr_fetch_k, mmr_settings, search_terms_messages,
+                       parse_search_terms, answer_messages, MAX_TOP_K)
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+@dataclass
+class QueryRequest:
+    """A validated query with the app's defaults filled in"""
+    query: str
+    top_k: int
+    additional_context: str
+    context_token_budget: int
+    mmr: dict  # fetch_k/lambda/max_per_file; empty when diversity is off
+    filters: dict
+    use_cache: bool
+    extract_terms: bool
+    variant: str  # Answer cache key of the options that shape the answer
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _mmr_count(options, name, default):
+    value = options.get(name, default)
+    if value is not None and (not _is_int(value) or value < 1):
+        raise ValueError(f"'mmr.{name}' must be a positive integer")
+    return value
+
+
+def parse_query(data, config):
+    """Validate the fields of one query; raises ValueError with a message for the client"""
+    if not isinstance(data, dict):
+        raise ValueError('Query is required')
+    query = data.get('query')
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError('Query is required')
+    top_k = data.get('top_k', 5)
+    if not _is_int(top_k) or not 0 < top_k <= MAX_TOP_K:
+        raise ValueError(f"'top_k' must be an integer from 1 to {MAX_TOP_K}")
+    try:
+        context_token_budget = int(data.get('context_token_budget', config['CONTEXT_TOKEN_BUDGET']))
+    except (TypeError, ValueError):
+        context_token_budget = 0
+    if context_token_budget < 1:
+        raise ValueError("'context_token_budget' must be a positive integer")
+    mmr = mmr_settings(data.get('mmr'))
+    if mmr:
+        lambda_mult = mmr.get('lambda', config['MMR_LAMBDA'])
+        if (not isinstance(lambda_mult, (int, float)) or isinstance(lambda_mult, bool)
+                or not 0 <= lambda_mult <= 1):
+            raise ValueError("'mmr.lambda' must be a number from 0 to 1")
+        mmr = {'fetch_k': _mmr_count(mmr, 'fetch_k', None),
+               'lambda': float(lambda_mult),
+               'max_per_file': _mmr_count(mmr, 'max_per_file', config['MMR_MAX_PER_FILE'])}
+    return QueryRequest(
+        query=query,
+        top_k=top_k,
+        additional_context=data.get('additional_context') or '',
+        context_token_budget=context_token_budget,
+        mmr=mmr,
+        filters=parse_filters(data.get('filters')),
+        use_cache=answer_cache.enabled and data.get('cache', True) is not False,
+        extract_terms=data.get('extract_terms', True) is not False,
+        variant=request_variant(data))
+
+
+@dataclass
+class Embed:
+    """Embed texts; the step is sent the embeddings response"""
+    texts: list
+
+    def call_options(self):
+        return {'model': EMBEDDING_MODEL, 'input': self.texts, 'tokens': estimate_tokens(*self.texts)}
+
+
+@dataclass
+class Complete:
+    """A chat completion; the step is sent the response"""
+    model: str
+    messages: list
+    tokens: int
+    options: dict = field(default_factory=dict)
+
+    def call_options(self):
+        return {'model': self.model, 'messages': self.messages, 'tokens': self.tokens, **self.options}
+
+
+@dataclass
+class Search:
+    """Query the index; the step is sent the list of matches"""
+    vector: list
+    top_k: int
+    include_values: bool = False
+    filter: dict = None
+
+
+@dataclass
+class Blocking:
+    """Run a function that uses the database or the answer cache; the step is sent its result"""
+    fn: object
+    args: tuple = ()
+
+
+@dataclass
+class Log:
+    """Add an entry to the API log"""
+    message: str
+    level: str = 'info'
+    data: dict = None
+
+
+def empty_result(filter_stats=None):
+    """Payload of a query that needed no search"""
+    result = {"answer": "", "contexts": []}
+    if filter_stats is not None:
+        result["filter_stats"] = filter_stats
+    return result
+
+
+def resolve_index_filters(index_id, filters):
+    return resolve_filters(filters, db.session.get(models.PineconeIndex, index_id))
+
+
+def lookup_thumbnails(content_hashes):
+    """Preview paths of content-addressed matches, looked up in one query"""
+    return dict(db.session.query(
+        models.FileBlob.content_hash, models.FileBlob.thumbnail_path).filter(
+            models.FileBlob.content_hash.in_(content_hashes)).all())
+
+
+def query_steps(query, index_id, index_name):
+    """Answer one query; returns the response payload"""
+    log_data = {"index": index_name}
+    vector_filter, filter_stats = None, None
+    if query.filters:
+        with span('filter_resolution') as filter_span:
+            vector_filter, filter_stats = yield Blocking(resolve_index_filters, (index_id, query.filters))
+            filter_span.set(files=filter_stats['files'])
+        if vector_filter is None:
+            yield Log("No files match the query filters - no Pinecone search necessary", data=log_data)
+            return empty_result(filter_stats)
+
+    # Near-duplicate questions are answered from the index's semantic cache
+    started = time.perf_counter()
+    cache_info = query_embedding = generation = None
+    if query.use_cache:
+        generation = yield Blocking(answer_cache.generation, (index_id,))
+        with span('cache_lookup') as cache_span:
+            response = yield Embed([query.query])
+            cache_span.record_usage(response)
+            query_embedding = response.data[0].embedding
+            cached, similarity = yield Blocking(
+                answer_cache.lookup, (index_id, index_name, query_embedding, query.variant, generation))
+            cache_span.set(hit=cached is not None)
+        cache_info = {'hit': cached is not None, 'similarity': round(similarity, 4)}
+        if cached is not None:
+            cache_info['saved_ms'] = round(
+                (cached['seconds'] - (time.perf_counter() - started)) * 1000, 1)
+            yield Log(f"Generated response: {cached['payload']['answer']}",
+                      data={**log_data, "cached": True, "similarity": cache_info['similarity']})
+            return {**cached['payload'], "cache": cache_info}
+
+    if query.extract_terms:
+        # Extract search-relevant information using GPT
+        with span('term_extraction') as extraction_span:
+            extraction_response = yield Complete(
+                "gpt-4o-mini", search_terms_messages(query.query),
+                estimate_tokens(query.query, completion=100))
+            extraction_span.record_usage(extraction_response)
+        search_terms = parse_search_terms(extraction_response.choices[0].message.content)
+        if not search_terms:
+            yield Log("No search terms found - no Pinecone search necessary", data=log_data)
+            return empty_result()
+        yield Log(f"Search terms identified: {search_terms}", data=log_data)
+    else:
+        search_terms = query.query
+
+    if search_terms == query.query and query_embedding is not None:
+        search_vector = query_embedding
+    else:
+        with span('embedding') as embedding_span:
+            embedding_response = yield Embed([search_terms])
+            embedding_span.record_usage(embedding_response)
+        if not embedding_response or not embedding_response.data:
+            yield Log("Failed to generate query embedding", level="error")
+            return empty_result()
+        search_vector = embedding_response.data[0].embedding
+
+    result = yield from search_steps(query, index_name, search_vector, vector_filter, filter_stats)
+    if query.use_cache:
+        yield Blocking(answer_cache.store, (index_id, query_embedding, query.variant, result,
+                                            time.perf_counter() - started, generation))
+    return {**result, "cache": cache_info}
+
+
+def search_steps(query, index_name, search_vector, vector_filter=None, filter_stats=None, answer=True):
+    """Look up, rank and answer from a search vector; returns the response payload.
+
+    With `answer` false the payload carries the contexts and stats with a
+    null answer and no completion is requested.
+    """
+    log_data = {"index": index_name}
+
+    # Query the index, over-fetching candidates when diversifying
+    with span('vector_query') as query_span:
+        matches = yield Search(
+            search_vector,
+            mmr_fetch_k(query.top_k, query.mmr['fetch_k']) if query.mmr else query.top_k,
+            include_values=bool(query.mmr),
+            filter=vector_filter)
+        query_span.set(matches=len(matches))
+
+    diversity_stats = None
+    if query.mmr:
+        with span('mmr'):
+            matches, diversity_stats = select_mmr(
+                matches, search_vector, query.top_k,
+                lambda_mult=query.mmr['lambda'], max_per_file=query.mmr['max_per_file'])
+        yield Log(f"Selected {diversity_stats['selected']} diverse results from "
+                  f"{diversity_stats['candidates']} candidates in {diversity_stats['elapsed_ms']}ms",
+                  data=log_data)
+
+    match_hashes = {(match.metadata or {}).get("content_hash") for match in matches}
+    match_hashes.discard(None)
+    thumbnails = (yield Blocking(lookup_thumbnails, (match_hashes,))) if match_hashes else {}
+
+    contexts = []
+    for match in matches:
+        metadata = match.metadata or {}
+        filename = metadata.get("filename", "Unknown file")
+        match_log_data = dict(log_data)
+        thumbnail_path = thumbnails.get(metadata.get("content_hash"))
+        if thumbnail_path:
+            match_log_data["thumbnail_path"] = thumbnail_path
+            match_log_data["preview_url"] = f"/preview/{metadata['content_hash']}"
+        yield Log(f"Found relevant content in {metadata.get('display_title', filename)}",
+                  data=match_log_data)
+        contexts.append({
+            "id": match.id,
+            "score": match.score,
+            "text": metadata.get("text_content", "No content available")
+        })
+
+    # Merge neighbouring chunks and fill the token budget by score
+    with span('context') as context_span:
+        retrieved_context, context_stats = build_context(matches, query.context_token_budget)
+        context_span.set(prompt_tokens=context_stats['context_tokens'])
+    yield Log(f"Context uses {context_stats['context_tokens']} tokens "
+              f"({context_stats['tokens_saved']} saved)", data={**log_data, **context_stats})
+
+    result = {
+        "answer": None,
+        "contexts": contexts,
+        "context_stats": context_stats,
+        "diversity_stats": diversity_stats,
+        "filter_stats": filter_stats
+    }
+    if not answer:
+        return result
+
+    if query.additional_context:
+        retrieved_context += f"\n{query.additional_context}"
+    with span('completion') as completion_span:
+        response = yield Complete(
+            "gpt-4o", answer_messages(query.query, retrieved_context),
+            estimate_tokens(query.query, retrieved_context, completion=1000))
+        completion_span.record_usage(response)
+    result["answer"] = response.choices[0].message.content
+    yield Log(f"Generated response: {result['answer']}", data=log_data)
+    return result
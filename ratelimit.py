@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import asyncio
+import heapq
+import random
+import logging
+import itertools
+import threading
+from contextlib import contextmanager
+
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from metrics import Counter, Histogram
+
+# Lower values are served first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+DEFAULT_RPM = int(os.environ.get('OPENAI_RPM', 500))
+DEFAULT_TPM = int(os.environ.get('OPENAI_TPM', 200000))
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get('OPENAI_MAX_CONCURRENCY', 64))
+MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', 6))
+BACKOFF_BASE = 0.5  # Seconds before the first retry, doubled on every attempt
+BACKOFF_CAP = 30.0
+CHARS_PER_TOKEN = 4
+
+RETRYABLE_ERRORS = (openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+QUEUE_SECONDS = Histogram('pfm_openai_queue_wait_seconds',
+                          'Time OpenAI calls waited for rate limit capacity',
+                          ('model', 'priority'))
+RATE_LIMITED = Counter('pfm_openai_rate_limited_total', 'OpenAI 429 responses', ('model',))
+RETRIES = Counter('pfm_openai_retries_total', 'OpenAI calls retried', ('model',))
+
+
+def estimate_tokens(*texts, completion=0):
+    """Rough token estimate for a request, used until the real usage is known"""
+    return sum(len(text or '') // CHARS_PER_TOKEN + 1 for text in texts) + completion
+
+
+def parse_retry_after(headers):
+    """Seconds to wait according to a 429 response, or None if it doesn't say"""
+    if not headers:
+        return None
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if headers.get('retry-after'):
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+    return None
+
+
+class TokenBucket:
+    """Refills `capacity` units per minute, continuously"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        rate = self.capacity / 60.0
+        self.available = min(self.capacity, self.available + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` units are available (requests above capacity wait for a full bucket)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / (self.capacity / 60.0)
+
+    def take(self, amount):
+        self.available -= amount
+
+    def resize(self, per_minute, remaining=None):
+        per_minute = float(per_minute)
+        if per_minute > 0 and per_minute != self.capacity:
+            self.capacity = per_minute
+            self.available = min(self.available, per_minute)
+        if remaining is not None:
+            self.available = min(self.available, float(remaining))
+
+
+class RateLimiter:
+    """Process-wide RPM/TPM limiter with priorities and adaptive concurrency.
+
+    Callers queue by (priority, arrival) and only the head of the queue may
+    take capacity, so interactive requests overtake queued background work.
+    Concurrency is additive-increase/multiplicative-decrease: it halves on a
+    429 and creeps back up with every success.
+    """
+
+    def __init__(self, name, rpm=DEFAULT_RPM, tpm=DEFAULT_TPM,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0.0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._async_waiters = {}
+
+    def _try_take(self, ticket, tokens):
+        """Take capacity for `ticket` if it is at the head of the queue.
+
+        Must be called with the condition held. Returns 0 once capacity was
+        taken, otherwise the seconds to wait (None when blocked on others).
+        """
+        if self._waiting[0] != ticket or self.in_flight >= int(self.concurrency):
+            return None
+        now = time.monotonic()
+        wait = max(self.blocked_until - now,
+                   self.requests.wait_time(1, now),
+                   self.tokens.wait_time(tokens, now))
+        if wait > 0:
+            return wait
+        heapq.heappop(self._waiting)
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.in_flight += 1
+        self._notify()
+        return 0
+
+    def _notify(self):
+        """Wake sync waiters and the async waiter at the head of the queue"""
+        self._condition.notify_all()
+        if self._waiting:
+            waiter = self._async_waiters.get(self._waiting[0])
+            if waiter:
+                loop, woken = waiter
+                loop.call_soon_threadsafe(_resolve, woken)
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._notify()
+
+    def _observe_wait(self, started, priority):
+        QUEUE_SECONDS.observe(time.monotonic() - started, model=self.name,
+                              priority='interactive' if priority <= INTERACTIVE else 'background')
+
+    @contextmanager
+    def acquire(self, tokens, priority=BACKGROUND):
+        """Wait for request, token and concurrency capacity"""
+        ticket = (priority, next(self._sequence))
+        started = time.monotonic()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+            while (wait := self._try_take(ticket, tokens)) != 0:
+                self._condition.wait(timeout=wait or 1.0)
+        self._observe_wait(started, priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def acquire_async(self, tokens, priority=BACKGROUND):
+        """Async counterpart of acquire; shares the queue and buckets. Call release_async after."""
+        loop = asyncio.get_running_loop()
+        ticket = (priority, next(self._sequence))
+        started = time.monotonic()
+        with self._condition:
+            heapq.heappush(self._waiting, ticket)
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_take(ticket, tokens)
+                    if wait == 0:
+                        break
+                    woken = loop.create_future()
+                    self._async_waiters[ticket] = (loop, woken)
+                # Woken by _notify when this ticket reaches the head or capacity frees up
+                await asyncio.wait([woken], timeout=wait or 1.0)
+        except asyncio.CancelledError:
+            with self._condition:
+                if ticket in self._waiting:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._notify()
+            raise
+        finally:
+            with self._condition:
+                self._async_waiters.pop(ticket, None)
+        self._observe_wait(started, priority)
+
+    def release_async(self):
+        self._release()
+
+    def reconcile(self, estimated, used):
+        """Correct the token bucket once the real usage is known"""
+        if used is None:
+            return
+        with self._condition:
+            self.tokens.take(used - estimated)
+
+    def on_success(self):
+        with self._condition:
+            self.concurrency = min(self.max_concurrency,
+                                   self.concurrency + 1.0 / max(self.concurrency, 1.0))
+
+    def on_rate_limited(self, delay):
+        RATE_LIMITED.inc(model=self.name)
+        with self._condition:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            logging.warning(f"OpenAI rate limit hit for {self.name}; pausing {delay:.1f}s, "
+                            f"concurrency now {int(self.concurrency)}")
+
+    def observe_headers(self, headers):
+        """Adopt the limits OpenAI reports in x-ratelimit-* response headers"""
+        try:
+            with self._condition:
+                if headers.get('x-ratelimit-limit-requests'):
+                    self.requests.resize(headers['x-ratelimit-limit-requests'],
+                                         headers.get('x-ratelimit-remaining-requests'))
+                if headers.get('x-ratelimit-limit-tokens'):
+                    self.tokens.resize(headers['x-ratelimit-limit-tokens'],
+                                       headers.get('x-ratelimit-remaining-tokens'))
+        except ValueError as e:
+            logging.debug(f"Ignoring malformed rate limit headers: {e}")
+
+    def call(self, fn, *args, priority=BACKGROUND, tokens=1, **kwargs):
+        """Call an OpenAI client method under the limiter, retrying 429s and transient errors"""
+        for attempt in range(MAX_RETRIES + 1):
+            with self.acquire(tokens, priority):
+                try:
+                    response = fn(*args, **kwargs)
+                except openai.RateLimitError as e:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    delay = parse_retry_after(e.response.headers) or backoff(attempt)
+                    self.on_rate_limited(delay)
+                except RETRYABLE_ERRORS as e:
+                    if attempt == MAX_RETRIES:
+                        raise
+                    delay = backoff(attempt)
+                    logging.warning(f"Retrying OpenAI call after error: {e}")
+                else:
+                    self.on_success()
+                    usage = getattr(response, 'usage', None)
+                    self.reconcile(tokens, getattr(usage, 'total_tokens', None))
+                    return response
+            RETRIES.inc(model=self.name)
+            time.sleep(delay)
+
+    async def call_async(self, fn, *args, priority=BACKGROUND, tokens=1, **kwargs):
+        """Async counterpart of call for AsyncOpenAI client methods"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self.acquire_async(tokens, priority)
+            try:
+                response = await fn(*args, **kwargs)
+            except openai.RateLimitError as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = parse_retry_after(e.response.headers) or backoff(attempt)
+                self.on_rate_limited(delay)
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                delay = backoff(attempt)
+                logging.warning(f"Retrying OpenAI call after error: {e}")
+            else:
+                self.on_success()
+                usage = getattr(response, 'usage', None)
+                self.reconcile(tokens, getattr(usage, 'total_tokens', None))
+                return response
+            finally:
+                self.release_async()
+            RETRIES.inc(model=self.name)
+            await asyncio.sleep(delay)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(model):
+    """Return the shared limiter for a model; OpenAI enforces limits per model"""
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(model)
+        return _limiters[model]
+
+
+def limited_call(fn, *, model, priority=BACKGROUND, tokens=1, **kwargs):
+    """Shorthand for get_limiter(model).call(fn, model=model, ...)"""
+    return get_limiter(model).call(fn, model=model, priority=priority, tokens=tokens, **kwargs)
+
+
+async def limited_call_async(fn, *, model, priority=BACKGROUND, tokens=1, **kwargs):
+    """Shorthand for get_limiter(model).call_async(fn, model=model, ...)"""
+    return await get_limiter(model).call_async(fn, model=model, priority=priority,
+                                               tokens=tokens, **kwargs)
+
+
+def _observe_response(response):
+    """httpx hook feeding every OpenAI response's rate limit headers to its limiter"""
+    try:
+        model = json.loads(response.request.content or b'{}').get('model')
+    except (ValueError, AttributeError):
+        return
+    if model:
+        get_limiter(model).observe_headers(response.headers)
+
+
+_client = None
+
+
+def openai_client():
+    """The process-wide OpenAI client; retries are left to the limiter"""
+    global _client
+    if _client is None:
+        _client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'),
+                         max_retries=0,
+                         http_client=httpx.Client(
+                             timeout=httpx.Timeout(60.0, connect=5.0),
+                             event_hooks={'response': [_observe_response]}))
+    return _client
+
+
+async def _observe_response_async(response):
+    _observe_response(response)
+
+
+_async_client = None
+
+
+def async_openai_client(max_connections=1000):
+    """The process-wide AsyncOpenAI client, for the ASGI query service"""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'),
+                                    max_retries=0,
+                                    http_client=httpx.AsyncClient(
+                                        timeout=httpx.Timeout(60.0, connect=5.0),
+                                        limits=httpx.Limits(max_connections=max_connections,
+                                                            max_keepalive_connections=100),
+                                        event_hooks={'response': [_observe_response_async]}))
+    return _async_client
@@ -0,0 +1,390 @@
+"""Find and clean up drift between the database, the filesystem and Pinecone.
+
+An upload or delete that fails partway can leave chunk vectors, stored files,
+thumbnails or cached text behind with nothing referencing them, and FileBlob
+reference counts that no longer match. The reconciler compares all three in
+paginated passes, reports what it found and, with --apply, fixes it in bulk:
+
+    flask --app reconcile reconcile                # dry run, prints the drift report
+    flask --app reconcile reconcile --apply        # also clean up
+    flask --app reconcile reconcile --apply --interval 3600   # keep running
+
+Anything newer than --grace seconds is left alone since it may belong to an
+upload that is still in progress. Pinecone calls go through a RateLimiter
+capped at --rpm requests per minute so it can run against production.
+"""
+import os
+import re
+import json
+import time
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import func
+
+import app as app_module
+from app import app, db, models, answer_cache
+from extractors import TEXT_CACHE_DIR, EXTRACTOR_VERSION
+from ratelimit import RateLimiter
+from storage import vector_base_id, remove_blob_files, delete_file_row
+
+DEFAULT_BATCH_SIZE = 100  # Rows, vector ids or metadata fetches per page
+DELETE_BATCH_SIZE = 1000  # Pinecone's limit on ids per delete request
+DEFAULT_GRACE = 3600  # Seconds before an unreferenced item counts as an orphan
+DEFAULT_RPM = 300  # Pinecone requests per minute
+SAMPLE_SIZE = 20  # Items of each kind listed in the report
+
+THUMBNAIL_DIR = os.path.join('static', 'thumbnails')
+CHUNK_SUFFIX = re.compile(r'_chunk_\d+$')
+TEXT_CACHE_NAME = re.compile(r'^([0-9a-f]{64})\.v(\d+)\.txt\.gz$')
+
+
+def _sample(items):
+    return sorted(items, key=str)[:SAMPLE_SIZE]
+
+
+class Reconciler:
+    def __init__(self, apply=False, grace=DEFAULT_GRACE, batch_size=DEFAULT_BATCH_SIZE,
+                 rpm=DEFAULT_RPM, index_names=None):
+        self.apply = apply
+        self.grace = grace
+        self.batch_size = batch_size
+        self.index_names = set(index_names or ())
+        self.limiter = RateLimiter('pinecone-reconcile', rpm=rpm, max_concurrency=1)
+        self.cutoff = time.time() - grace
+        self.changed_indexes = set()
+
+    def pinecone(self, fn, *args, **kwargs):
+        with self.limiter.acquire(0):
+            return fn(*args, **kwargs)
+
+    def _files(self):
+        """Page through every File row by id"""
+        last_id = 0
+        while True:
+            rows = db.session.query(models.File).filter(models.File.id > last_id).order_by(
+                models.File.id).limit(self.batch_size).all()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1].id
+            db.session.expunge_all()
+
+    def _blobs(self):
+        last_id = 0
+        while True:
+            rows = db.session.query(models.FileBlob).filter(models.FileBlob.id > last_id).order_by(
+                models.FileBlob.id).limit(self.batch_size).all()
+            if not rows:
+                return
+            yield from rows
+            last_id = rows[-1].id
+
+    def scan_database(self):
+        """Collect what the database references, without keeping whole rows"""
+        self.paths = set()
+        self.thumbnails = set()
+        self.hashes = set()
+        self.references = Counter()
+        self.indexed = defaultdict(dict)  # index id -> vector base id -> [processed file ids]
+        self.pending = defaultdict(set)  # index id -> vector base ids of every unprocessed file
+        self.unprocessed = []  # (file id, index id, base vector id, filepath) older than the grace period
+        self.missing_files = []
+        stale_before = datetime.utcnow() - timedelta(seconds=self.grace)
+        # Content an upload or delete touched within the grace period, possibly still in progress
+        self.active_hashes = {content_hash for content_hash, in db.session.query(
+            models.FileBlob.content_hash).filter(self._last_change() >= stale_before)}
+
+        for file in self._files():
+            self.paths.add(os.path.abspath(file.filepath))
+            if file.thumbnail_path:
+                self.thumbnails.add(file.thumbnail_path)
+            if file.content_hash:
+                self.hashes.add(file.content_hash)
+                self.references[file.content_hash] += 1
+            if file.processed and file.vector_id:
+                self.indexed[file.index_id].setdefault(file.vector_id, []).append(file.id)
+                if not os.path.exists(file.filepath):
+                    self.missing_files.append(file.id)
+            elif not file.processed:
+                base = vector_base_id(file.content_hash) if file.content_hash else None
+                if base:
+                    self.pending[file.index_id].add(base)
+                if (file.uploaded_at and file.uploaded_at < stale_before
+                        and file.content_hash not in self.active_hashes):
+                    self.unprocessed.append((file.id, file.index_id, base, file.filepath))
+
+    @staticmethod
+    def _last_change():
+        """When a blob's references last changed or an upload of it last made progress"""
+        return func.coalesce(models.FileBlob.updated_at, models.FileBlob.created_at)
+
+    def scan_index(self, index):
+        """List every vector id of an index and classify the ones no processed file owns"""
+        vector_store = app_module.pinecone_client.Index(index.name)
+        known = self.indexed.get(index.id, {})
+        # Uploads write their vectors before the file is marked processed, however long that takes
+        pending = self.pending.get(index.id, set()) | {vector_base_id(h) for h in self.active_hashes}
+        seen_bases = set()
+        candidates = []
+        listed = 0
+
+        pages = vector_store.list(limit=self.batch_size)
+        while True:
+            page = self.pinecone(next, pages, None)
+            if page is None:
+                break
+            for vector_id in page:
+                listed += 1
+                base = CHUNK_SUFFIX.sub('', vector_id)
+                seen_bases.add(base)
+                if base not in known and base not in pending:
+                    candidates.append(vector_id)
+
+        # Vectors written in the last few minutes may belong to an upload that hasn't committed yet
+        orphans = []
+        for start in range(0, len(candidates), self.batch_size):
+            fetched = self.pinecone(vector_store.fetch, ids=candidates[start:start + self.batch_size]).vectors
+            for vector_id, vector in fetched.items():
+                uploaded_at = (vector.metadata or {}).get('uploaded_at')
+                if uploaded_at is None or uploaded_at < self.cutoff:
+                    orphans.append(vector_id)
+
+        if self.apply and orphans:
+            for start in range(0, len(orphans), DELETE_BATCH_SIZE):
+                self.pinecone(vector_store.delete, ids=orphans[start:start + DELETE_BATCH_SIZE], namespace="")
+            self.changed_indexes.add(index.id)
+            logging.info(f"Deleted {len(orphans)} orphaned vectors from {index.name}")
+
+        missing = [file_id for base, file_ids in known.items() if base not in seen_bases for file_id in file_ids]
+        return {
+            'vectors': listed,
+            'orphaned_vectors': len(orphans),
+            'orphaned_vector_sample': _sample(orphans),
+            'files_missing_vectors': len(missing),
+            'files_missing_vectors_sample': _sample(missing),
+        }, seen_bases
+
+    def reconcile_unprocessed(self, seen_bases):
+        """Settle files that were never marked processed.
+
+        Rows whose bytes are gone are deleted; rows whose vectors are in the
+        index after all are marked processed. The rest had no extractable text
+        and are only counted.
+        """
+        dangling, repaired, unsearchable = [], [], []
+        for file_id, index_id, base, filepath in self.unprocessed:
+            if not os.path.exists(filepath):
+                dangling.append(file_id)
+            elif base and base in seen_bases.get(index_id, ()):
+                repaired.append((file_id, base))
+            else:
+                unsearchable.append(file_id)
+
+        if self.apply and (dangling or repaired):
+            for start in range(0, len(dangling), self.batch_size):
+                for file in db.session.query(models.File).filter(
+                        models.File.id.in_(dangling[start:start + self.batch_size])):
+                    if file.content_hash:
+                        self.references[file.content_hash] -= 1
+                    self.changed_indexes.add(file.index_id)
+                    # Keeps FileBlob.ref_count right even when the blob pass is skipped (--index)
+                    delete_file_row(file)
+                db.session.commit()
+            for start in range(0, len(repaired), self.batch_size):
+                bases = dict(repaired[start:start + self.batch_size])
+                for file in db.session.query(models.File).filter(models.File.id.in_(bases)):
+                    file.vector_id = bases[file.id]
+                    file.processed = True
+                    self.changed_indexes.add(file.index_id)
+                db.session.commit()
+
+        return {
+            'stale_unprocessed_files': len(self.unprocessed),
+            'dangling_files': len(dangling),
+            'dangling_file_sample': _sample(dangling),
+            'repaired_files': len(repaired),
+            'repaired_file_sample': _sample(file_id for file_id, _ in repaired),
+            'unsearchable_files': len(unsearchable),
+        }
+
+    def reconcile_blobs(self):
+        """Fix reference counts and drop blobs that no File row references.
+
+        File rows only count once committed, so an upload holds a reference
+        its row doesn't show yet. Blobs whose references changed within the
+        grace period are skipped, and every fix is a conditional statement
+        that does nothing if an upload or delete touched the blob since it
+        was read.
+        """
+        drifted, unreferenced = [], []
+        stale_before = datetime.utcnow() - timedelta(seconds=self.grace)
+        for blob in self._blobs():
+            self.paths.add(os.path.abspath(blob.filepath))
+            if blob.thumbnail_path:
+                self.thumbnails.add(blob.thumbnail_path)
+            self.hashes.add(blob.content_hash)
+            last_change = blob.updated_at or blob.created_at
+            if blob.content_hash in self.active_hashes or (last_change and last_change >= stale_before):
+                continue
+            references = max(self.references[blob.content_hash], 0)
+            # Detached copies: a commit would otherwise reload the rows with newer counts
+            observed = models.FileBlob(id=blob.id, content_hash=blob.content_hash, filepath=blob.filepath,
+                                       thumbnail_path=blob.thumbnail_path, ref_count=blob.ref_count)
+            if references == 0:
+                unreferenced.append(observed)
+            elif blob.ref_count != references:
+                drifted.append((observed, references))
+
+        unchanged = db.session.query(models.FileBlob).filter(self._last_change() < stale_before)
+        if self.apply:
+            for start in range(0, len(drifted), self.batch_size):
+                for blob, references in drifted[start:start + self.batch_size]:
+                    unchanged.filter(models.FileBlob.id == blob.id,
+                                     models.FileBlob.ref_count == blob.ref_count).update(
+                        {models.FileBlob.ref_count: references}, synchronize_session=False)
+                db.session.commit()
+
+            for start in range(0, len(unreferenced), self.batch_size):
+                for blob in unreferenced[start:start + self.batch_size]:
+                    if not unchanged.filter(models.FileBlob.id == blob.id,
+                                            models.FileBlob.ref_count == blob.ref_count).delete(
+                                                synchronize_session=False):
+                        continue
+                    # Like release_blob, the files go before the delete commits
+                    db.session.flush()
+                    remove_blob_files(blob)
+                    self.paths.discard(os.path.abspath(blob.filepath))
+                    self.thumbnails.discard(blob.thumbnail_path)
+                    self.hashes.discard(blob.content_hash)
+                db.session.commit()
+        drifted = [blob.content_hash for blob, _ in drifted]
+        unreferenced = [blob.content_hash for blob in unreferenced]
+
+        return {
+            'ref_count_drift': len(drifted),
+            'ref_count_drift_sample': _sample(drifted),
+            'unreferenced_blobs': len(unreferenced),
+            'unreferenced_blob_sample': _sample(unreferenced),
+        }
+
+    def _old_files(self, directory):
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < self.cutoff:
+                        yield path
+                except OSError:
+                    continue  # Removed while walking
+
+    def _remove(self, paths):
+        if not self.apply:
+            return
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Error removing {path}: {e}")
+
+    def scan_filesystem(self):
+        """Find stored files, thumbnails and cached text that nothing references"""
+        uploads = [path for path in self._old_files(app.config['UPLOAD_FOLDER'])
+                   if os.path.abspath(path) not in self.paths]
+        thumbnails = [path for path in self._old_files(THUMBNAIL_DIR)
+                      if os.path.relpath(path, 'static') not in self.thumbnails]
+        cached_text = []
+        for path in self._old_files(TEXT_CACHE_DIR):
+            match = TEXT_CACHE_NAME.match(os.path.basename(path))
+            if not match or match.group(1) not in self.hashes or int(match.group(2)) != EXTRACTOR_VERSION:
+                cached_text.append(path)
+
+        for paths in (uploads, thumbnails, cached_text):
+            self._remove(paths)
+        return {
+            'orphaned_uploads': len(uploads),
+            'orphaned_upload_sample': _sample(uploads),
+            'orphaned_thumbnails': len(thumbnails),
+            'orphaned_thumbnail_sample': _sample(thumbnails),
+            'orphaned_cached_text': len(cached_text),
+            'orphaned_cached_text_sample': _sample(cached_text),
+        }
+
+    def scan_index_names(self, indexes):
+        """Indexes that only exist on one side are reported, never deleted"""
+        remote = set(self.pinecone(app_module.pinecone_client.list_indexes).names())
+        local = {index.name for index in indexes}
+        return {
+            'indexes_missing_in_pinecone': sorted(local - remote),
+            'indexes_missing_in_database': sorted(remote - local),
+        }, remote
+
+    def run(self):
+        started = time.perf_counter()
+        self.changed_indexes = set()
+        self.cutoff = time.time() - self.grace
+        report = {'applied': self.apply, 'grace_seconds': self.grace}
+
+        self.scan_database()
+        indexes = db.session.query(models.PineconeIndex).all()
+        if self.index_names:
+            indexes = [index for index in indexes if index.name in self.index_names]
+        index_report, remote = self.scan_index_names(indexes)
+        report.update(index_report)
+
+        report['indexes'] = {}
+        seen_bases = {}
+        for index in indexes:
+            if index.name not in remote:
+                continue
+            try:
+                report['indexes'][index.name], seen_bases[index.id] = self.scan_index(index)
+            except Exception as e:
+                logging.error(f"Error reconciling index {index.name}: {e}")
+                report['indexes'][index.name] = {'error': str(e)}
+
+        # Only rows of indexes that were listed can be judged against their vectors
+        self.unprocessed = [row for row in self.unprocessed if row[1] in seen_bases]
+        report['files_missing_bytes'] = len(self.missing_files)
+        report['files_missing_bytes_sample'] = _sample(self.missing_files)
+        report.update(self.reconcile_unprocessed(seen_bases))
+        if not self.index_names:
+            # Blobs and files are shared between indexes, so only a full pass may remove them
+            report.update(self.reconcile_blobs())
+            report.update(self.scan_filesystem())
+
+        for index_id in self.changed_indexes:
+            answer_cache.invalidate(index_id)
+        report['seconds'] = round(time.perf_counter() - started, 2)
+        return report
+
+
+@app.cli.command('reconcile')
+@click.option('--apply', is_flag=True, help='Clean up the drift instead of only reporting it.')
+@click.option('--index', 'index_names', multiple=True,
+              help='Only check the vectors of these indexes (skips the blob and filesystem passes).')
+@click.option('--grace', default=DEFAULT_GRACE, show_default=True,
+              help='Seconds before an unreferenced item counts as an orphan.')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Items per page.')
+@click.option('--rpm', default=DEFAULT_RPM, show_default=True, help='Pinecone requests per minute.')
+@click.option('--interval', type=float, help='Keep running, one pass every INTERVAL seconds.')
+def reconcile_command(apply, index_names, grace, batch_size, rpm, interval):
+    """Report drift between the database, stored files and Pinecone, and optionally fix it."""
+    reconciler = Reconciler(apply=apply, grace=grace, batch_size=batch_size, rpm=rpm,
+                            index_names=index_names)
+    while True:
+        try:
+            click.echo(json.dumps(reconciler.run(), indent=2))
+        except Exception as e:
+            logging.error(f"Reconcile pass failed: {e}")
+            db.session.rollback()
+            if not interval:
+                raise
+        if not interval:
+            return
+        db.session.remove()
+        time.sleep(interval)
@@ -0,0 +1,302 @@
+import time
+import json
+import logging
+from dataclasses import dataclass, field
+
+import numpy as np
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to a character based estimate
+    tiktoken = None
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000  # Tokens of retrieved context sent to the completion
+MIN_OVERLAP_CHARS = 20  # Shortest suffix/prefix match treated as chunk overlap
+MAX_OVERLAP_CHARS = 1000  # Longest overlap searched for between neighbouring chunks
+LEGACY_TEXT_CHARS = 1000  # Chunk text kept by uploads that predate storing the whole chunk
+CHARS_PER_TOKEN = 4  # Rough estimate used when tiktoken is unavailable
+COMPLETION_MODEL = "gpt-4o"
+DEFAULT_MMR_LAMBDA = 0.5  # 1.0 ranks purely by relevance, 0.0 purely by diversity
+MMR_FETCH_MULTIPLIER = 4  # Candidates fetched per requested result
+MIN_MMR_FETCH_K = 20
+MAX_TOP_K = 10000  # Pinecone's limit on results per query
+
+SEARCH_TERMS_PROMPT = (
+    "IF the query could be a request to search, extract key information from the query that "
+    "would be relevant for searching a knowledge base. Return only the essential search terms "
+    "and concepts. Otherwise, return an empty string.")
+BATCH_SEARCH_TERMS_PROMPT = (
+    "You receive a JSON object mapping ids to queries. For each query that could be a request to "
+    "search, extract key information that would be relevant for searching a knowledge base: only "
+    "the essential search terms and concepts. Otherwise use an empty string. Respond with a JSON "
+    "object mapping the same ids to the search terms.")
+ANSWER_PROMPT = "You are a helpful assistant. Find anything relevant to the query."
+
+_encoding = None
+
+
+def search_terms_messages(query_text):
+    """Messages asking gpt-4o-mini for the searchable part of a query"""
+    return [{"role": "system", "content": SEARCH_TERMS_PROMPT},
+            {"role": "user", "content": query_text}]
+
+
+def parse_search_terms(content):
+    """Search terms from the extraction response, or "" when no search is needed"""
+    terms = (content or "").strip()
+    return "" if terms == '""' else terms
+
+
+def batch_search_terms_messages(queries):
+    """Messages asking gpt-4o-mini for the searchable part of many queries at once"""
+    payload = json.dumps({str(i): query for i, query in enumerate(queries, 1)})
+    return [{"role": "system", "content": BATCH_SEARCH_TERMS_PROMPT},
+            {"role": "user", "content": payload}]
+
+
+def parse_batch_search_terms(content, count):
+    """Search terms for each of `count` queries, in order; "" where none were returned"""
+    terms = json.loads(content or "{}")
+    return [parse_search_terms(str(terms.get(str(i)) or "")) for i in range(1, count + 1)]
+
+
+def answer_messages(query_text, retrieved_context):
+    """Messages asking gpt-4o to answer a query from the retrieved context"""
+    return [{"role": "system", "content": ANSWER_PROMPT},
+            {"role": "user", "content": query_text},
+            {"role": "system", "content": f"Relevant context: {retrieved_context}"}]
+
+
+def count_tokens(text):
+    """Count prompt tokens for the completion model"""
+    global _encoding
+    if not text:
+        return 0
+    if tiktoken is not None:
+        try:
+            if _encoding is None:
+                _encoding = tiktoken.encoding_for_model(COMPLETION_MODEL)
+            return len(_encoding.encode(text))
+        except Exception as e:
+            logging.debug(f"tiktoken unavailable, estimating tokens: {e}")
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def strip_overlap(previous, following):
+    """Remove the prefix of `following` that repeats the end of `previous`"""
+    limit = min(len(previous), len(following), MAX_OVERLAP_CHARS)
+    for size in range(limit, MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(following[:size]):
+            return following[size:].lstrip()
+    return following
+
+
+@dataclass
+class ContextSegment:
+    """A run of consecutive chunks from one file whose text joins up"""
+    parent_file: str
+    filename: str
+    first_chunk: int
+    last_chunk: int
+    score: float
+    texts: list = field(default_factory=list)
+    truncated: bool = False  # The last chunk's text stops short, so nothing can follow it
+
+    @property
+    def text(self):
+        merged = ""
+        for text in self.texts:
+            merged = f"{merged} {strip_overlap(merged, text)}".strip() if merged else text
+        return merged
+
+
+def text_truncated(metadata):
+    """Whether a chunk's stored text is only the start of the chunk"""
+    if "text_truncated" in metadata:
+        return bool(metadata["text_truncated"])
+    return len(metadata.get("text_content", "")) >= LEGACY_TEXT_CHARS
+
+
+def _match_fields(match):
+    metadata = match.metadata or {}
+    chunk_index = metadata.get("chunk_index")
+    return (metadata.get("parent_file") or match.id,
+            metadata.get("filename", "Unknown file"),
+            int(chunk_index) if chunk_index is not None else None,
+            metadata.get("text_content", ""),
+            text_truncated(metadata))
+
+
+def build_segments(matches):
+    """Dedupe matches and merge consecutive chunk ranges per file.
+
+    A chunk only joins the previous one when that chunk's whole text is
+    stored; older vectors keep just the start of each chunk, and gluing those
+    together would read as continuous text that is not.
+    """
+    seen_ids = set()
+    seen_texts = set()
+    by_file = {}
+
+    for match in matches:
+        parent_file, filename, chunk_index, text, truncated = _match_fields(match)
+        normalized = " ".join(text.split())
+        if not normalized or match.id in seen_ids or normalized in seen_texts:
+            continue
+        seen_ids.add(match.id)
+        seen_texts.add(normalized)
+        by_file.setdefault(parent_file, []).append(
+            (chunk_index, match.score or 0.0, filename, text, truncated))
+
+    segments = []
+    for parent_file, chunks in by_file.items():
+        chunks.sort(key=lambda chunk: (chunk[0] is None, chunk[0] or 0))
+        segment = None
+        for chunk_index, score, filename, text, truncated in chunks:
+            adjacent = (segment is not None and chunk_index is not None
+                        and segment.last_chunk is not None
+                        and chunk_index == segment.last_chunk + 1
+                        and not segment.truncated)
+            if adjacent:
+                segment.last_chunk = chunk_index
+                segment.score = max(segment.score, score)
+                segment.texts.append(text)
+                segment.truncated = truncated
+            else:
+                segment = ContextSegment(parent_file, filename, chunk_index,
+                                         chunk_index, score, [text], truncated)
+                segments.append(segment)
+    return segments
+
+
+def build_context(matches, token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    """Assemble retrieved context for the completion within a token budget.
+
+    Segments are added best score first and skipped when they would not fit,
+    so a long low-scoring run cannot crowd out shorter relevant ones.
+    `tokens_saved` counts only text removed as duplicate or overlapping;
+    segments left out for the budget are reported in `segments_included`.
+
+    Returns a tuple of (context, stats).
+    """
+    naive_context = " ".join(
+        (match.metadata or {}).get("text_content", "") for match in matches)
+    naive_tokens = count_tokens(naive_context)
+
+    parts = []
+    used_tokens = 0
+    included = 0
+    segments = sorted(build_segments(matches), key=lambda s: s.score, reverse=True)
+    deduplicated_tokens = count_tokens(" ".join(segment.text for segment in segments))
+    for segment in segments:
+        part = f"[{segment.filename}]\n{segment.text}"
+        part_tokens = count_tokens(part)
+        if used_tokens + part_tokens > token_budget:
+            continue
+        parts.append(part)
+        used_tokens += part_tokens
+        included += 1
+
+    context = "\n\n".join(parts)
+    context_tokens = count_tokens(context)
+    stats = {
+        "matches": len(matches),
+        "segments": len(segments),
+        "segments_included": included,
+        "token_budget": token_budget,
+        "context_tokens": context_tokens,
+        "naive_tokens": naive_tokens,
+        "tokens_saved": max(naive_tokens - deduplicated_tokens, 0),
+    }
+    return context, stats
+
+
+def mmr_settings(value):
+    """MMR settings from a request's "mmr" field; empty when diversity is off.
+
+    `true` turns it on with the defaults, an object turns it on with its
+    fetch_k/lambda/max_per_file unless it has "enabled": false.
+    """
+    if value is True:
+        return {'enabled': True}
+    if isinstance(value, dict) and value.get('enabled', True):
+        return {**value, 'enabled': True}
+    return {}
+
+
+def _cap_per_file(matches, max_per_file):
+    """Matches in order, skipping any beyond `max_per_file` from one parent file"""
+    if not max_per_file:
+        return list(matches)
+    per_file = {}
+    kept = []
+    for match in matches:
+        parent = (match.metadata or {}).get("parent_file", match.id)
+        per_file[parent] = per_file.get(parent, 0) + 1
+        if per_file[parent] <= max_per_file:
+            kept.append(match)
+    return kept
+
+
+def mmr_fetch_k(top_k, fetch_k=None):
+    """Number of candidates to fetch for a diverse top_k, within Pinecone's limit"""
+    return min(max(int(fetch_k or 0), top_k * MMR_FETCH_MULTIPLIER, MIN_MMR_FETCH_K), MAX_TOP_K)
+
+
+def select_mmr(matches, query_vector, top_k, lambda_mult=DEFAULT_MMR_LAMBDA,
+               max_per_file=None):
+    """Pick a diverse top_k from candidates using maximal marginal relevance.
+
+    Candidates must have been fetched with their values. Each step picks the
+    candidate maximising lambda * relevance - (1 - lambda) * redundancy, where
+    redundancy is the highest cosine similarity to anything already picked.
+    `max_per_file` caps how many chunks of one parent file may be returned.
+
+    Returns a tuple of (selected_matches, stats).
+    """
+    started = time.perf_counter()
+    candidates = [match for match in matches if match.values]
+    if not candidates:
+        selected = _cap_per_file(matches, max_per_file)[:top_k]
+        return selected, {"candidates": len(matches), "selected": len(selected),
+                          "elapsed_ms": 0.0}
+
+    vectors = np.asarray([match.values for match in candidates], dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(query_vector, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = vectors @ query
+    similarity = vectors @ vectors.T
+    parents = np.asarray([(match.metadata or {}).get("parent_file", match.id)
+                          for match in candidates])
+
+    available = np.ones(len(candidates), dtype=bool)
+    redundancy = np.full(len(candidates), -np.inf, dtype=np.float32)
+    per_file = {}
+    selected = []
+
+    while len(selected) < top_k and available.any():
+        if selected:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+
+        parent = parents[best]
+        per_file[parent] = per_file.get(parent, 0) + 1
+        if max_per_file and per_file[parent] >= max_per_file:
+            available &= parents != parent
+
+    stats = {
+        "candidates": len(candidates),
+        "selected": len(selected),
+        "files": len(per_file),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
+    return [candidates[i] for i in selected], stats
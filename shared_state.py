@@ -0,0 +1,151 @@
+"""Process-shared state for upload status, API logs and caches.
+
+With a single process everything can live in memory. Under several gunicorn
+workers (or several hosts sharing a volume) each worker would otherwise see
+only its own status and logs, so SHARED_STATE_URL selects a backend that all
+workers read and write:
+
+    memory://                    per-process dictionaries (default)
+    sqlite:////var/lib/pfm/state.db   a SQLite file in WAL mode shared by every worker
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import deque
+
+SHARED_STATE_URL = os.environ.get('SHARED_STATE_URL', 'memory://')
+PURGE_INTERVAL = 100  # Writes between trims of logs and expired keys in the SQLite backend
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+class MemoryBackend:
+    """Keeps state in this process only"""
+
+    shared = False
+
+    def __init__(self):
+        self._values = {}
+        self._logs = {}
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires_at = self._values.get(key, (default, None))
+            if expires_at is not None and expires_at < time.time():
+                del self._values[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ttl if ttl else None)
+
+    def update(self, key, fn, default=None):
+        """Atomically replace a value with fn(current) and return the new value"""
+        with self._lock:
+            value = fn(self.get(key, default))
+            self.set(key, value)
+            return value
+
+    def append_log(self, key, entry, max_length):
+        with self._lock:
+            log = self._logs.get(key)
+            if log is None or log.maxlen != max_length:
+                log = self._logs[key] = deque(log or (), maxlen=max_length)
+            log.append(entry)
+
+    def get_log(self, key, max_length):
+        with self._lock:
+            return list(self._logs.get(key, ()))[-max_length:]
+
+
+class SQLiteBackend:
+    """Keeps state in a SQLite file that every worker process opens"""
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                         'expires_at REAL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS log (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'key TEXT NOT NULL, value TEXT NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_log_key_id ON log (key, id)')
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads or across a fork,
+        # so keep one per thread and reconnect in a forked worker
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _purge_due(self):
+        self._writes += 1
+        return self._writes % PURGE_INTERVAL == 0
+
+    def get(self, key, default=None):
+        row = self._connection().execute(
+            'SELECT value, expires_at FROM kv WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+                     (key, json.dumps(value), time.time() + ttl if ttl else None))
+        if ttl and self._purge_due():
+            conn.execute('DELETE FROM kv WHERE expires_at < ?', (time.time(),))
+
+    def update(self, key, fn, default=None):
+        """Atomically replace a value with fn(current) and return the new value"""
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent updates serialize
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            value = fn(self.get(key, default))
+            self.set(key, value)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return value
+
+    def append_log(self, key, entry, max_length):
+        conn = self._connection()
+        conn.execute('INSERT INTO log (key, value) VALUES (?, ?)', (key, json.dumps(entry)))
+        if self._purge_due():
+            conn.execute('DELETE FROM log WHERE key = ? AND id <= '
+                         '(SELECT id FROM log WHERE key = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                         (key, key, max_length))
+
+    def get_log(self, key, max_length):
+        rows = self._connection().execute(
+            'SELECT value FROM (SELECT id, value FROM log WHERE key = ? ORDER BY id DESC LIMIT ?) '
+            'ORDER BY id', (key, max_length)).fetchall()
+        return [json.loads(value) for value, in rows]
+
+
+def create_backend(url):
+    if url.startswith('memory://') or not url:
+        return MemoryBackend()
+    if url.startswith('sqlite:///'):
+        return SQLiteBackend(url[len('sqlite:///'):])
+    raise ValueError(f"Unsupported SHARED_STATE_URL: {url}")
+
+
+state = create_backend(SHARED_STATE_URL)
@@ -0,0 +1,373 @@
+"""Export a PineconeIndex to a snapshot directory and restore it as a new index.
+
+A snapshot holds everything needed to clone an index without re-embedding:
+
+    manifest.json        index settings, counts and the vectors checksum
+    vectors.f32          row-major little-endian float32 matrix, one row per vector
+    records.jsonl.gz     id and metadata of each row, in the same order
+    db.json              the PineconeIndex, File and FileBlob rows
+
+    flask --app snapshots snapshot export file-manager backups/file-manager
+    flask --app snapshots snapshot import backups/file-manager file-manager-copy
+"""
+import os
+import gzip
+import json
+import time
+import random
+import hashlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import click
+import numpy as np
+from pinecone import ServerlessSpec
+
+import app as app_module
+from app import app, db, models, answer_cache
+
+SNAPSHOT_VERSION = 1
+FETCH_BATCH_SIZE = 100  # Ids per fetch request; they travel in the query string
+UPSERT_BATCH_SIZE = 200
+DEFAULT_WORKERS = 8
+VERIFY_SAMPLE_SIZE = 200
+VERIFY_TIMEOUT = 120  # Seconds to wait for upserted vectors to be counted
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+FILE_COLUMNS = ('id', 'filename', 'filepath', 'thumbnail_path', 'mime_type', 'uploaded_at',
+                'processed', 'vector_id', 'display_title', 'content_hash')
+BLOB_COLUMNS = ('content_hash', 'filepath', 'size', 'mime_type', 'thumbnail_path', 'chunk_count',
+                'created_at')
+
+
+def _row(record, columns):
+    row = {}
+    for column in columns:
+        value = getattr(record, column)
+        row[column] = value.isoformat() if isinstance(value, datetime) else value
+    return row
+
+
+def _datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+def _bounded_map(executor, fn, items, window):
+    """Like executor.map, in order, but with at most `window` calls in flight"""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _rate(count, seconds):
+    return round(count / seconds, 1) if seconds > 0 else None
+
+
+def export_snapshot(index_name, path, workers=DEFAULT_WORKERS):
+    """Stream every vector of an index and its database rows to a snapshot directory"""
+    index = db.session.query(models.PineconeIndex).filter_by(name=index_name).first()
+    if not index:
+        raise click.ClickException(f'Index "{index_name}" not found')
+    if os.path.exists(os.path.join(path, 'manifest.json')):
+        raise click.ClickException(f"{path} already contains a snapshot")
+    os.makedirs(path, exist_ok=True)
+
+    started = time.perf_counter()
+    vector_store = app_module.pinecone_client.Index(index_name, pool_threads=workers)
+
+    def fetch(ids):
+        return ids, vector_store.fetch(ids=ids).vectors
+
+    def id_pages():
+        for page in vector_store.list(limit=FETCH_BATCH_SIZE):
+            if page:
+                yield list(page)
+
+    count = 0
+    checksum = hashlib.sha256()
+    with open(os.path.join(path, 'vectors.f32'), 'wb') as vectors_file, \
+            gzip.open(os.path.join(path, 'records.jsonl.gz'), 'wt', encoding='utf-8') as records_file, \
+            ThreadPoolExecutor(workers) as executor:
+        for ids, fetched in _bounded_map(executor, fetch, id_pages(), workers * 2):
+            for vector_id in ids:
+                vector = fetched.get(vector_id)
+                if vector is None:
+                    continue  # Deleted between listing and fetching
+                values = np.asarray(vector.values, dtype='<f4')
+                if values.shape != (index.dimension,):
+                    raise click.ClickException(
+                        f"Vector {vector_id} has {values.size} dimensions, expected {index.dimension}")
+                data = values.tobytes()
+                vectors_file.write(data)
+                checksum.update(data)
+                records_file.write(json.dumps({'id': vector_id, 'metadata': vector.metadata or {}}) + '\n')
+                count += 1
+    vector_seconds = time.perf_counter() - started
+
+    files = db.session.query(models.File).filter_by(index_id=index.id).all()
+    hashes = {file.content_hash for file in files if file.content_hash}
+    blobs = db.session.query(models.FileBlob).filter(models.FileBlob.content_hash.in_(hashes)).all() if hashes else []
+    with open(os.path.join(path, 'db.json'), 'w') as db_file:
+        json.dump({
+            'index': _row(index, ('name', 'dimension', 'metric', 'cloud', 'region')),
+            'files': [_row(file, FILE_COLUMNS) for file in files],
+            'blobs': [_row(blob, BLOB_COLUMNS) for blob in blobs],
+        }, db_file)
+
+    manifest = {
+        'version': SNAPSHOT_VERSION,
+        'index': index_name,
+        'dimension': index.dimension,
+        'metric': index.metric,
+        'vectors': count,
+        'files': len(files),
+        'vectors_sha256': checksum.hexdigest(),
+        'created_at': datetime.utcnow().isoformat(),
+    }
+    # The manifest is written last so a partial export is never mistaken for a snapshot
+    with open(os.path.join(path, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    seconds = time.perf_counter() - started
+    vector_bytes = count * index.dimension * 4
+    return {
+        'vectors': count,
+        'files': len(files),
+        'seconds': round(seconds, 2),
+        'vectors_per_second': _rate(count, vector_seconds),
+        'megabytes': round(vector_bytes / 1e6, 2),
+        'megabytes_per_second': _rate(vector_bytes / 1e6, vector_seconds),
+    }
+
+
+def _read_snapshot(path):
+    manifest_path = os.path.join(path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        raise click.ClickException(f"{path} is not a complete snapshot (no manifest.json)")
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('version') != SNAPSHOT_VERSION:
+        raise click.ClickException(f"Unsupported snapshot version {manifest.get('version')}")
+    with open(os.path.join(path, 'db.json')) as db_file:
+        rows = json.load(db_file)
+
+    vectors_path = os.path.join(path, 'vectors.f32')
+    expected_size = manifest['vectors'] * manifest['dimension'] * 4
+    if os.path.getsize(vectors_path) != expected_size:
+        raise click.ClickException(f"vectors.f32 is {os.path.getsize(vectors_path)} bytes, expected {expected_size}")
+    checksum = hashlib.sha256()
+    with open(vectors_path, 'rb') as vectors_file:
+        for block in iter(lambda: vectors_file.read(HASH_BLOCK_SIZE), b''):
+            checksum.update(block)
+    if checksum.hexdigest() != manifest['vectors_sha256']:
+        raise click.ClickException("vectors.f32 does not match the checksum in the manifest")
+
+    vectors = np.memmap(vectors_path, dtype='<f4', mode='r',
+                        shape=(manifest['vectors'], manifest['dimension'])) if manifest['vectors'] else \
+        np.zeros((0, manifest['dimension']), dtype='<f4')
+    return manifest, rows, vectors
+
+
+def _restore_rows(rows, index_name, index_desc):
+    """Create the index, File and FileBlob rows; returns the new index and the file id mapping"""
+    source = rows['index']
+    index = models.PineconeIndex(name=index_name, dimension=source['dimension'], metric=source['metric'],
+                                 cloud=source['cloud'], region=source['region'], status="ready",
+                                 endpoint=index_desc.host)
+    db.session.add(index)
+    db.session.flush()
+
+    blobs = {row['content_hash']: row for row in rows['blobs']}
+    existing_blobs = {}
+    file_ids = {}
+    for row in rows['files']:
+        file = models.File(index_id=index.id, **{
+            column: _datetime(row[column]) if column == 'uploaded_at' else row[column]
+            for column in FILE_COLUMNS if column != 'id'})
+        db.session.add(file)
+        db.session.flush()
+        file_ids[row['id']] = file.id
+
+        content_hash = row['content_hash']
+        if not content_hash:
+            continue
+        blob = existing_blobs.get(content_hash) or db.session.query(models.FileBlob).filter_by(
+            content_hash=content_hash).first()
+        if blob is None:
+            blob_row = blobs.get(content_hash)
+            if blob_row is None:
+                continue
+            blob = models.FileBlob(ref_count=0, **{
+                column: _datetime(blob_row[column]) if column == 'created_at' else blob_row[column]
+                for column in BLOB_COLUMNS})
+            db.session.add(blob)
+            if not os.path.exists(blob.filepath):
+                logging.warning(f"Restored file {row['filename']} but {blob.filepath} is missing on this host")
+        existing_blobs[content_hash] = blob
+        blob.ref_count = (blob.ref_count or 0) + 1
+    return index, file_ids
+
+
+def _restored_metadata(metadata, index_id, file_ids):
+    metadata = dict(metadata)
+    if 'index_id' in metadata:
+        metadata['index_id'] = index_id
+    if metadata.get('file_id') in file_ids:
+        metadata['file_id'] = file_ids[metadata['file_id']]
+    return metadata
+
+
+def _wait_for_count(vector_store, expected):
+    deadline = time.monotonic() + VERIFY_TIMEOUT
+    while True:
+        counted = vector_store.describe_index_stats().total_vector_count
+        if counted >= expected or time.monotonic() > deadline:
+            return counted
+        time.sleep(1)
+
+
+def import_snapshot(path, index_name, workers=DEFAULT_WORKERS, batch_size=UPSERT_BATCH_SIZE,
+                    verify_sample=VERIFY_SAMPLE_SIZE):
+    """Restore a snapshot into a new index with parallel batched upserts, then verify it"""
+    manifest, rows, vectors = _read_snapshot(path)
+    if db.session.query(models.PineconeIndex).filter_by(name=index_name).first():
+        raise click.ClickException(f'Index "{index_name}" already exists')
+
+    pinecone_client = app_module.pinecone_client
+    source = rows['index']
+    started = time.perf_counter()
+    pinecone_client.create_index(name=index_name, dimension=manifest['dimension'], metric=manifest['metric'],
+                                 spec=ServerlessSpec(cloud=source['cloud'], region=source['region']))
+    try:
+        while not pinecone_client.describe_index(index_name).status['ready']:
+            time.sleep(1)
+        index_desc = pinecone_client.describe_index(index_name)
+        index, file_ids = _restore_rows(rows, index_name, index_desc)
+        vector_store = pinecone_client.Index(index_name, pool_threads=workers)
+
+        def batches():
+            with gzip.open(os.path.join(path, 'records.jsonl.gz'), 'rt', encoding='utf-8') as records_file:
+                batch, start = [], 0
+                for row, line in enumerate(records_file):
+                    batch.append(json.loads(line))
+                    if len(batch) == batch_size:
+                        yield start, batch
+                        batch, start = [], row + 1
+                if batch:
+                    yield start, batch
+
+        def upsert(item):
+            start, records = item
+            values = vectors[start:start + len(records)].tolist()
+            vector_store.upsert(vectors=[
+                {'id': record['id'], 'values': row_values,
+                 'metadata': _restored_metadata(record['metadata'], index.id, file_ids)}
+                for record, row_values in zip(records, values)])
+            return len(records)
+
+        upsert_started = time.perf_counter()
+        with ThreadPoolExecutor(workers) as executor:
+            upserted = sum(_bounded_map(executor, upsert, batches(), workers * 2))
+        upsert_seconds = time.perf_counter() - upsert_started
+
+        verify_started = time.perf_counter()
+        verification = verify_restore(path, vector_store, vectors, index.id, file_ids,
+                                      manifest['vectors'], verify_sample)
+        verify_seconds = time.perf_counter() - verify_started
+        if not verification['ok']:
+            raise click.ClickException(f"Verification failed: {verification}")
+
+        db.session.commit()
+        answer_cache.invalidate(index.id)
+    except BaseException:
+        db.session.rollback()
+        # Don't leave a half-restored index behind
+        try:
+            pinecone_client.delete_index(index_name)
+        except Exception as e:
+            logging.error(f"Error deleting partially restored index {index_name}: {e}")
+        raise
+
+    vector_bytes = upserted * manifest['dimension'] * 4
+    return {
+        'vectors': upserted,
+        'files': len(file_ids),
+        'seconds': round(time.perf_counter() - started, 2),
+        'upsert_seconds': round(upsert_seconds, 2),
+        'vectors_per_second': _rate(upserted, upsert_seconds),
+        'megabytes_per_second': _rate(vector_bytes / 1e6, upsert_seconds),
+        'verify_seconds': round(verify_seconds, 2),
+        'verification': verification,
+    }
+
+
+def verify_restore(path, vector_store, vectors, index_id, file_ids, expected, sample_size):
+    """Check the vector count and compare a random sample of rows with the snapshot"""
+    counted = _wait_for_count(vector_store, expected)
+    rows = sorted(random.sample(range(expected), min(sample_size, expected)))
+    wanted = set(rows)
+    records = {}
+    with gzip.open(os.path.join(path, 'records.jsonl.gz'), 'rt', encoding='utf-8') as records_file:
+        for row, line in enumerate(records_file):
+            if row in wanted:
+                records[row] = json.loads(line)
+
+    mismatched = []
+    for start in range(0, len(rows), FETCH_BATCH_SIZE):
+        batch = rows[start:start + FETCH_BATCH_SIZE]
+        fetched = vector_store.fetch(ids=[records[row]['id'] for row in batch]).vectors
+        for row in batch:
+            record = records[row]
+            vector = fetched.get(record['id'])
+            if (vector is None
+                    or not np.allclose(np.asarray(vector.values, dtype=np.float32), vectors[row], atol=1e-6)
+                    or (vector.metadata or {}) != _restored_metadata(record['metadata'], index_id, file_ids)):
+                mismatched.append(record['id'])
+    return {
+        'ok': counted == expected and not mismatched,
+        'expected_vectors': expected,
+        'counted_vectors': counted,
+        'sampled': len(rows),
+        'mismatched': mismatched[:20],
+    }
+
+
+@app.cli.group()
+def snapshot():
+    """Back up and clone indexes without re-embedding."""
+
+
+@snapshot.command('export')
+@click.argument('index_name')
+@click.argument('path')
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True, help='Parallel fetch requests.')
+def export_command(index_name, path, workers):
+    """Write INDEX_NAME with its vectors and database rows to the directory PATH."""
+    stats = export_snapshot(index_name, path, workers=workers)
+    click.echo(f"Exported {stats['vectors']} vectors and {stats['files']} files in {stats['seconds']}s "
+               f"({stats['vectors_per_second']} vectors/s, {stats['megabytes_per_second']} MB/s)")
+
+
+@snapshot.command('import')
+@click.argument('path')
+@click.argument('index_name')
+@click.option('--workers', default=DEFAULT_WORKERS, show_default=True, help='Parallel upsert requests.')
+@click.option('--batch-size', default=UPSERT_BATCH_SIZE, show_default=True, help='Vectors per upsert.')
+@click.option('--verify-sample', default=VERIFY_SAMPLE_SIZE, show_default=True,
+              help='Vectors fetched back and compared with the snapshot.')
+def import_command(path, index_name, workers, batch_size, verify_sample):
+    """Restore the snapshot in PATH as a new index INDEX_NAME."""
+    stats = import_snapshot(path, index_name, workers=workers, batch_size=batch_size,
+                            verify_sample=verify_sample)
+    verification = stats['verification']
+    click.echo(f"Imported {stats['vectors']} vectors and {stats['files']} files in {stats['seconds']}s "
+               f"(upserts {stats['vectors_per_second']} vectors/s, {stats['megabytes_per_second']} MB/s)")
+    click.echo(f"Verified {verification['counted_vectors']}/{verification['expected_vectors']} vectors counted, "
+               f"{verification['sampled']} sampled, {len(verification['mismatched'])} mismatched "
+               f"in {stats['verify_seconds']}s")
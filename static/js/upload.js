@@ -38,10 +38,20 @@ function proceedWithUpload() {
   }
 }
 
+function newUploadId() {
+  if (window.crypto && crypto.randomUUID) {
+    return crypto.randomUUID().replace(/-/g, "");
+  }
+  return Date.now().toString(36) + Math.random().toString(36).slice(2);
+}
+
 function uploadFile(file, indexId) {
+  // Chosen here so the upload can be cancelled before the server responds
+  const uploadId = newUploadId();
   const formData = new FormData();
   formData.append("file", file);
   formData.append("index_id", indexId);
+  formData.append("upload_id", uploadId);
 
   // Show progress bar and hide upload content
   const uploadContent = document.querySelector(".upload-content");
@@ -49,8 +59,23 @@ function uploadFile(file, indexId) {
   const progressBarFill = document.querySelector(".progress-bar");
   const progressStatus = document.querySelector(".progress-status");
 
+  const cancelButton = document.querySelector(".cancel-upload");
+  let cancelled = false;
+
   uploadContent.style.display = "none";
   progressBar.style.display = "block";
+  cancelButton.style.display = "inline-block";
+  cancelButton.disabled = false;
+
+  const showCancelled = () => {
+    progressStatus.textContent = "Upload cancelled";
+    cancelButton.style.display = "none";
+    setTimeout(() => {
+      progressBar.style.display = "none";
+      progressBarFill.style.width = "0%";
+      uploadContent.style.display = "flex";
+    }, 1500);
+  };
 
   // Function to map progress based on phase
   const mapProgress = (progress, phase) => {
@@ -86,7 +111,10 @@ function uploadFile(file, indexId) {
             progressStatus.textContent = "Analyzing file...";
           }
           setTimeout(pollStatus, 1000); // Poll every second
+        } else if (data.status === "cancelled") {
+          showCancelled();
         } else if (data.status === "complete") {
+          cancelButton.style.display = "none";
           progressStatus.textContent = "Upload complete!";
           progressBarFill.style.width = "100%";
           setTimeout(() => {
@@ -95,6 +123,7 @@ function uploadFile(file, indexId) {
         } else if (data.status === "error") {
           progressStatus.textContent = data.message;
           progressBar.classList.add("error");
+          cancelButton.style.display = "none";
           setTimeout(() => {
             progressBar.style.display = "none";
             progressBar.classList.remove("error");
@@ -121,12 +150,33 @@ function uploadFile(file, indexId) {
     }
   };
 
+  cancelButton.onclick = () => {
+    cancelled = true;
+    cancelButton.disabled = true;
+    progressStatus.textContent = "Cancelling...";
+    // The server stops between processing steps and removes anything already stored
+    fetch(`/upload/${uploadId}/cancel`, { method: "POST" }).catch((error) =>
+      console.error("Error cancelling upload:", error)
+    );
+    if (xhr.readyState !== XMLHttpRequest.DONE) {
+      xhr.abort();
+    }
+    showCancelled();
+  };
+
   xhr.onload = () => {
+    if (cancelled) {
+      return;
+    }
     if (xhr.status === 200) {
       const response = JSON.parse(xhr.responseText);
       if (response.error) {
         throw new Error(response.error);
       }
+      if (response.status === "cancelled") {
+        showCancelled();
+        return;
+      }
       // Start polling for processing status
       pollStatus();
     } else {
@@ -135,9 +185,13 @@ function uploadFile(file, indexId) {
   };
 
   xhr.onerror = () => {
+    if (cancelled) {
+      return;
+    }
     console.error("Upload error:", xhr.statusText);
     progressStatus.textContent = "Upload failed";
     progressBar.classList.add("error");
+    cancelButton.style.display = "none";
     setTimeout(() => {
       progressBar.style.display = "none";
       progressBar.classList.remove("error");
@@ -231,8 +285,12 @@ function formatLogMessage(log) {
     // Extract filename from message
     const filename = message.substring("Found relevant content in ".length);
 
-    // Construct thumbnail path
-    const thumbnailPath = `/static/thumbnails/pdf_thumb_${filename}.jpg`;
+    // Construct thumbnail path, preferring the cacheable content-addressed preview
+    const thumbnailPath = log.preview_url
+      ? log.preview_url
+      : log.thumbnail_path
+      ? `/static/${log.thumbnail_path}`
+      : `/static/thumbnails/pdf_thumb_${filename}.jpg`;
 
     // Get content from matches if available
     const content = log.matches
@@ -0,0 +1,182 @@
+import os
+import hashlib
+import logging
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+import models
+from database import db
+from extractors import remove_cached_text
+
+HASH_ALGORITHM = 'sha256'
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes read from the upload stream at a time
+VECTOR_ID_HASH_LENGTH = 32  # Hex characters of the content hash used in vector ids
+
+
+def content_path(upload_folder, content_hash, filename):
+    """Return the content-addressed path for a blob, keeping the original extension"""
+    ext = os.path.splitext(filename)[1].lower()
+    return os.path.join(upload_folder, content_hash[:2], f"{content_hash}{ext}")
+
+
+def vector_base_id(content_hash):
+    """Return the base Pinecone vector id for a piece of content"""
+    return f"file_{content_hash[:VECTOR_ID_HASH_LENGTH]}"
+
+
+def chunk_vector_ids(base_vector_id, chunk_count):
+    """Return the ids of every chunk vector stored for a file"""
+    return [f"{base_vector_id}_chunk_{i}" for i in range(chunk_count)]
+
+
+def save_stream_hashed(file_storage, upload_folder):
+    """Stream an upload to a temporary file in the upload folder while hashing it.
+
+    The caller takes a reference with acquire_blob() and then moves the bytes
+    into place with place_blob_file(), so a blob that is being deleted can
+    never swallow a new upload of the same content.
+
+    Returns a tuple of (content_hash, temp_path, size).
+    """
+    os.makedirs(upload_folder, exist_ok=True)
+    hasher = hashlib.new(HASH_ALGORITHM)
+    size = 0
+
+    fd, temp_path = tempfile.mkstemp(dir=upload_folder, prefix='.upload_')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            while True:
+                block = file_storage.stream.read(STREAM_CHUNK_SIZE)
+                if not block:
+                    break
+                hasher.update(block)
+                temp_file.write(block)
+                size += len(block)
+        return hasher.hexdigest(), temp_path, size
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def place_blob_file(temp_path, file_path):
+    """Move uploaded bytes to their content-addressed path.
+
+    The temporary copy is discarded when the path already holds the content.
+    Returns True in that case, False if the bytes were moved into place.
+    """
+    if os.path.exists(file_path):
+        os.remove(temp_path)
+        return True
+    for attempt in range(3):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        try:
+            os.replace(temp_path, file_path)
+            return False
+        except FileNotFoundError:
+            # A delete removed the emptied shard directory in between
+            if attempt == 2:
+                raise
+
+
+def acquire_blob(content_hash, file_path, size, mime_type):
+    """Take a reference to the blob for some content, creating its row if needed.
+
+    Commits straight away. Concurrent uploads of the same bytes race on the
+    unique content_hash: the loser's insert fails, so it rolls back and
+    increments the winner's row instead. Stamps updated_at, which keeps the
+    reconciler away from the blob while the upload is in progress. Returns
+    the path the blob is stored at.
+    """
+    blobs = db.session.query(models.FileBlob).filter_by(content_hash=content_hash)
+    for attempt in range(3):
+        if blobs.update({models.FileBlob.ref_count: func.coalesce(models.FileBlob.ref_count, 0) + 1,
+                         models.FileBlob.updated_at: datetime.utcnow()},
+                        synchronize_session=False):
+            db.session.commit()
+            return blobs.with_entities(models.FileBlob.filepath).scalar()
+        db.session.add(models.FileBlob(content_hash=content_hash, filepath=file_path, size=size,
+                                       mime_type=mime_type, ref_count=1))
+        try:
+            db.session.commit()
+            return file_path
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == 2:
+                raise
+
+
+def release_blob(content_hash, thumbnail_path=None):
+    """Drop a reference to a blob; once none are left delete it and its files.
+
+    The files are removed inside the caller's transaction, before it commits,
+    so a concurrent acquire_blob() either keeps the row alive or runs after
+    the delete and stores the bytes again. `thumbnail_path` names a preview
+    made for the reference being dropped that never reached the row.
+    Returns True if the blob was deleted.
+    """
+    blobs = db.session.query(models.FileBlob).filter_by(content_hash=content_hash)
+    blobs.update({models.FileBlob.ref_count: func.coalesce(models.FileBlob.ref_count, 1) - 1,
+                  models.FileBlob.updated_at: datetime.utcnow()},
+                 synchronize_session=False)
+    blob = blobs.populate_existing().first()
+    if blob is None or blob.ref_count > 0:
+        return False
+    blob.thumbnail_path = blob.thumbnail_path or thumbnail_path
+    db.session.delete(blob)
+    db.session.flush()
+    remove_blob_files(blob)
+    return True
+
+
+def delete_file_row(file):
+    """Delete a File row along with its reference to the stored bytes.
+
+    Content-addressed files release their blob, so the bytes go once no
+    other row references them; legacy files own their bytes and thumbnail
+    outright. The caller deletes any vectors and commits.
+    """
+    if file.content_hash and db.session.query(models.FileBlob.id).filter_by(
+            content_hash=file.content_hash).first():
+        release_blob(file.content_hash)
+    else:
+        if os.path.exists(file.filepath):
+            os.remove(file.filepath)
+            logging.info(f"Deleted file: {file.filepath}")
+        if file.thumbnail_path:
+            thumbnail_path = os.path.join('static', file.thumbnail_path)
+            if os.path.exists(thumbnail_path):
+                os.remove(thumbnail_path)
+                logging.info(f"Deleted thumbnail: {thumbnail_path}")
+    db.session.delete(file)
+
+
+def remove_blob_files(blob):
+    """Delete the stored bytes and preview of a blob that is no longer referenced"""
+    if os.path.exists(blob.filepath):
+        os.remove(blob.filepath)
+        logging.info(f"Deleted file: {blob.filepath}")
+        remove_empty_shard(blob.filepath, blob.content_hash)
+
+    if blob.thumbnail_path:
+        thumbnail_path = os.path.join('static', blob.thumbnail_path)
+        if os.path.exists(thumbnail_path):
+            os.remove(thumbnail_path)
+            logging.info(f"Deleted thumbnail: {thumbnail_path}")
+
+    if blob.content_hash:
+        remove_cached_text(blob.content_hash)
+
+
+def remove_empty_shard(file_path, content_hash):
+    """Remove the uploads/<hash[:2]>/ directory a blob lived in once it is empty"""
+    directory = os.path.dirname(file_path)
+    if not content_hash or os.path.basename(directory) != content_hash[:2]:
+        return
+    try:
+        os.rmdir(directory)
+    except OSError:
+        pass  # Still holds other blobs
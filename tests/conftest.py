@@ -0,0 +1,55 @@
+import os
+import shutil
+
+import pytest
+from flask import Flask
+
+import models
+from database import db
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """A bare Flask app on a throwaway SQLite database, run from a scratch directory"""
+    monkeypatch.chdir(tmp_path)
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{tmp_path / 'test.db'}"
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture(scope='session')
+def stubs():
+    """The app module, imported once against the benchmark stub servers"""
+    from benchmarks.run import Context
+    with Context(latency=0) as context:
+        context.app  # noqa: B018 - imports app and creates the benchmark index
+        yield context
+
+
+@pytest.fixture
+def live_app(stubs):
+    """The real app on an emptied database, Pinecone stub and workspace"""
+    app_module = stubs.app
+    with app_module.app.app_context():
+        db.drop_all()
+        db.create_all()
+        for name in list(stubs.pinecone.indexes):
+            if name != 'bench-index':
+                app_module.pinecone_client.delete_index(name)
+        stubs.pinecone.vectors.clear()
+        index = models.PineconeIndex(name='bench-index', status='ready',
+                                     endpoint=app_module.pinecone_client.describe_index('bench-index').host)
+        db.session.add(index)
+        db.session.commit()
+        stubs.index_id = index.id
+        for directory in (app_module.app.config['UPLOAD_FOLDER'], 'static', 'text_cache'):
+            shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(app_module.app.config['UPLOAD_FOLDER'])
+        os.makedirs(os.path.join('static', 'thumbnails'))
+        yield stubs
+        db.session.remove()
@@ -0,0 +1,71 @@
+import itertools
+
+import numpy as np
+
+from answer_cache import AnswerCache, IndexAnswerCache, request_variant
+
+index_ids = itertools.count(1000)  # The generation counters live in the shared state backend
+
+
+def unit(*values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_request_variant_ignores_query_and_unset_options():
+    assert request_variant({'query': 'a', 'top_k': 5}) == request_variant({'query': 'b', 'top_k': 5,
+                                                                           'filters': None})
+    assert request_variant({'top_k': 5}) != request_variant({'top_k': 6})
+    assert request_variant({'mmr': {'lambda': 0.5, 'fetch_k': 20}}) == request_variant(
+        {'mmr': {'fetch_k': 20, 'lambda': 0.5}})
+
+
+def test_ring_buffer_overwrites_oldest_entry():
+    cache = IndexAnswerCache(dimension=2, capacity=2, generation=0)
+    cache.store(unit(1, 0), 'v', 'first', ttl=60)
+    cache.store(unit(0, 1), 'v', 'second', ttl=60)
+    cache.store(unit(1, 1), 'v', 'third', ttl=60)
+    assert cache.size == 2
+    assert cache.lookup(unit(1, 0), 'v', threshold=0.99)[0] is None
+    assert cache.lookup(unit(0, 1), 'v', threshold=0.99)[0] == 'second'
+    assert cache.lookup(unit(1, 1), 'v', threshold=0.99)[0] == 'third'
+
+
+def test_lookup_matches_variant_and_skips_expired_entries():
+    cache = IndexAnswerCache(dimension=2, capacity=4, generation=0)
+    cache.store(unit(1, 0), 'a', 'expired', ttl=-1)
+    cache.store(unit(1, 0.1), 'b', 'other options', ttl=60)
+    assert cache.lookup(unit(1, 0), 'a', threshold=0.9)[0] is None
+    entry, similarity = cache.lookup(unit(1, 0), 'b', threshold=0.9)
+    assert entry == 'other options' and 0.99 < similarity < 1
+
+
+def test_answer_cache_hits_and_stats():
+    cache, index_id = AnswerCache(threshold=0.95, capacity=8, ttl=60), next(index_ids)
+    generation = cache.generation(index_id)
+    assert cache.lookup(index_id, 'docs', [3, 4], 'v', generation)[0] is None
+    cache.store(index_id, [3, 4], 'v', {'answer': 'yes'}, 0.5, generation)
+    entry, similarity = cache.lookup(index_id, 'docs', [6, 8.1], 'v', generation)
+    assert entry == {'payload': {'answer': 'yes'}, 'seconds': 0.5}
+    assert similarity > 0.99
+    assert cache.stats(index_id) == {'entries': 1, 'hits': 1, 'misses': 1, 'hit_rate': 0.5,
+                                     'seconds_saved': 0.5}
+
+
+def test_invalidate_drops_entries_and_stale_stores():
+    cache, index_id = AnswerCache(threshold=0.95, capacity=8, ttl=60), next(index_ids)
+    generation = cache.generation(index_id)
+    cache.store(index_id, [1, 0], 'v', {'answer': 'old'}, 0.1, generation)
+    cache.invalidate(index_id)
+    assert cache.generation(index_id) == generation + 1
+
+    # An answer computed before the files changed is not kept
+    cache.store(index_id, [1, 0], 'v', {'answer': 'stale'}, 0.1, generation)
+    assert cache.lookup(index_id, 'docs', [1, 0], 'v', generation + 1)[0] is None
+    assert cache.stats(index_id)['entries'] == 0
+
+
+def test_disabled_when_threshold_or_size_is_zero():
+    assert not AnswerCache(threshold=0).enabled
+    assert not AnswerCache(capacity=0).enabled
+    assert AnswerCache(threshold=0.9, capacity=1).enabled
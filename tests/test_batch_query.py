@@ -0,0 +1,47 @@
+import pytest
+
+import batch_query
+from batch_query import parse_batch
+
+CONFIG = {'CONTEXT_TOKEN_BUDGET': 3000, 'MMR_LAMBDA': 0.5, 'MMR_MAX_PER_FILE': None}
+
+
+def test_queries_inherit_shared_options_and_override_them():
+    answer, items = parse_batch({'queries': ['What is due?', {'query': 'Who grades it?', 'top_k': 3}],
+                                 'top_k': 7, 'filters': {'mime_types': 'application/pdf'},
+                                 'answer': False}, CONFIG)
+    assert answer is False
+    assert [(item.position, item.query, item.request.top_k) for item in items] == [
+        (0, 'What is due?', 7), (1, 'Who grades it?', 3)]
+    assert all(item.request.filters == {'mime_types': ['application/pdf']} for item in items)
+    assert items[0].request.variant != items[1].request.variant
+
+
+def test_bad_queries_are_reported_on_their_item_only():
+    _, items = parse_batch({'queries': ['fine', 42, {'query': ''}, {'query': 'q', 'top_k': 0}]}, CONFIG)
+    assert items[0].error is None
+    assert items[1].error == 'Each query must be a string or an object'
+    assert items[2].error == 'Query is required'
+    assert items[3].error.startswith("'top_k' must be an integer")
+
+
+def test_shared_option_errors_apply_to_every_query():
+    _, items = parse_batch({'queries': ['a', 'b'], 'filters': {'bogus': 1}}, CONFIG)
+    assert [item.error for item in items] == ['Unknown filters: bogus'] * 2
+
+
+@pytest.mark.parametrize('data, message', [
+    (None, "'queries' must be a non-empty list"),
+    ({'queries': []}, "'queries' must be a non-empty list"),
+    ({'queries': 'one'}, "'queries' must be a non-empty list"),
+    ({'queries': ['a'], 'answer': 'no'}, "'answer' must be true or false"),
+])
+def test_invalid_batches_are_rejected(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_batch(data, CONFIG)
+
+
+def test_batch_size_is_capped(monkeypatch):
+    monkeypatch.setattr(batch_query, 'MAX_BATCH_QUERIES', 2)
+    with pytest.raises(ValueError, match='at most 2 queries'):
+        parse_batch({'queries': ['a', 'b', 'c']}, CONFIG)
@@ -0,0 +1,55 @@
+import codecs
+
+import extractors
+from extractors import (extract_text_from_file, extract_legacy_doc_text, extract_text_cached,
+                        get_extractor, load_cached_text)
+
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_get_extractor_falls_back_to_wildcard():
+    assert get_extractor('text/markdown') is get_extractor('text/plain')
+    assert get_extractor('image/png') is None
+    assert get_extractor(None) is None
+
+
+def test_plain_text_encodings(tmp_path):
+    text = "Café déjà vu – naïve"
+    assert extract_text_from_file(write(tmp_path / 'a.txt', text.encode('utf-8')), 'text/plain') == text
+    assert extract_text_from_file(write(tmp_path / 'b.txt', codecs.BOM_UTF16_LE + text.encode('utf-16-le')),
+                                  'text/plain') == text
+    assert extract_text_from_file(write(tmp_path / 'c.txt', text.encode('cp1252')), 'text/plain') == text
+    assert extract_text_from_file(write(tmp_path / 'd.txt', b''), 'text/plain') == ''
+
+
+def test_plain_text_split_across_blocks(tmp_path, monkeypatch):
+    monkeypatch.setattr(extractors, 'READ_BLOCK_SIZE', 3)
+    text = "€uro ünïcode"
+    assert extract_text_from_file(write(tmp_path / 'a.txt', text.encode('utf-8')), 'text/plain') == text
+
+
+def test_legacy_doc_scraping_keeps_words_only(tmp_path, monkeypatch):
+    monkeypatch.setattr(extractors.shutil, 'which', lambda name: None)
+    data = (b'\xd0\xcf\x11\xe0' + b'\xff' * 64 + b'\x00' * 16 + b'12345678 %%%%%%%%'
+            + b'\x01\x02' + 'Résumé of the quarterly report'.encode('cp1252') + b'\x00\xff\xfe')
+    text = "".join(extract_legacy_doc_text(write(tmp_path / 'a.doc', data)))
+    assert text == 'Résumé of the quarterly report'
+
+
+def test_legacy_doc_scraping_prefers_utf16(tmp_path, monkeypatch):
+    monkeypatch.setattr(extractors.shutil, 'which', lambda name: None)
+    data = b'\x00' * 8 + 'Minutes of the annual meeting'.encode('utf-16-le') + b'\xff' * 8
+    text = "".join(extract_legacy_doc_text(write(tmp_path / 'a.doc', data)))
+    assert text == 'Minutes of the annual meeting'
+
+
+def test_extracted_text_is_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(extractors, 'TEXT_CACHE_DIR', str(tmp_path / 'cache'))
+    path = write(tmp_path / 'a.txt', b'cached text')
+    assert extract_text_cached(path, 'text/plain', 'ab' * 32) == 'cached text'
+    (tmp_path / 'a.txt').write_bytes(b'changed')
+    assert extract_text_cached(path, 'text/plain', 'ab' * 32) == 'cached text'
+    assert load_cached_text('cd' * 32) is None
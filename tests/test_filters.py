@@ -0,0 +1,97 @@
+from datetime import datetime
+
+import pytest
+
+import filters
+import models
+from database import db
+from filters import parse_filters, resolve_filters
+
+
+@pytest.fixture
+def index(app):
+    index = models.PineconeIndex(name='docs')
+    db.session.add(index)
+    db.session.commit()
+    return index
+
+
+def add_file(index, number, mime_type='application/pdf', content_hash=None, vector_id=None,
+             uploaded_at=datetime(2024, 6, 1)):
+    file = models.File(filename=f'file{number}.pdf', filepath=f'uploads/file{number}', mime_type=mime_type,
+                       processed=True, index_id=index.id, uploaded_at=uploaded_at, vector_id=vector_id,
+                       content_hash=content_hash if content_hash is not None else f'{number:064x}')
+    db.session.add(file)
+    return file
+
+
+def test_parse_filters_normalises_values():
+    parsed = parse_filters({'file_ids': 3, 'mime_types': ['image/*'], 'uploaded_after': '2024-01-01T00:00:00+02:00',
+                            'uploaded_before': 1735689600})
+    assert parsed == {'file_ids': [3], 'mime_types': ['image/*'],
+                      'uploaded_after': datetime(2023, 12, 31, 22), 'uploaded_before': datetime(2025, 1, 1)}
+    assert parse_filters({'filenames': 'a.pdf'}) == {'filenames': ['a.pdf']}
+    assert parse_filters(None) is None
+    assert parse_filters({}) is None
+
+
+@pytest.mark.parametrize('raw, message', [
+    ([1], "'filters' must be an object"),
+    ({'folder': 'x'}, 'Unknown filters: folder'),
+    ({'file_ids': []}, "'file_ids' must be a non-empty list of int values"),
+    ({'file_ids': [True]}, "'file_ids' must be a non-empty list of int values"),
+    ({'uploaded_after': 'yesterday'}, "'uploaded_after' must be an ISO 8601 date"),
+    ({'uploaded_after': '2024-02-01', 'uploaded_before': '2024-01-01'}, 'must not be later'),
+])
+def test_parse_filters_rejects_bad_input(raw, message):
+    with pytest.raises(ValueError, match=message):
+        parse_filters(raw)
+
+
+def test_resolve_filters_matches_content_hashes(index):
+    first = add_file(index, 1)
+    add_file(index, 2, mime_type='image/png', uploaded_at=datetime(2023, 1, 1))
+    add_file(index, 3, content_hash=f'{1:064x}')  # Same bytes as file 1
+    add_file(index, 4, content_hash='', vector_id='file_4')  # Uploaded before hashing
+    db.session.commit()
+
+    vector_filter, stats = resolve_filters({'mime_types': ['application/*']}, index)
+    assert vector_filter == {'$or': [{'content_hash': {'$in': [f'{1:064x}']}},
+                                     {'parent_file': {'$in': ['file_4']}}]}
+    assert stats == {'files': 3, 'content_hashes': 1, 'mode': 'content_hash'}
+
+    vector_filter, _ = resolve_filters({'file_ids': [first.id]}, index)
+    assert vector_filter == {'content_hash': {'$in': [f'{1:064x}']}}
+
+    vector_filter, stats = resolve_filters({'uploaded_before': datetime(2022, 1, 1)}, index)
+    assert vector_filter is None
+    assert stats['mode'] == 'empty'
+
+
+def test_resolve_filters_splits_long_hash_lists(index, monkeypatch):
+    monkeypatch.setattr(filters, 'MAX_FILTER_VALUES', 2)
+    for number in range(5):
+        add_file(index, number + 1)
+    db.session.commit()
+
+    vector_filter, stats = resolve_filters({'filenames': [f'file{n}.pdf' for n in range(1, 6)]}, index)
+    assert stats['mode'] == 'content_hash'
+    assert [len(condition['content_hash']['$in']) for condition in vector_filter['$or']] == [2, 2, 1]
+    assert sorted(h for c in vector_filter['$or'] for h in c['content_hash']['$in']) == [
+        f'{n:064x}' for n in range(1, 6)]
+
+
+def test_resolve_filters_pushes_down_exact_mime_types_only(index, monkeypatch):
+    monkeypatch.setattr(filters, 'MAX_FILTER_VALUES', 2)
+    for number in range(3):
+        add_file(index, number + 1)
+    db.session.commit()
+
+    vector_filter, stats = resolve_filters({'mime_types': ['application/pdf']}, index)
+    assert (vector_filter, stats['mode']) == ({'mime_type': {'$in': ['application/pdf']}}, 'metadata')
+
+    for raw in ({'mime_types': ['application/*']},
+                {'mime_types': ['application/pdf'], 'uploaded_after': datetime(2024, 1, 1)}):
+        vector_filter, stats = resolve_filters(raw, index)
+        assert stats['mode'] == 'content_hash'
+        assert 'mime_type' not in str(vector_filter)
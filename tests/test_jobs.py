@@ -0,0 +1,66 @@
+import threading
+import uuid
+
+import pytest
+
+from jobs import (JobScheduler, JobCancelled, BULK_LANE, INTERACTIVE_LANE, BULK_UPLOAD_BYTES, upload_lane,
+                  cancel_job, check_cancelled, set_job_state, job_state)
+
+
+def test_upload_lane_by_request_or_size():
+    assert upload_lane(BULK_LANE, 1) == BULK_LANE
+    assert upload_lane(None, BULK_UPLOAD_BYTES) == INTERACTIVE_LANE
+    assert upload_lane('urgent', BULK_UPLOAD_BYTES + 1) == BULK_LANE
+
+
+def test_interactive_jobs_start_before_queued_bulk_jobs():
+    scheduler = JobScheduler(workers=1, bulk_workers=1)
+    started, gate, order = threading.Event(), threading.Event(), []
+
+    def block():
+        started.set()
+        gate.wait(5)
+
+    scheduler.submit('blocker', BULK_LANE, block)
+    started.wait(5)
+    jobs = [scheduler.submit(name, lane, order.append, name)
+            for name, lane in (('bulk', BULK_LANE), ('interactive', INTERACTIVE_LANE))]
+    gate.set()
+    for job in jobs:
+        job.wait(5)
+    assert order == ['interactive', 'bulk']
+
+
+def test_bulk_jobs_leave_workers_for_interactive_ones():
+    scheduler = JobScheduler(workers=2, bulk_workers=1)
+    gate, ran = threading.Event(), threading.Event()
+    bulk = [scheduler.submit(f'bulk{i}', BULK_LANE, gate.wait, 5) for i in range(2)]
+    interactive = scheduler.submit('small', INTERACTIVE_LANE, ran.set)
+    assert ran.wait(5)  # Ran while both bulk jobs were still queued or running
+    assert scheduler.queued(BULK_LANE) == 1
+    gate.set()
+    for job in bulk + [interactive]:
+        job.wait(5)
+
+
+def test_job_wait_reraises_the_job_error():
+    scheduler = JobScheduler(workers=1)
+
+    def fail():
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError, match='broken'):
+        scheduler.submit('failing', INTERACTIVE_LANE, fail).wait(5)
+
+
+def test_cancellation_and_job_state():
+    job_id = uuid.uuid4().hex
+    check_cancelled(job_id)
+    set_job_state(job_id, 'queued', filename='a.pdf')
+    set_job_state(job_id, 'processing')
+    assert job_state(job_id)['state'] == 'processing'
+    assert job_state(job_id)['filename'] == 'a.pdf'
+    cancel_job(job_id)
+    with pytest.raises(JobCancelled):
+        check_cancelled(job_id)
+    check_cancelled(None)
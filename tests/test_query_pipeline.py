@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+from query_pipeline import (parse_query, query_steps, search_steps, Embed, Complete, Search, Blocking,
+                            Log, MAX_TOP_K)
+
+CONFIG = {'CONTEXT_TOKEN_BUDGET': 3000, 'MMR_LAMBDA': 0.5, 'MMR_MAX_PER_FILE': None}
+
+
+def completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                           usage=None)
+
+
+def embedding(vector):
+    return SimpleNamespace(data=[SimpleNamespace(embedding=vector, index=0)], usage=None)
+
+
+def drive(steps, matches=()):
+    """Run pipeline steps against canned responses; returns (payload, steps seen)"""
+    seen = []
+    result = None
+    while True:
+        try:
+            step = steps.send(result)
+        except StopIteration as done:
+            return done.value, seen
+        seen.append(step)
+        if isinstance(step, Embed):
+            result = embedding([1.0, 0.0])
+        elif isinstance(step, Complete):
+            result = completion('terms' if step.model == 'gpt-4o-mini' else 'the answer')
+        elif isinstance(step, Search):
+            result = list(matches)
+        elif isinstance(step, Blocking):
+            result = {}
+        else:
+            result = None
+
+
+def match(id, text):
+    return SimpleNamespace(id=id, score=0.9, values=None,
+                           metadata={'parent_file': id, 'filename': f'{id}.txt', 'chunk_index': 0,
+                                     'text_content': text, 'text_truncated': False})
+
+
+def test_parse_query_fills_defaults():
+    query = parse_query({'query': 'What is due?', 'mmr': True, 'cache': False}, CONFIG)
+    assert (query.top_k, query.context_token_budget, query.additional_context) == (5, 3000, '')
+    assert query.mmr == {'fetch_k': None, 'lambda': 0.5, 'max_per_file': None}
+    assert query.use_cache is False
+    assert query.extract_terms is True
+    assert parse_query({'query': 'q', 'mmr': {'enabled': False}}, CONFIG).mmr == {}
+    assert parse_query({'query': 'q', 'mmr': {'lambda': 1, 'fetch_k': 50, 'max_per_file': 2}}, CONFIG).mmr == {
+        'fetch_k': 50, 'lambda': 1.0, 'max_per_file': 2}
+
+
+@pytest.mark.parametrize('data, message', [
+    (['not', 'an', 'object'], 'Query is required'),
+    ({'query': '  '}, 'Query is required'),
+    ({'query': 'q', 'top_k': 0}, "'top_k' must be an integer"),
+    ({'query': 'q', 'top_k': MAX_TOP_K + 1}, "'top_k' must be an integer"),
+    ({'query': 'q', 'top_k': True}, "'top_k' must be an integer"),
+    ({'query': 'q', 'context_token_budget': 'lots'}, "'context_token_budget' must be a positive integer"),
+    ({'query': 'q', 'context_token_budget': 0}, "'context_token_budget' must be a positive integer"),
+    ({'query': 'q', 'context_token_budget': -50}, "'context_token_budget' must be a positive integer"),
+    ({'query': 'q', 'filters': {'bogus': 1}}, 'Unknown filters'),
+    ({'query': 'q', 'mmr': {'lambda': None}}, "'mmr.lambda' must be a number from 0 to 1"),
+    ({'query': 'q', 'mmr': {'lambda': 1.5}}, "'mmr.lambda' must be a number from 0 to 1"),
+    ({'query': 'q', 'mmr': {'max_per_file': '2'}}, "'mmr.max_per_file' must be a positive integer"),
+    ({'query': 'q', 'mmr': {'fetch_k': 0}}, "'mmr.fetch_k' must be a positive integer"),
+])
+def test_parse_query_rejects_bad_fields(data, message):
+    with pytest.raises(ValueError, match=message):
+        parse_query(data, CONFIG)
+
+
+def test_query_steps_extract_search_and_answer():
+    query = parse_query({'query': 'What is due?', 'cache': False}, CONFIG)
+    payload, seen = drive(query_steps(query, 1, 'docs'), [match('file_a', 'Due Friday.')])
+
+    assert payload['answer'] == 'the answer'
+    assert payload['contexts'] == [{'id': 'file_a', 'score': 0.9, 'text': 'Due Friday.'}]
+    assert payload['cache'] is None
+    kinds = [type(step).__name__ for step in seen if not isinstance(step, Log)]
+    assert kinds == ['Complete', 'Embed', 'Search', 'Complete']
+    assert seen[[type(s) for s in seen].index(Embed)].texts == ['terms']
+    assert any(isinstance(step, Log) and step.message.startswith('Context uses') for step in seen)
+
+
+def test_query_steps_without_search_terms_skip_the_search():
+    query = parse_query({'query': 'hello', 'cache': False}, CONFIG)
+    steps = query_steps(query, 1, 'docs')
+    assert isinstance(next(steps), Complete)
+    step = steps.send(completion('""'))
+    assert isinstance(step, Log) and step.message.startswith('No search terms found')
+    with pytest.raises(StopIteration) as done:
+        steps.send(None)
+    assert done.value.value == {'answer': '', 'contexts': []}
+
+
+def test_search_steps_without_answer_skip_the_completion():
+    query = parse_query({'query': 'What is due?', 'top_k': 3}, CONFIG)
+    payload, seen = drive(search_steps(query, 'docs', [1.0, 0.0], answer=False),
+                          [match('file_a', 'Due Friday.')])
+    assert payload['answer'] is None
+    assert len(payload['contexts']) == 1
+    assert not any(isinstance(step, Complete) for step in seen)
+    assert next(step for step in seen if isinstance(step, Search)).top_k == 3
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from ratelimit import (TokenBucket, RateLimiter, INTERACTIVE, BACKGROUND, estimate_tokens,
+                       parse_retry_after)
+
+
+def test_token_bucket_waits_and_refills():
+    bucket = TokenBucket(60)  # One unit per second
+    now = bucket.updated
+    assert bucket.wait_time(60, now) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1, now) == 1.0
+    assert bucket.wait_time(1, now + 0.5) == 0.5
+    assert bucket.wait_time(1, now + 1) == 0
+    assert bucket.wait_time(1, now + 600) == 0 and bucket.available == 60  # Never above capacity
+
+
+def test_token_bucket_request_above_capacity_waits_for_full_bucket():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    bucket.take(30)
+    assert bucket.wait_time(500, now) == 30.0
+
+
+def test_token_bucket_resize_clamps_available():
+    bucket = TokenBucket(100)
+    bucket.resize('50', '20')
+    assert (bucket.capacity, bucket.available) == (50, 20)
+    bucket.resize(0)
+    assert bucket.capacity == 50
+
+
+def test_estimate_tokens_and_retry_after():
+    assert estimate_tokens('a' * 40, None, completion=10) == 11 + 1 + 10
+    assert parse_retry_after({'retry-after-ms': '1500', 'retry-after': '9'}) == 1.5
+    assert parse_retry_after({'retry-after': '2'}) == 2.0
+    assert parse_retry_after({'retry-after': 'soon'}) is None
+    assert parse_retry_after(None) is None
+
+
+def test_interactive_callers_overtake_queued_background_work():
+    limiter = RateLimiter('test', rpm=10000, tpm=10 ** 6, max_concurrency=1)
+    order = []
+
+    def call(name, priority):
+        with limiter.acquire(1, priority):
+            order.append(name)
+
+    with limiter.acquire(1, BACKGROUND):
+        threads = []
+        for name, priority in (('background', BACKGROUND), ('interactive', INTERACTIVE)):
+            threads.append(threading.Thread(target=call, args=(name, priority)))
+            threads[-1].start()
+            while len(limiter._waiting) < len(threads):
+                time.sleep(0.001)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['interactive', 'background']
+
+
+def test_rate_limit_halves_concurrency_and_success_restores_it():
+    limiter = RateLimiter('test', max_concurrency=8)
+    limiter.on_rate_limited(0)
+    limiter.on_rate_limited(0)
+    assert limiter.concurrency == 2
+    for _ in range(100):
+        limiter.on_success()
+    assert limiter.concurrency == 8
+
+
+def test_observe_headers_adopts_reported_limits():
+    limiter = RateLimiter('test', rpm=500, tpm=200000)
+    limiter.observe_headers({'x-ratelimit-limit-requests': '100', 'x-ratelimit-remaining-requests': '7',
+                             'x-ratelimit-limit-tokens': 'bogus'})
+    assert (limiter.requests.capacity, limiter.requests.available) == (100, 7)
+    assert limiter.tokens.capacity == 200000
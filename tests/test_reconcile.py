@@ -0,0 +1,188 @@
+import io
+import os
+import time
+from datetime import datetime, timedelta
+
+import hashlib
+
+import models
+from database import db
+from storage import acquire_blob, content_path, vector_base_id
+
+HOUR = timedelta(hours=1)
+
+
+def upload(ctx, data, filename='notes.txt'):
+    response = ctx.client.post('/upload', data={'file': (io.BytesIO(data), filename),
+                                                'index_id': str(ctx.index_id)},
+                               content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return db.session.query(models.File).order_by(models.File.id.desc()).first()
+
+
+def age(content_hash, blob_age=2 * HOUR, file_age=2 * HOUR):
+    """Backdate a blob's last reference change and the upload time of its files"""
+    now = datetime.utcnow()
+    db.session.query(models.FileBlob).filter_by(content_hash=content_hash).update(
+        {models.FileBlob.created_at: now - blob_age, models.FileBlob.updated_at: now - blob_age})
+    db.session.query(models.File).filter_by(content_hash=content_hash).update(
+        {models.File.uploaded_at: now - file_age})
+    db.session.commit()
+
+
+def blob_for(content_hash):
+    return db.session.query(models.FileBlob).filter_by(content_hash=content_hash).populate_existing().one_or_none()
+
+
+def reconciler():
+    import reconcile  # Imports the app, which needs the stub servers
+    return reconcile.Reconciler
+
+
+def reconcile_pass(apply=True):
+    return reconciler()(apply=apply, grace=HOUR.total_seconds()).run()
+
+
+def vectors(ctx):
+    return ctx.pinecone.vectors.setdefault('bench-index', {})
+
+
+def add_vectors(ctx, base, uploaded_at, count=2):
+    ctx.app.pinecone_client.Index('bench-index').upsert(vectors=[
+        {'id': f'{base}_chunk_{i}', 'values': [0.1] * 1536, 'metadata': {'uploaded_at': uploaded_at}}
+        for i in range(count)])
+
+
+def unprocessed_file(ctx, data, filename='pending.txt'):
+    """A stored blob whose File row is committed but not processed yet, as mid-upload"""
+    content_hash = hashlib.sha256(data).hexdigest()
+    file_path = content_path(ctx.app.app.config['UPLOAD_FOLDER'], content_hash, filename)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, 'wb') as file:
+        file.write(data)
+    acquire_blob(content_hash, file_path, len(data), 'text/plain')
+    file = models.File(filename=filename, filepath=file_path, mime_type='text/plain', processed=False,
+                       index_id=ctx.index_id, content_hash=content_hash)
+    db.session.add(file)
+    db.session.commit()
+    return file
+
+
+def test_in_flight_reference_is_not_counted_away(live_app):
+    file = upload(live_app, b'counted while uploading')
+    age(file.content_hash)
+    # A second upload of the same bytes has taken its reference but not committed its row
+    acquire_blob(file.content_hash, file.filepath, 1, 'text/plain')
+
+    report = reconcile_pass()
+    assert report['ref_count_drift'] == 0
+    assert blob_for(file.content_hash).ref_count == 2
+
+    # Once the grace period has passed without progress the reference counts as leaked
+    age(file.content_hash)
+    report = reconcile_pass()
+    assert report['ref_count_drift'] == 1
+    assert blob_for(file.content_hash).ref_count == 1
+    assert os.path.exists(file.filepath)
+
+
+def test_count_fix_does_not_overwrite_a_concurrent_acquire(live_app, monkeypatch):
+    file = upload(live_app, b'raced by an upload')
+    db.session.query(models.FileBlob).update({models.FileBlob.ref_count: 3})
+    age(file.content_hash)
+    scan = reconciler()._blobs
+
+    def racing_blobs(self):
+        yield from scan(self)
+        acquire_blob(file.content_hash, file.filepath, 1, 'text/plain')  # After the read, before the fix
+
+    monkeypatch.setattr(reconciler(), '_blobs', racing_blobs)
+    report = reconcile_pass()
+    assert report['ref_count_drift'] == 1
+    assert blob_for(file.content_hash).ref_count == 4
+
+
+def test_unreferenced_blob_survives_a_concurrent_acquire(live_app, monkeypatch):
+    file = upload(live_app, b'deleted while uploaded again')
+    db.session.delete(db.session.get(models.File, file.id))
+    db.session.commit()
+    age(file.content_hash)
+    scan = reconciler()._blobs
+
+    def racing_blobs(self):
+        yield from scan(self)
+        acquire_blob(file.content_hash, file.filepath, 1, 'text/plain')
+
+    monkeypatch.setattr(reconciler(), '_blobs', racing_blobs)
+    assert reconcile_pass()['unreferenced_blobs'] == 1
+    assert blob_for(file.content_hash).ref_count == 2
+    assert os.path.exists(file.filepath)
+
+    # Without the race the unreferenced blob and its bytes go
+    monkeypatch.setattr(reconciler(), '_blobs', scan)
+    db.session.query(models.FileBlob).update({models.FileBlob.ref_count: 1})
+    age(file.content_hash)
+    reconcile_pass()
+    assert blob_for(file.content_hash) is None
+    assert not os.path.exists(file.filepath)
+
+
+def test_orphaned_vectors_are_deleted_but_uploads_keep_theirs(live_app):
+    kept = upload(live_app, b'a processed file')
+    long_upload = unprocessed_file(live_app, b'an upload that outlasts the grace period')
+    # Its row and first chunks are old, but it reported progress a moment ago
+    age(long_upload.content_hash, blob_age=timedelta(0), file_age=3 * HOUR)
+    add_vectors(live_app, vector_base_id(long_upload.content_hash), uploaded_at=time.time() - 3 * 3600)
+    add_vectors(live_app, 'file_dead', uploaded_at=time.time() - 3 * 3600)
+    add_vectors(live_app, 'file_fresh', uploaded_at=time.time())
+
+    dry_run = reconcile_pass(apply=False)
+    assert dry_run['indexes']['bench-index']['orphaned_vectors'] == 2
+    kept_ids = list(vectors(live_app))
+
+    report = reconcile_pass()
+    assert report['indexes']['bench-index']['orphaned_vector_sample'] == ['file_dead_chunk_0', 'file_dead_chunk_1']
+    assert report['stale_unprocessed_files'] == 0
+    assert sorted(vectors(live_app)) == sorted(i for i in kept_ids if not i.startswith('file_dead'))
+    assert not db.session.get(models.File, long_upload.id).processed
+
+
+def test_stale_unprocessed_files_are_settled(live_app):
+    repaired = unprocessed_file(live_app, b'vectors made it, the commit did not', 'repaired.txt')
+    dangling = unprocessed_file(live_app, b'bytes are gone', 'dangling.txt')
+    unsearchable = unprocessed_file(live_app, b'nothing to embed', 'unsearchable.txt')
+    for file in (repaired, dangling, unsearchable):
+        age(file.content_hash)
+    add_vectors(live_app, vector_base_id(repaired.content_hash), uploaded_at=time.time() - 2 * 3600)
+    os.remove(dangling.filepath)
+    dangling_hash = dangling.content_hash
+
+    report = reconcile_pass()
+    assert (report['stale_unprocessed_files'], report['repaired_files'], report['dangling_files'],
+            report['unsearchable_files']) == (3, 1, 1, 1)
+    repaired = db.session.get(models.File, repaired.id)
+    assert repaired.processed and repaired.vector_id == vector_base_id(repaired.content_hash)
+    assert db.session.get(models.File, dangling.id) is None
+    assert blob_for(dangling_hash) is None
+    assert not db.session.get(models.File, unsearchable.id).processed
+
+
+def test_filesystem_pass_removes_old_unreferenced_files_only(live_app, monkeypatch):
+    kept = upload(live_app, b'still referenced')
+    monkeypatch.setattr('reconcile.TEXT_CACHE_DIR', 'text_cache')
+    folder = live_app.app.app.config['UPLOAD_FOLDER']
+    old = time.time() - 2 * 3600
+    strays = [os.path.join(folder, 'ab', 'stray.pdf'), os.path.join('static', 'thumbnails', 'thumb_stray.jpg'),
+              os.path.join('text_cache', 'ab', 'ab' * 32 + '.v1.txt.gz')]
+    fresh = os.path.join(folder, 'fresh.pdf')
+    for path in strays + [fresh]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write('x')
+    for path in strays + [kept.filepath]:
+        os.utime(path, (old, old))
+
+    report = reconcile_pass()
+    assert (report['orphaned_uploads'], report['orphaned_thumbnails'], report['orphaned_cached_text']) == (1, 1, 1)
+    assert not any(os.path.exists(path) for path in strays)
+    assert os.path.exists(fresh) and os.path.exists(kept.filepath)
@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+from retrieval import (build_segments, build_context, strip_overlap, count_tokens, mmr_settings,
+                       mmr_fetch_k, select_mmr, MAX_TOP_K)
+
+
+def match(chunk_index, text, score=0.5, parent='file_a', truncated=False, **metadata):
+    metadata = {'parent_file': parent, 'filename': f'{parent}.txt', 'chunk_index': chunk_index,
+                'text_content': text, **metadata}
+    if truncated is not None:
+        metadata['text_truncated'] = truncated
+    return SimpleNamespace(id=f'{parent}_chunk_{chunk_index}', score=score, metadata=metadata, values=None)
+
+
+def test_consecutive_whole_chunks_merge_into_one_segment():
+    segments = build_segments([match(1, 'second part.', 0.9), match(0, 'First part,', 0.4)])
+    assert len(segments) == 1
+    assert (segments[0].first_chunk, segments[0].last_chunk, segments[0].score) == (0, 1, 0.9)
+    assert segments[0].text == 'First part, second part.'
+
+
+def test_gap_between_chunks_starts_a_new_segment():
+    segments = build_segments([match(0, 'one'), match(2, 'three')])
+    assert [(s.first_chunk, s.last_chunk) for s in segments] == [(0, 0), (2, 2)]
+
+
+def test_truncated_chunk_is_not_joined_to_the_next():
+    legacy = 'x' * 1000
+    segments = build_segments([match(0, legacy, truncated=None), match(1, 'y' * 1000, truncated=None),
+                               match(2, 'tail', truncated=None)])
+    assert [(s.first_chunk, s.last_chunk) for s in segments] == [(0, 0), (1, 1), (2, 2)]
+
+    # A short legacy chunk was stored whole, so the next one may follow it
+    segments = build_segments([match(0, 'short', truncated=None), match(1, legacy, truncated=None)])
+    assert [(s.first_chunk, s.last_chunk) for s in segments] == [(0, 1)]
+
+
+def test_duplicate_matches_are_dropped():
+    segments = build_segments([match(0, 'same  text'), match(0, 'same text'),
+                               match(4, 'same text', parent='file_b')])
+    assert len(segments) == 1
+
+
+def test_strip_overlap_removes_repeated_prefix():
+    repeated = 'the shared sentence between chunks'
+    assert strip_overlap(f'intro {repeated}', f'{repeated} and more') == 'and more'
+    assert strip_overlap('no overlap here', 'at all') == 'at all'
+
+
+def test_tokens_saved_counts_only_deduplicated_text():
+    matches = [match(0, 'a' * 400, 0.9), match(0, 'a' * 400, 0.8), match(3, 'b' * 400, 0.1, parent='file_b')]
+    _, stats = build_context(matches, token_budget=150)
+    assert stats['segments'] == 2
+    assert stats['segments_included'] == 1
+    # Only the repeated chunk counts, not file_b's segment left out for the budget
+    assert stats['tokens_saved'] == stats['naive_tokens'] - count_tokens(f"{'a' * 400} {'b' * 400}")
+
+
+def test_context_fills_budget_best_score_first():
+    matches = [match(0, 'low ' * 50, 0.1, parent='file_b'), match(0, 'high', 0.9)]
+    context, stats = build_context(matches, token_budget=20)
+    assert context == '[file_a.txt]\nhigh'
+    assert stats['segments_included'] == 1
+
+
+def test_mmr_settings():
+    assert mmr_settings(True) == {'enabled': True}
+    assert mmr_settings({'lambda': 0.3}) == {'lambda': 0.3, 'enabled': True}
+    assert mmr_settings({'enabled': False, 'lambda': 0.3}) == {}
+    assert mmr_settings(False) == {}
+    assert mmr_settings(None) == {}
+    assert mmr_settings('yes') == {}
+
+
+def test_mmr_fetch_k_stays_within_pinecone_limit():
+    assert mmr_fetch_k(2) == 20
+    assert mmr_fetch_k(10) == 40
+    assert mmr_fetch_k(10, fetch_k=100) == 100
+    assert mmr_fetch_k(MAX_TOP_K) == MAX_TOP_K
+    assert mmr_fetch_k(5, fetch_k=50000) == MAX_TOP_K
+
+
+def vector_match(id, values, parent, score=0.0):
+    return SimpleNamespace(id=id, score=score, values=values, metadata={'parent_file': parent})
+
+
+def test_select_mmr_prefers_diverse_results():
+    matches = [vector_match('a1', [1.0, 0.0], 'a'), vector_match('a2', [0.99, 0.01], 'a'),
+               vector_match('b1', [0.7, 0.7], 'b')]
+    selected, stats = select_mmr(matches, [1.0, 0.0], top_k=2, lambda_mult=0.3)
+    assert [match.id for match in selected] == ['a1', 'b1']
+    assert stats['candidates'] == 3
+    assert stats['files'] == 2
+
+    selected, _ = select_mmr(matches, [1.0, 0.0], top_k=2, lambda_mult=1.0)
+    assert [match.id for match in selected] == ['a1', 'a2']
+
+
+def test_select_mmr_caps_results_per_file():
+    matches = [vector_match('a1', [1.0, 0.0], 'a'), vector_match('a2', [0.99, 0.01], 'a'),
+               vector_match('a3', [0.98, 0.02], 'a'), vector_match('b1', [0.0, 1.0], 'b')]
+    selected, _ = select_mmr(matches, [1.0, 0.0], top_k=3, lambda_mult=1.0, max_per_file=2)
+    assert [match.id for match in selected] == ['a1', 'a2', 'b1']
+
+
+def test_select_mmr_without_values_still_caps_per_file():
+    matches = [vector_match('a1', None, 'a'), vector_match('a2', None, 'a'),
+               vector_match('a3', None, 'a'), vector_match('b1', None, 'b')]
+    selected, stats = select_mmr(matches, [1.0, 0.0], top_k=3, max_per_file=1)
+    assert [match.id for match in selected] == ['a1', 'b1']
+    assert stats['selected'] == 2
@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+import pytest
+
+import jobs
+import answer_cache as answer_cache_module
+from shared_state import MemoryBackend, SQLiteBackend, create_backend
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def backend(request, tmp_path, monkeypatch):
+    backend = MemoryBackend() if request.param == 'memory' else SQLiteBackend(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(jobs, 'shared_state', backend)
+    monkeypatch.setattr(answer_cache_module, 'shared_state', backend)
+    return backend
+
+
+def test_create_backend_by_url(tmp_path):
+    assert isinstance(create_backend('memory://'), MemoryBackend)
+    assert isinstance(create_backend(f"sqlite:///{tmp_path / 'state.db'}"), SQLiteBackend)
+    with pytest.raises(ValueError):
+        create_backend('redis://localhost')
+
+
+def test_values_round_trip_and_expire(backend):
+    assert backend.get('missing', 'default') == 'default'
+    backend.set('status', {'status': 'processing', 'progress': 30.0})
+    assert backend.get('status') == {'status': 'processing', 'progress': 30.0}
+    backend.set('short', True, ttl=0.05)
+    assert backend.get('short') is True
+    time.sleep(0.1)
+    assert backend.get('short') is None
+
+
+def test_updates_from_many_threads_are_not_lost(backend):
+    def bump():
+        for _ in range(25):
+            answer_cache_module.answer_cache.invalidate(7)
+
+    threads = [threading.Thread(target=bump) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert answer_cache_module.answer_cache.generation(7) == 100
+    assert answer_cache_module.answer_cache.generation(8) == 0
+
+
+def test_logs_keep_the_newest_entries_in_order(backend, monkeypatch):
+    monkeypatch.setattr('shared_state.PURGE_INTERVAL', 3)
+    for i in range(10):
+        backend.append_log('api_logs', {'message': f'entry {i}'}, 4)
+    assert [entry['message'] for entry in backend.get_log('api_logs', 4)] == [f'entry {i}' for i in range(6, 10)]
+    assert [entry['message'] for entry in backend.get_log('api_logs', 2)] == ['entry 8', 'entry 9']
+    assert backend.get_log('other', 4) == []
+
+
+def test_job_state_and_cancel_flags(backend):
+    jobs.set_job_state('job', 'queued', filename='notes.txt')
+    jobs.set_job_state('job', 'running')
+    assert jobs.job_state('job')['state'] == 'running'
+    assert jobs.job_state('job')['filename'] == 'notes.txt'
+    assert not jobs.is_cancelled('job')
+    jobs.cancel_job('job')
+    assert jobs.is_cancelled('job')
+    with pytest.raises(jobs.JobCancelled):
+        jobs.check_cancelled('job')
+
+
+def test_sqlite_state_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'state.db')
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+    first.set('upload_cancel:job', True)
+    first.update('generation', lambda g: g + 1, default=0)
+    first.append_log('api_logs', {'message': 'from the first worker'}, 10)
+    assert second.get('upload_cancel:job') is True
+    assert second.update('generation', lambda g: g + 1, default=0) == 2
+    assert second.get_log('api_logs', 10) == [{'message': 'from the first worker'}]
+
+
+def test_log_panel_only_receives_info_and_above(live_app, caplog):
+    caplog.set_level(logging.DEBUG)  # As the app configures the root logger
+    logger = logging.getLogger('test_shared_state')
+    logger.debug('debug detail')
+    logger.info('shown in the panel')
+    messages = [entry['message'] for entry in live_app.app.shared_state.get_log('api_logs', 100)]
+    assert 'shown in the panel' in messages
+    assert 'debug detail' not in messages
@@ -0,0 +1,93 @@
+import io
+
+import click
+import pytest
+
+import models
+from database import db
+
+
+def upload(ctx, data, filename):
+    response = ctx.client.post('/upload', data={'file': (io.BytesIO(data), filename),
+                                                'index_id': str(ctx.index_id)},
+                               content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_data(as_text=True)
+
+
+def snapshots():
+    import snapshots  # Imports the app, which needs the stub servers
+    return snapshots
+
+
+def exported(ctx, tmp_path):
+    upload(ctx, b'first file about due dates', 'first.txt')
+    upload(ctx, b'second file about instructions', 'second.txt')
+    path = str(tmp_path / 'snapshot')
+    stats = snapshots().export_snapshot('bench-index', path, workers=2)
+    assert stats['files'] == 2
+    return path, stats
+
+
+def test_round_trip_restores_vectors_and_rows(live_app, tmp_path):
+    path, stats = exported(live_app, tmp_path)
+    source = live_app.pinecone.vectors['bench-index']
+    assert stats['vectors'] == len(source) > 0
+
+    restored = snapshots().import_snapshot(path, 'bench-copy', workers=2, batch_size=1)
+    assert restored['vectors'] == stats['vectors']
+    assert restored['verification']['ok']
+
+    copy = live_app.pinecone.vectors['bench-copy']
+    assert set(copy) == set(source)
+    for vector_id, (values, _) in source.items():
+        assert copy[vector_id][0] == pytest.approx(values, abs=1e-6)
+    index = db.session.query(models.PineconeIndex).filter_by(name='bench-copy').one()
+    files = db.session.query(models.File).filter_by(index_id=index.id).all()
+    assert sorted(file.filename for file in files) == ['first.txt', 'second.txt']
+    # Each restored file shares the stored bytes of its original
+    for file in files:
+        assert db.session.query(models.FileBlob).filter_by(content_hash=file.content_hash).one().ref_count == 2
+
+
+def test_restored_metadata_points_at_the_new_rows(live_app, tmp_path):
+    path, _ = exported(live_app, tmp_path)
+    originals = {file.filename: file.id for file in db.session.query(models.File).all()}
+    snapshots().import_snapshot(path, 'bench-copy', workers=2)
+
+    index = db.session.query(models.PineconeIndex).filter_by(name='bench-copy').one()
+    restored = {file.id: file.filename for file in db.session.query(models.File).filter_by(index_id=index.id)}
+    assert not set(restored) & set(originals.values())
+    for vector_id, (_, metadata) in live_app.pinecone.vectors['bench-copy'].items():
+        source_metadata = live_app.pinecone.vectors['bench-index'][vector_id][1]
+        assert metadata['index_id'] == index.id
+        assert restored[metadata['file_id']] == metadata['filename']
+        assert originals[metadata['filename']] == source_metadata['file_id']
+
+
+def test_failed_import_leaves_nothing_behind(live_app, tmp_path, monkeypatch):
+    path, _ = exported(live_app, tmp_path)
+    module = snapshots()
+    monkeypatch.setattr(module, 'verify_restore', lambda *args: {'ok': False})
+    files = db.session.query(models.File).count()
+    ref_counts = {blob.content_hash: blob.ref_count for blob in db.session.query(models.FileBlob)}
+
+    with pytest.raises(click.ClickException, match='Verification failed'):
+        module.import_snapshot(path, 'bench-copy', workers=2)
+
+    assert db.session.query(models.PineconeIndex).filter_by(name='bench-copy').first() is None
+    assert db.session.query(models.File).count() == files
+    assert {blob.content_hash: blob.ref_count for blob in db.session.query(models.FileBlob)} == ref_counts
+    assert 'bench-copy' not in live_app.pinecone.indexes
+
+
+def test_import_rejects_a_corrupted_snapshot(live_app, tmp_path):
+    path, _ = exported(live_app, tmp_path)
+    with open(f'{path}/vectors.f32', 'r+b') as vectors_file:
+        first = vectors_file.read(1)
+        vectors_file.seek(0)
+        vectors_file.write(bytes([first[0] ^ 0xff]))
+
+    with pytest.raises(click.ClickException, match='does not match the checksum'):
+        snapshots().import_snapshot(path, 'bench-copy', workers=2)
+    assert 'bench-copy' not in live_app.pinecone.indexes
+    assert db.session.query(models.PineconeIndex).filter_by(name='bench-copy').first() is None
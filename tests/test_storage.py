@@ -0,0 +1,148 @@
+import io
+import os
+import threading
+
+from werkzeug.datastructures import FileStorage
+
+import models
+from database import db
+from storage import (save_stream_hashed, place_blob_file, content_path, acquire_blob, release_blob,
+                     delete_file_row, remove_blob_files)
+
+
+def store(app, data, filename='notes.txt'):
+    """Upload bytes the way upload_file does and return (content_hash, file_path)"""
+    content_hash, temp_path, size = save_stream_hashed(FileStorage(io.BytesIO(data)), 'uploads')
+    file_path = acquire_blob(content_hash, content_path('uploads', content_hash, filename), size, 'text/plain')
+    place_blob_file(temp_path, file_path)
+    return content_hash, file_path
+
+
+def blob_for(content_hash):
+    return db.session.query(models.FileBlob).filter_by(content_hash=content_hash).populate_existing().one_or_none()
+
+
+def test_save_stream_hashed_leaves_bytes_in_temp_file(app):
+    content_hash, temp_path, size = save_stream_hashed(FileStorage(io.BytesIO(b'hello')), 'uploads')
+    assert content_hash == '2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824'
+    assert size == 5
+    with open(temp_path, 'rb') as file:
+        assert file.read() == b'hello'
+
+
+def test_duplicate_upload_shares_bytes(app):
+    content_hash, file_path = store(app, b'same bytes')
+    _, second_path = store(app, b'same bytes', filename='copy.txt')
+    assert second_path == file_path
+    assert blob_for(content_hash).ref_count == 2
+    assert [name for name in os.listdir('uploads') if name.startswith('.upload_')] == []
+
+
+def test_concurrent_uploads_of_same_content_all_take_a_reference(app):
+    errors = []
+
+    def upload():
+        with app.app_context():
+            try:
+                store(app, b'raced bytes')
+            except Exception as e:
+                errors.append(e)
+            finally:
+                db.session.remove()
+
+    threads = [threading.Thread(target=upload) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    blobs = db.session.query(models.FileBlob).all()
+    assert len(blobs) == 1
+    assert blobs[0].ref_count == 8
+
+
+def test_release_keeps_bytes_until_last_reference(app):
+    content_hash, file_path = store(app, b'shared')
+    store(app, b'shared')
+
+    assert release_blob(content_hash) is False
+    db.session.commit()
+    assert os.path.exists(file_path)
+    assert blob_for(content_hash).ref_count == 1
+
+    assert release_blob(content_hash) is True
+    db.session.commit()
+    assert not os.path.exists(file_path)
+    assert blob_for(content_hash) is None
+
+
+def test_release_removes_preview_and_empty_shard_directory(app):
+    content_hash, file_path = store(app, b'with preview')
+    os.makedirs('static/thumbnails')
+    with open('static/thumbnails/thumb.png', 'wb') as file:
+        file.write(b'png')
+
+    release_blob(content_hash, thumbnail_path='thumbnails/thumb.png')
+    db.session.commit()
+
+    assert not os.path.exists('static/thumbnails/thumb.png')
+    assert not os.path.exists(os.path.dirname(file_path))
+    assert os.path.isdir('uploads')
+
+
+def test_upload_after_delete_stores_bytes_again(app):
+    content_hash, file_path = store(app, b'come back')
+    release_blob(content_hash)
+    db.session.commit()
+
+    store(app, b'come back')
+    assert os.path.exists(file_path)
+    assert blob_for(content_hash).ref_count == 1
+
+
+def test_remove_blob_files_keeps_legacy_upload_folder(app):
+    os.makedirs('uploads')
+    with open('uploads/legacy.pdf', 'wb') as file:
+        file.write(b'%PDF')
+    remove_blob_files(models.FileBlob(content_hash='ab' * 32, filepath='uploads/legacy.pdf'))
+    assert os.path.isdir('uploads')
+
+
+def add_file(content_hash, file_path, filename='notes.txt'):
+    index = db.session.query(models.PineconeIndex).first()
+    if index is None:
+        index = models.PineconeIndex(name='docs')
+        db.session.add(index)
+        db.session.flush()
+    file = models.File(filename=filename, filepath=file_path, index_id=index.id, content_hash=content_hash)
+    db.session.add(file)
+    db.session.commit()
+    return file
+
+
+def test_delete_file_row_releases_its_blob_reference(app):
+    content_hash, file_path = store(app, b'two rows')
+    store(app, b'two rows')
+    first, second = add_file(content_hash, file_path), add_file(content_hash, file_path)
+
+    delete_file_row(first)
+    db.session.commit()
+    assert blob_for(content_hash).ref_count == 1
+    assert os.path.exists(file_path)
+
+    delete_file_row(second)
+    db.session.commit()
+    assert blob_for(content_hash) is None
+    assert not os.path.exists(file_path)
+    assert db.session.query(models.File).count() == 0
+
+
+def test_delete_file_row_removes_legacy_bytes(app):
+    os.makedirs('uploads')
+    with open('uploads/legacy.pdf', 'wb') as file:
+        file.write(b'%PDF')
+    delete_file_row(add_file(None, 'uploads/legacy.pdf', filename='legacy.pdf'))
+    db.session.commit()
+    assert not os.path.exists('uploads/legacy.pdf')
+    assert db.session.query(models.File).count() == 0
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+
+from ratelimit import openai_client, limited_call, estimate_tokens, BACKGROUND
+from shared_state import state as shared_state
+
+TITLE_MODEL = os.environ.get('TITLE_MODEL', 'gpt-4o')
+TITLE_MAX_LENGTH = 50
+TITLE_BATCH_SIZE = int(os.environ.get('TITLE_BATCH_SIZE', 25))  # Filenames per completion call
+TITLE_BATCH_WINDOW = float(os.environ.get('TITLE_BATCH_WINDOW', 0.25))  # Seconds to gather a batch
+TITLE_WORKERS = 2  # Batches in flight at once
+TITLE_CACHE_SIZE = 10000
+TITLE_CACHE_TTL = 30 * 24 * 3600  # Seconds a title stays in the shared state backend
+
+TITLE_PROMPT = (
+    "You are a file title generator. You receive a JSON object mapping ids to filenames. "
+    "Generate a clear, concise title for each filename. Keep each title under 50 characters. "
+    "Do not include file extensions or technical terms. Make them readable and descriptive. "
+    "Respond with a JSON object mapping the same ids to the titles."
+)
+
+# Words kept lower case inside a heuristic title
+SMALL_WORDS = {'a', 'an', 'and', 'as', 'at', 'by', 'for', 'in', 'of', 'on', 'or', 'the', 'to', 'vs'}
+
+client = openai_client()
+
+
+def normalize_filename(filename):
+    """Cache key for a filename: case, extension and separators don't matter"""
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    return re.sub(r'[\W_]+', ' ', base_name).strip().lower()
+
+
+def truncate_title(title):
+    title = title.strip().strip('"').strip()
+    if len(title) > TITLE_MAX_LENGTH:
+        title = title[:TITLE_MAX_LENGTH - 3] + "..."
+    return title
+
+
+def heuristic_title(filename):
+    """Readable title derived locally from a filename, used until the AI title arrives"""
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    # Split camelCase words, then separators
+    spaced = re.sub(r'(?<=[a-z])(?=[A-Z])', ' ', base_name)
+    words = [w for w in re.split(r'[\s_\-.+]+', spaced) if w]
+    if not words:
+        return filename
+
+    titled = []
+    for position, word in enumerate(words):
+        if word.isupper() and len(word) > 1:
+            titled.append(word)  # Keep acronyms
+        elif position and word.lower() in SMALL_WORDS:
+            titled.append(word.lower())
+        else:
+            titled.append(word[0].upper() + word[1:])
+    return truncate_title(' '.join(titled))
+
+
+class TitleCache:
+    """Thread-safe LRU of AI titles keyed by normalized filename.
+
+    When the shared state backend is shared between workers, titles are also
+    written through to it so one worker's titles serve every other worker.
+    """
+
+    def __init__(self, max_size=TITLE_CACHE_SIZE):
+        self.max_size = max_size
+        self._titles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            title = self._titles.get(key)
+            if title is not None:
+                self._titles.move_to_end(key)
+                return title
+        if shared_state.shared:
+            title = shared_state.get(f'title:{key}')
+            if title is not None:
+                self._remember(key, title)
+        return title
+
+    def _remember(self, key, title):
+        with self._lock:
+            self._titles[key] = title
+            self._titles.move_to_end(key)
+            while len(self._titles) > self.max_size:
+                self._titles.popitem(last=False)
+
+    def set(self, key, title):
+        self._remember(key, title)
+        if shared_state.shared:
+            shared_state.set(f'title:{key}', title, ttl=TITLE_CACHE_TTL)
+
+
+class TitleBatcher:
+    """Generates AI titles off the request path, many filenames per completion call.
+
+    Requests for the same normalized filename share one lookup. Callbacks run on
+    a worker thread once the title is known, or immediately on a cache hit.
+    """
+
+    def __init__(self, cache=None):
+        self.cache = cache or TitleCache()
+        self._pending = {}  # normalized filename -> (filename, [callbacks])
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._workers = []
+
+    def _start(self):
+        if self._workers:
+            return
+        for i in range(TITLE_WORKERS):
+            worker = threading.Thread(target=self._run, name=f'title-batcher-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def request(self, filename, callback=None):
+        """Return the cached title, or queue the filename and return None"""
+        key = normalize_filename(filename)
+        if not key:
+            return None
+        title = self.cache.get(key)
+        if title is not None:
+            if callback:
+                callback(title)
+            return title
+
+        with self._lock:
+            if key in self._pending:
+                if callback:
+                    self._pending[key][1].append(callback)
+                return None
+            self._pending[key] = (filename, [callback] if callback else [])
+            self._start()
+        self._queue.put(key)
+        return None
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + TITLE_BATCH_WINDOW
+        while len(batch) < TITLE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            keys = self._next_batch()
+            with self._lock:
+                filenames = {key: self._pending[key][0] for key in keys}
+            try:
+                titles = generate_titles(list(filenames.values()))
+            except Exception as e:
+                logging.error(f"Error generating titles: {e}")
+                titles = {}
+
+            for key, filename in filenames.items():
+                title = titles.get(filename)
+                if title:
+                    self.cache.set(key, title)
+                with self._lock:
+                    _, callbacks = self._pending.pop(key)
+                # Fall back to the heuristic title so waiters are never left hanging
+                for callback in callbacks:
+                    try:
+                        callback(title or heuristic_title(filename))
+                    except Exception as e:
+                        logging.error(f"Error applying title for {filename}: {e}")
+
+
+def generate_titles(filenames):
+    """Generate titles for many filenames with one completion call"""
+    names = {str(i): os.path.splitext(name)[0].replace('_', ' ').replace('-', ' ')
+             for i, name in enumerate(filenames, 1)}
+    payload = json.dumps(names)
+    response = limited_call(
+        client.chat.completions.create,
+        model=TITLE_MODEL,
+        priority=BACKGROUND,
+        tokens=estimate_tokens(payload, completion=20 * len(names)),
+        messages=[{"role": "system", "content": TITLE_PROMPT},
+                  {"role": "user", "content": payload}],
+        response_format={"type": "json_object"},
+        max_tokens=20 * len(names) + 20)
+
+    titles = json.loads(response.choices[0].message.content)
+    return {filename: truncate_title(str(titles[str(i)]))
+            for i, filename in enumerate(filenames, 1)
+            if str(i) in titles and str(titles[str(i)]).strip()}
+
+
+title_batcher = TitleBatcher()
+
+
+def request_title(filename, callback=None):
+    """Queue AI title generation for a filename; returns the title on a cache hit"""
+    return title_batcher.request(filename, callback)
@@ -5,53 +5,13 @@ import logging
 from werkzeug.utils import secure_filename
 from pdf2image import convert_from_path
 import tempfile
-import PyPDF2
-import docx2txt
 import re
-from openai import OpenAI
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client with API key
-client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-
-
-def generate_title(filename):
-    """Generate a human-readable title from the filename using OpenAI"""
-    try:
-        # Remove file extension and replace underscores/hyphens with spaces
-        base_name = os.path.splitext(filename)[0].replace('_', ' ').replace(
-            '-', ' ')
-
-        response = client.chat.completions.create(
-            model=
-            "gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024
-            messages=[{
-                "role":
-                "system",
-                "content":
-                "You are a file title generator. Generate a clear, concise title from the given filename. "
-                "Keep it under 50 characters. Do not include file extensions or technical terms. "
-                "Make it readable and descriptive."
-            }, {
-                "role":
-                "user",
-                "content":
-                f"Generate a title for this filename: {base_name}"
-            }],
-            max_tokens=50)
-
-        title = response.choices[0].message.content.strip()
-        # Ensure the title isn't too long
-        if len(title) > 50:
-            title = title[:47] + "..."
-        return title
-    except Exception as e:
-        logging.error(f"Error generating title: {e}")
-        return filename  # Fallback to original filename if generation fails
-
+from extractors import extract_text_from_file  # noqa: F401 - re-exported for callers of utils
 
 THUMBNAIL_SIZE = (200, 200)
 IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
@@ -119,48 +79,6 @@ def is_pdf(mime_type):
     return mime_type == 'application/pdf'
 
 
-def extract_text_from_pdf(filepath):
-    """Extract text content from PDF file"""
-    try:
-        text = ""
-        with open(filepath, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-        return text.strip()
-    except Exception as e:
-        logging.error(f"Error extracting text from PDF: {e}")
-        return ""
-
-
-def extract_text_from_docx(filepath):
-    """Extract text content from DOCX file"""
-    try:
-        return docx2txt.process(filepath)
-    except Exception as e:
-        logging.error(f"Error extracting text from DOCX: {e}")
-        return ""
-
-
-def extract_text_from_file(filepath, mime_type):
-    """Extract text content from various file types"""
-    try:
-        if mime_type == 'application/pdf':
-            return extract_text_from_pdf(filepath)
-        elif mime_type in [
-                'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                'application/msword'
-        ]:
-            return extract_text_from_docx(filepath)
-        elif mime_type.startswith('text/'):
-            with open(filepath, 'r', encoding='utf-8') as file:
-                return file.read()
-        return ""
-    except Exception as e:
-        logging.error(f"Error extracting text from file: {e}")
-        return ""
-
-
 def generate_thumbnail(filepath, filename):
     """Generate a thumbnail for an image file"""
     try: